@@ -0,0 +1,90 @@
+import argparse
+import json
+import random
+import timeit
+
+from benchmarks.common import create_bench_app, seed, measure
+from flaskr.answers import normalize, matches, AnswerCache
+from models import db, Question
+
+#----------------------------------------------------------------------------#
+# Cost of checking a guess: the matcher alone (normalizing the guess and
+# comparing it with a normalized answer), AnswerCache.check on a cached
+# answer, and POST /questions/<id>/answer through the test client.
+#
+#     python -m benchmarks.bench_answers --questions 10k
+#----------------------------------------------------------------------------#
+
+ANSWERS = ['Lake Victoria', 'George Washington Carver', 'The Beatles', 'Mona Lisa', '1990', 'Uruguay']
+
+
+def guesses(answer, rng):
+    """an exact guess, one with a typo, one that contains the answer and a wrong one"""
+    typo = list(answer.lower())
+    position = rng.randrange(len(typo))
+    typo[position] = 'x' if typo[position] != 'x' else 'y'
+    return {
+        'exact': answer.upper(),
+        'typo': ''.join(typo),
+        'contains': 'I think {}!'.format(answer),
+        'wrong': 'Abraham Lincoln',
+    }
+
+
+# mean time of one of the `batch` calls made by `fn`
+def microseconds(fn, repeat, batch=1):
+    return round(timeit.timeit(fn, number=repeat) / (repeat * batch) * 1e6, 2)
+
+
+def run(questions, number, requests):
+    rng = random.Random(0)
+    results = {'questions': questions, 'matcher_us': {}, 'cached_check_us': {}}
+
+    normalized = {answer: normalize(answer) for answer in ANSWERS}
+    for kind in ('exact', 'typo', 'contains', 'wrong'):
+        cases = [(guesses(answer, rng)[kind], normalized[answer]) for answer in ANSWERS]
+        results['matcher_us'][kind] = microseconds(
+            lambda: [matches(normalize(guess), answer) for guess, answer in cases],
+            number // len(cases), len(cases))
+    results['normalize_answer_us'] = microseconds(
+        lambda: [normalize(answer) for answer in ANSWERS], number // len(ANSWERS), len(ANSWERS))
+
+    app = create_bench_app()
+    seed(app, questions)
+    with app.app_context():
+        rows = db.session.query(Question.id, Question.answer).limit(1000).all()
+        cache = AnswerCache()
+        for id, _ in rows:
+            cache.get(id)
+        for kind in ('exact', 'typo', 'wrong'):
+            cases = [(id, guesses(answer, rng)[kind]) for id, answer in rows[:100]]
+            results['cached_check_us'][kind] = microseconds(
+                lambda: [cache.check(id, guess) for id, guess in cases],
+                number // len(cases), len(cases))
+        results['uncached_check_us'] = microseconds(
+            lambda: AnswerCache().check(rows[0][0], 'guess'), 200)
+
+    client = app.test_client()
+    cases = [('/questions/{}/answer'.format(id), {'answer': guesses(answer, rng)['typo']})
+             for id, answer in rows]
+
+    def check():
+        path, body = rng.choice(cases)
+        client.post(path, json=body)
+
+    results['endpoint'] = measure(check, requests)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='answer matching cost')
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--number', type=int, default=20000, help='matcher calls timed')
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.questions, args.number, args.requests), indent=2))
+
+
+if __name__ == '__main__':
+    main()
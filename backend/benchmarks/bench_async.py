@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from benchmarks.common import create_bench_app, parse_sizes, seed
+from flaskr.asgi import AsyncTriviaApp, async_database_url
+from models import db
+
+#----------------------------------------------------------------------------#
+# Concurrent requests served by one worker: the Flask app on a pool of
+# threads (a threaded WSGI worker) against the ASGI app on one event loop.
+# Every statement is slowed down by --latency-ms in the thread running it,
+# standing in for the network round trip to a database server.
+#
+#     python -m benchmarks.bench_async --questions 10k --requests 2000 --latency-ms 20
+#----------------------------------------------------------------------------#
+
+
+def requests_mix(count, rng):
+    mix = []
+    for _ in range(count):
+        kind = rng.randrange(4)
+        if kind == 0:
+            mix.append(('GET', '/questions?page={}'.format(rng.randint(1, 50)), None))
+        elif kind == 1:
+            mix.append(('GET', '/categories', None))
+        elif kind == 2:
+            mix.append(('POST', '/quizzes', {
+                'previous_questions': [], 'quiz_category': {'type': 'click', 'id': 0}}))
+        else:
+            mix.append(('POST', '/questions/search', {'searchTerm': rng.choice(['river', 'king', 'gold'])}))
+    return mix
+
+
+def slow_down(engine, latency):
+    def connect(dbapi_connection, connection_record):
+        sqlite_connection = getattr(dbapi_connection, '_connection', None)
+        sqlite_connection = getattr(sqlite_connection, '_conn', dbapi_connection)
+        sqlite_connection.set_trace_callback(lambda statement: time.sleep(latency))
+    event.listen(engine, 'connect', connect)
+
+
+def stats(samples, seconds):
+    samples.sort()
+    return {
+        'requests_per_second': round(len(samples) / seconds, 1),
+        'p50_ms': round(samples[len(samples) // 2] * 1000, 2),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 2),
+    }
+
+
+def run_sync(app, mix, threads):
+    client = app.test_client()
+
+    def call(request):
+        method, path, body = request
+        start = time.perf_counter()
+        res = client.open(path, method=method, json=body)
+        assert res.status_code == 200, (path, res.status_code)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        samples = list(pool.map(call, mix))
+    return stats(samples, time.perf_counter() - start)
+
+
+async def asgi_call(asgi, method, path, body):
+    path, _, query_string = path.partition('?')
+    payload = b'' if body is None else json.dumps(body).encode()
+    scope = {
+        'type': 'http', 'http_version': '1.1', 'scheme': 'http', 'method': method,
+        'path': path, 'raw_path': path.encode(), 'root_path': '',
+        'query_string': query_string.encode(),
+        'headers': [(b'content-type', b'application/json')],
+        'server': ('localhost', 80), 'client': ('127.0.0.1', 50000),
+    }
+    messages = [{'type': 'http.request', 'body': payload, 'more_body': False}]
+    status = []
+
+    async def receive():
+        return messages.pop() if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await asgi(scope, receive, send)
+    return status[0]
+
+
+async def run_async(asgi, mix, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(request):
+        async with semaphore:
+            start = time.perf_counter()
+            status = await asgi_call(asgi, *request)
+            assert status == 200, (request[1], status)
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    samples = await asyncio.gather(*(call(request) for request in mix))
+    seconds = time.perf_counter() - start
+    await asgi.dispose()
+    return stats(list(samples), seconds)
+
+
+def run(questions, requests, threads, concurrency, latency_ms):
+    config = {
+        'SEARCH_BACKEND': 'like',
+        'RESPONSE_CACHE_MAX_ENTRIES': 0,
+        'SQLALCHEMY_ENGINE_OPTIONS': {'connect_args': {'check_same_thread': False}},
+    }
+    app = create_bench_app(config=config)
+    seed(app, questions)
+    mix = requests_mix(requests, random.Random(0))
+    latency = latency_ms / 1000
+
+    with app.app_context():
+        slow_down(db.engine, latency)
+    engine = create_async_engine(async_database_url(app), connect_args={'check_same_thread': False})
+    slow_down(engine.sync_engine, latency)
+
+    return {
+        'sync_threads_{}'.format(threads): run_sync(app, mix, threads),
+        'async_concurrency_{}'.format(concurrency): asyncio.run(
+            run_async(AsyncTriviaApp(app, engine), mix, concurrency)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sync (threads) against async (event loop) serving')
+    parser.add_argument('--questions', default='10k')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    args = parser.parse_args()
+
+    questions, = parse_sizes(args.questions)
+    print(json.dumps(run(questions, args.requests, args.threads, args.concurrency, args.latency_ms), indent=2))
+
+
+if __name__ == '__main__':
+    main()
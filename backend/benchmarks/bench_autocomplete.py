@@ -0,0 +1,67 @@
+import argparse
+import itertools
+import json
+import random
+import time
+import tracemalloc
+
+from benchmarks.common import create_bench_app, seed, measure, parse_sizes, WORDS
+from flaskr.search import PrefixIndex, load_search_rows
+
+#----------------------------------------------------------------------------#
+# Typeahead latency and memory footprint of the prefix index.
+#
+#     python -m benchmarks.bench_autocomplete --sizes 10k,100k
+#
+# `index` times PrefixIndex.complete() alone, `endpoint` a full
+# GET /questions/autocomplete through the Flask test client.
+#----------------------------------------------------------------------------#
+
+
+def run(size, repeat):
+    app = create_bench_app()
+    seed(app, size)
+    rng = random.Random(1)
+    prefixes = [word[:rng.randint(1, len(word))] for word in WORDS]
+    queries = prefixes + ['{} {}'.format(rng.choice(WORDS), prefix) for prefix in prefixes]
+
+    with app.app_context():
+        rows = list(load_search_rows())
+        tracemalloc.start()
+        start = time.perf_counter()
+        index = PrefixIndex(lambda: rows)
+        index._ensure_built()
+        build_ms = (time.perf_counter() - start) * 1000
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    # the texts are shared with `rows`, count them as part of the index
+    memory += sum(len(text) + 49 for text in index.texts.values())
+
+    client = app.test_client()
+    client.get('/questions/autocomplete?q=a')
+    queries_cycle = itertools.cycle(queries)
+
+    return {
+        'questions': size,
+        'entries': len(index.ids),
+        'build_ms': round(build_ms, 1),
+        'bytes_per_question': round(memory / size, 1),
+        'index': measure(lambda: index.complete(next(queries_cycle), 10), repeat),
+        'endpoint': measure(
+            lambda: client.get('/questions/autocomplete?q=' + next(queries_cycle)), repeat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='typeahead latency and memory')
+    parser.add_argument('--sizes', default='10k,100k')
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    results = [run(size, args.repeat) for size in parse_sizes(args.sizes)]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
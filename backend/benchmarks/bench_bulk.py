@@ -0,0 +1,60 @@
+import argparse
+import io
+import json
+import random
+import time
+
+from benchmarks.common import create_bench_app, make_question, parse_sizes
+from flaskr.bulk import read_records, import_questions, export_questions
+from models import Question
+
+#----------------------------------------------------------------------------#
+# Import throughput in rows/sec: one Question.insert() (and commit) per
+# row, against the batched NDJSON import.
+#
+#     python -m benchmarks.bench_bulk --rows 100k --per-row 5k
+#----------------------------------------------------------------------------#
+
+
+def rows_per_second(count, seconds):
+    return round(count / seconds, 1)
+
+
+def run(rows, per_row, database_uri):
+    rng = random.Random(0)
+    app = create_bench_app(database_uri)
+    results = {}
+
+    with app.app_context():
+        start = time.perf_counter()
+        for n in range(per_row):
+            record = make_question(n, rng)
+            Question(record['question'], record['answer'], record['category'], record['difficulty']).insert()
+        results['per_row_insert'] = rows_per_second(per_row, time.perf_counter() - start)
+
+        body = ''.join(json.dumps(make_question(n, rng)) + '\n' for n in range(rows)).encode()
+        start = time.perf_counter()
+        result = import_questions(read_records(io.BytesIO(body), 'ndjson'))
+        results['ndjson_import'] = rows_per_second(result['imported'], time.perf_counter() - start)
+
+        start = time.perf_counter()
+        exported = sum(1 for line in export_questions())
+        results['ndjson_export'] = rows_per_second(exported, time.perf_counter() - start)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='bulk import/export throughput')
+    parser.add_argument('--rows', default='100k')
+    parser.add_argument('--per-row', default='5k')
+    parser.add_argument('--database-uri', default=None)
+    args = parser.parse_args()
+
+    rows, = parse_sizes(args.rows)
+    per_row, = parse_sizes(args.per_row)
+    print(json.dumps(run(rows, per_row, args.database_uri), indent=2))
+
+
+if __name__ == '__main__':
+    main()
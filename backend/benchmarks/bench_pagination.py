@@ -0,0 +1,48 @@
+import argparse
+import json
+
+from benchmarks.common import create_bench_app, seed, measure, parse_sizes
+from flaskr import QUESTIONS_PER_PAGE
+
+#----------------------------------------------------------------------------#
+# GET /questions latency against the size of the question bank.
+#
+#     python -m benchmarks.bench_pagination --sizes 1k,10k,100k,1M
+#
+# `first_page` and `keyset_deep` should stay flat as the table grows,
+# `offset_deep` shows what a large OFFSET still costs the database.
+#----------------------------------------------------------------------------#
+
+
+def run(size, repeat):
+    app = create_bench_app()
+    seed(app, size)
+    client = app.test_client()
+    last_page = max(1, (size + QUESTIONS_PER_PAGE - 1) // QUESTIONS_PER_PAGE)
+    deep_id = max(0, size - QUESTIONS_PER_PAGE)
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+
+    return {
+        'questions': size,
+        'first_page': measure(lambda: get('/questions?page=1'), repeat),
+        'offset_deep': measure(lambda: get('/questions?page={}'.format(last_page)), repeat),
+        'keyset_deep': measure(lambda: get('/questions?after_id={}'.format(deep_id)), repeat),
+        'category_page': measure(lambda: get('/categories/1/questions?page=1'), repeat),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GET /questions latency by table size')
+    parser.add_argument('--sizes', default='1k,10k,100k,1M')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    results = [run(size, args.repeat) for size in parse_sizes(args.sizes)]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import itertools
+import json
+import random
+import tracemalloc
+
+from benchmarks.common import create_bench_app, seed, measure, parse_sizes, CATEGORIES
+from flaskr import QUESTIONS_PER_PAGE
+from models import db, page_with_total, read_questions, format_row, Question, QUESTION_COLUMNS
+
+#----------------------------------------------------------------------------#
+# Latency and memory allocated per page of questions, by the way the rows
+# are read:
+#     orm_entities    Question instances, then Question.format()
+#     orm_columns     an ORM query of the formatted columns
+#     read_questions  the Core SELECT of models.read_questions
+# and for the total alone, Query.count() against read_questions(count_only).
+# `endpoint` times the GET /questions pages through the test client.
+#
+#     python -m benchmarks.bench_projection --sizes 10k,100k
+#----------------------------------------------------------------------------#
+
+
+def allocated_bytes(fn, repeat=50):
+    """mean peak memory allocated by one call of `fn`"""
+    total = 0
+    tracemalloc.start()
+    for _ in range(repeat):
+        db.session.expunge_all()
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        fn()
+        total += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return round(total / repeat)
+
+
+def run(size, repeat):
+    app = create_bench_app(config={'RESPONSE_CACHE_MAX_ENTRIES': 0})
+    seed(app, size)
+    rng = random.Random(1)
+    offsets = itertools.cycle([rng.randrange(0, 100) * QUESTIONS_PER_PAGE for _ in range(500)])
+    categories = itertools.cycle([rng.randint(1, len(CATEGORIES)) for _ in range(500)])
+
+    def orm_entities():
+        questions, total = page_with_total(
+            Question.query.filter(Question.category_id == next(categories)).order_by(Question.id),
+            next(offsets), QUESTIONS_PER_PAGE, entities=True)
+        return [question.format() for question in questions], total
+
+    def orm_columns():
+        rows, total = page_with_total(
+            Question.query.with_entities(*QUESTION_COLUMNS).filter(
+                Question.category_id == next(categories)).order_by(Question.id),
+            next(offsets), QUESTIONS_PER_PAGE)
+        return [format_row(row) for row in rows], total
+
+    def projected():
+        rows, total = read_questions(next(categories), offset=next(offsets), limit=QUESTIONS_PER_PAGE)
+        return [format_row(row) for row in rows], total
+
+    results = {'questions': size}
+    with app.app_context():
+        for name, fn in (('orm_entities', orm_entities), ('orm_columns', orm_columns),
+                         ('read_questions', projected)):
+            results[name] = dict(measure(fn, repeat), allocated_bytes=allocated_bytes(fn))
+        results['query_count'] = measure(lambda: Question.query.count(), repeat)
+        results['count_only'] = measure(lambda: read_questions(count_only=True), repeat)
+
+    client = app.test_client()
+    results['endpoint'] = measure(
+        lambda: client.get('/questions?page={}'.format(next(offsets) // QUESTIONS_PER_PAGE + 1)), repeat)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='per page latency and allocations by query style')
+    parser.add_argument('--sizes', default='10k,100k')
+    parser.add_argument('--repeat', type=int, default=500)
+    args = parser.parse_args()
+
+    results = [run(size, args.repeat) for size in parse_sizes(args.sizes)]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import json
+import time
+
+from benchmarks.common import create_bench_app, seed, measure, parse_sizes
+from flaskr import create_app
+
+#----------------------------------------------------------------------------#
+# POST /questions/search latency for each search backend.
+#
+#     python -m benchmarks.bench_search --sizes 100k
+#     python -m benchmarks.bench_search --database-uri postgresql://... --backends like,postgres
+#
+# The synthetic bank uses a ~30 word vocabulary, so most terms match a
+# third of the table: a worst case for the index, real questions are sparser.
+#----------------------------------------------------------------------------#
+
+TERMS = ['capital', 'gold medal', 'anc', 'famous painter river', 'nothingmatches']
+
+
+def run(size, backends, database_uri, repeat):
+    app = create_bench_app(database_uri)
+    seed(app, size)
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+
+    results = {'questions': size}
+    for backend in backends:
+        client = create_app({'SQLALCHEMY_DATABASE_URI': uri, 'SEARCH_BACKEND': backend}).test_client()
+
+        def search(term):
+            response = client.post('/questions/search', json={'searchTerm': term})
+            assert response.status_code == 200, response.status_code
+
+        # the first search pays for building the in-process index
+        start = time.perf_counter()
+        search(TERMS[0])
+        results[backend] = {'first_search_ms': round((time.perf_counter() - start) * 1000, 2)}
+        for term in TERMS:
+            results[backend][term] = measure(lambda: search(term), repeat)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='search latency by backend')
+    parser.add_argument('--sizes', default='100k')
+    parser.add_argument('--backends', default='like,memory')
+    parser.add_argument('--database-uri', default=None)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    results = [run(size, args.backends.split(','), args.database_uri, args.repeat)
+               for size in parse_sizes(args.sizes)]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
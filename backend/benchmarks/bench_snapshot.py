@@ -0,0 +1,85 @@
+import argparse
+import itertools
+import json
+import random
+import tracemalloc
+
+from benchmarks.common import create_bench_app, seed, measure, parse_sizes, CATEGORIES
+from flaskr import create_app
+from flaskr.snapshot import QuestionSnapshot, load_snapshot_rows
+from models import db, Question
+
+#----------------------------------------------------------------------------#
+# The in-memory question snapshot against the ORM.
+#
+#     python -m benchmarks.bench_snapshot --sizes 10k,100k
+#
+# `bytes_per_question` is the memory held once every question is loaded,
+# as ORM objects or as a snapshot. The endpoints are timed through the
+# Flask test client with QUESTION_SNAPSHOT off and on, the response cache
+# disabled, and reported in requests per second.
+#----------------------------------------------------------------------------#
+
+
+def traced_bytes(load):
+    tracemalloc.start()
+    loaded = load()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return memory, loaded
+
+
+def requests_per_second(stats):
+    return round(1000 / stats['mean_ms'], 1)
+
+
+def run(size, repeat):
+    app = create_bench_app(config={'RESPONSE_CACHE_MAX_ENTRIES': 0})
+    seed(app, size)
+    snapshot_app = create_app({
+        'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI'],
+        'RESPONSE_CACHE_MAX_ENTRIES': 0,
+        'QUESTION_SNAPSHOT': True,
+    })
+
+    with app.app_context():
+        orm_memory, questions = traced_bytes(lambda: Question.query.all())
+        del questions
+        db.session.remove()
+        snapshot_memory, snapshot = traced_bytes(lambda: QuestionSnapshot(load_snapshot_rows()))
+
+    rng = random.Random(1)
+    pages = itertools.cycle([rng.randint(1, size // 10) for _ in range(1000)])
+    categories = itertools.cycle([rng.randint(1, len(CATEGORIES)) for _ in range(1000)])
+    results = {
+        'questions': size,
+        'orm_bytes_per_question': round(orm_memory / size, 1),
+        'snapshot_bytes_per_question': round(snapshot_memory / size, 1),
+    }
+    for mode, client in (('orm', app.test_client()), ('snapshot', snapshot_app.test_client())):
+        client.get('/questions')
+        results[mode] = {
+            'questions_page': requests_per_second(measure(
+                lambda: client.get('/questions?page={}'.format(next(pages))), repeat)),
+            'category_page': requests_per_second(measure(
+                lambda: client.get('/categories/{}/questions?page=2'.format(next(categories))), repeat)),
+            'quiz': requests_per_second(measure(
+                lambda: client.post('/quizzes', json={
+                    'previous_questions': [1, 2, 3],
+                    'quiz_category': {'type': 'x', 'id': next(categories)}}), repeat)),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='snapshot against ORM memory and throughput')
+    parser.add_argument('--sizes', default='10k,100k')
+    parser.add_argument('--repeat', type=int, default=1000)
+    args = parser.parse_args()
+
+    results = [run(size, args.repeat) for size in parse_sizes(args.sizes)]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
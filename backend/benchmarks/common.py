@@ -0,0 +1,89 @@
+import os
+import random
+import tempfile
+import time
+
+from flaskr import create_app
+from models import db, Question, Category
+
+#----------------------------------------------------------------------------#
+# Helpers shared by the benchmark scripts.
+# Run them from the /backend directory, e.g.
+#     python -m benchmarks.bench_pagination
+#----------------------------------------------------------------------------#
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+WORDS = (
+    'what which who where when capital river mountain painter novel movie '
+    'element planet king queen war team player record ocean country city '
+    'first largest smallest famous ancient modern world cup gold medal'
+).split()
+
+
+def create_bench_app(database_uri=None, config=None):
+    """creates an app bound to `database_uri` (a fresh SQLite file by default)"""
+    if database_uri is None:
+        handle, path = tempfile.mkstemp(suffix='.db', prefix='trivia_bench_')
+        os.close(handle)
+        database_uri = 'sqlite:///' + path
+
+    test_config = {'SQLALCHEMY_DATABASE_URI': database_uri}
+    test_config.update(config or {})
+    app = create_app(test_config)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+def make_question(n, rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(5, 12))]
+    category = rng.randint(1, len(CATEGORIES))
+    return {
+        'question': '{} {}?'.format(' '.join(words).capitalize(), n),
+        'answer': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))),
+        'category': str(category),
+        'category_id': category,
+        'difficulty': rng.randint(1, 5),
+    }
+
+
+def seed(app, count, batch_size=10000, seed=0):
+    """bulk loads the categories and `count` synthetic questions"""
+    rng = random.Random(seed)
+    with app.app_context():
+        db.session.execute(Category.__table__.insert(), [{'type': type} for type in CATEGORIES])
+        for start in range(0, count, batch_size):
+            rows = [make_question(n, rng) for n in range(start, min(start + batch_size, count))]
+            db.session.execute(Question.__table__.insert(), rows)
+        db.session.commit()
+
+
+def measure(fn, repeat=200, warmup=10):
+    """calls `fn` `repeat` times, returns latency stats in milliseconds"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'mean_ms': round(sum(samples) / len(samples), 4),
+        'p50_ms': round(samples[len(samples) // 2], 4),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 4),
+    }
+
+
+def parse_sizes(value):
+    """'1k,10k,1M' -> [1000, 10000, 1000000]"""
+    units = {'k': 1000, 'm': 1000000}
+    sizes = []
+    for item in value.split(','):
+        item = item.strip().lower()
+        if item[-1] in units:
+            sizes.append(int(float(item[:-1]) * units[item[-1]]))
+        else:
+            sizes.append(int(item))
+    return sizes
@@ -0,0 +1,415 @@
+import argparse
+import http.client
+import itertools
+import json
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from benchmarks.common import create_bench_app, seed, parse_sizes, CATEGORIES, WORDS, make_question
+from models import db
+
+#----------------------------------------------------------------------------#
+# Benchmark suite: every endpoint of the API, against a seeded question bank,
+# through the Flask test client (the app alone) and a real WSGI server over
+# HTTP. Reports throughput, p50/p99 latency and SQL statements per request
+# (from the app's own metrics, see GET /metrics) as JSON.
+#
+#     python -m benchmarks.run --sizes 10k,100k --output results.json
+#     python -m benchmarks.run --sizes 10k --baseline results.json
+#
+# With --baseline, exits with status 1 when an endpoint got slower than the
+# baseline by more than --tolerance, or runs more SQL statements.
+# --database runs against another database, e.g. a local Postgres:
+#     --database postgresql://localhost:5432/trivia_bench
+# Its tables are dropped and re-created.
+#----------------------------------------------------------------------------#
+
+TRANSPORTS = ('test_client', 'wsgi')
+
+
+class Scenario(object):
+    """
+    Requests to one endpoint (the Flask endpoint name, `name` by default).
+    `make(rng)` returns the (method, path, body) of the next request;
+    `prepare(transport, rng)` does the same but may send untimed requests
+    first (e.g. to create what it then deletes).
+    """
+
+    def __init__(self, name, make=None, prepare=None, endpoint=None, statuses=(200,), weight=1.0):
+        self.name = name
+        self.endpoint = endpoint or name
+        self.prepare = prepare or (lambda transport, rng: make(rng))
+        self.statuses = statuses
+        # share of --requests sent, for the endpoints too slow to send them all
+        self.weight = weight
+
+
+def scenarios(size):
+    """The scenarios, read-only ones first, for a bank of `size` questions"""
+    pages = max(size // 10, 1)
+    # the seeded questions, deleted from the last one down
+    seeded_ids = itertools.count(size, -1)
+    counter = itertools.count()
+
+    def search_term(rng):
+        return ' '.join(rng.sample(WORDS, rng.randint(1, 2)))
+
+    def quiz_category(rng):
+        category = rng.randint(0, len(CATEGORIES))
+        if category == 0:
+            return {'type': 'click', 'id': 0}
+        return {'type': CATEGORIES[category - 1], 'id': category}
+
+    def start_session(transport, rng):
+        status, body = transport.request('POST', '/quizzes/sessions', {
+            'quiz_category': {'type': CATEGORIES[0], 'id': 1}})
+        return json.loads(body)['token']
+
+    # a new session with a question drawn, waiting for its answer
+    def drawn_session(transport, rng):
+        token = start_session(transport, rng)
+        transport.request('POST', '/quizzes/sessions/{}/next'.format(token))
+        return token
+
+    def answered_session(transport, rng):
+        token = drawn_session(transport, rng)
+        transport.request('POST', '/quizzes/sessions/{}/answer'.format(token), {'answer': rng.choice(WORDS)})
+        return token
+
+    # one session per transport, drawn from until its deck is empty
+    sessions = {}
+
+    def next_question(transport, rng):
+        token = sessions.get(transport)
+        if token is None:
+            token = sessions[transport] = start_session(transport, rng)
+        return 'POST', '/quizzes/sessions/{}/next'.format(token), None
+
+    adaptive_sessions = {}
+
+    def next_adaptive_question(transport, rng):
+        token = adaptive_sessions.get(transport)
+        if token is None:
+            status, body = transport.request('POST', '/quizzes/adaptive', {
+                'quiz_category': {'type': 'click', 'id': 0}})
+            token = adaptive_sessions[transport] = json.loads(body)['token']
+        return 'POST', '/quizzes/adaptive/{}/next'.format(token), {'correct': rng.random() < 0.6}
+
+    def question(rng):
+        question = make_question(next(counter), rng)
+        del question['category_id']
+        return question
+
+    def import_body(rng):
+        return '\n'.join(json.dumps(question(rng)) for _ in range(100))
+
+    return [
+        Scenario('get_categories', lambda rng: ('GET', '/categories', None)),
+        Scenario('get_questions', lambda rng: (
+            'GET', '/questions?page={}'.format(rng.randint(1, min(pages, 100))), None)),
+        Scenario('get_questions_keyset', lambda rng: (
+            'GET', '/questions?after_id={}'.format(rng.randrange(size)), None), endpoint='get_questions'),
+        Scenario('get_questions_in_category', lambda rng: (
+            'GET', '/categories/{}/questions?page={}'.format(
+                rng.randint(1, len(CATEGORIES)), rng.randint(1, 10)), None)),
+        Scenario('search', lambda rng: (
+            'POST', '/questions/search', {'searchTerm': search_term(rng)})),
+        Scenario('autocomplete', lambda rng: (
+            'GET', '/questions/autocomplete?q={}'.format(rng.choice(WORDS)[:3]), None)),
+        Scenario('check_answer', lambda rng: (
+            'POST', '/questions/{}/answer'.format(rng.randint(1, min(size, 1000))),
+            {'answer': ' '.join(rng.sample(WORDS, 2))})),
+        Scenario('play_quizz', lambda rng: ('POST', '/quizzes', {
+            'quiz_category': quiz_category(rng),
+            'previous_questions': rng.sample(range(1, size + 1), min(size, 20))})),
+        Scenario('start_quiz_session', lambda rng: (
+            'POST', '/quizzes/sessions', {'quiz_category': quiz_category(rng)}), weight=0.1),
+        Scenario('next_quiz_question', prepare=next_question),
+        Scenario('answer_quiz_question', prepare=lambda transport, rng: (
+            'POST', '/quizzes/sessions/{}/answer'.format(drawn_session(transport, rng)),
+            {'answer': rng.choice(WORDS)}), weight=0.1),
+        Scenario('end_quiz_session', prepare=lambda transport, rng: (
+            'DELETE', '/quizzes/sessions/{}'.format(start_session(transport, rng)), None), weight=0.1),
+        Scenario('start_adaptive_quiz', lambda rng: (
+            'POST', '/quizzes/adaptive', {'quiz_category': quiz_category(rng)}), weight=0.1),
+        Scenario('next_adaptive_question', prepare=next_adaptive_question),
+        Scenario('get_difficulties', lambda rng: (
+            'GET', '/quizzes/difficulties?category={}'.format(rng.randint(1, len(CATEGORIES))), None)),
+        Scenario('get_question_stats', lambda rng: (
+            'GET', '/categories/{}/questions/stats?sort={}'.format(
+                rng.randint(1, len(CATEGORIES)), rng.choice(('hardest', 'easiest', 'served'))), None),
+                 weight=0.1),
+        Scenario('get_leaderboard', lambda rng: (
+            'GET', '/leaderboard?category={}&limit=10'.format(rng.randint(1, len(CATEGORIES))), None)),
+        Scenario('export_questions_in_bulk', lambda rng: ('GET', '/questions/export', None),
+                 weight=0.01),
+        Scenario('get_cache_stats', lambda rng: ('GET', '/stats/cache', None)),
+        Scenario('get_results_stats', lambda rng: ('GET', '/stats/results', None)),
+        Scenario('get_pool_stats', lambda rng: ('GET', '/stats/pool', None)),
+        Scenario('get_metrics', lambda rng: ('GET', '/metrics', None)),
+        # writes
+        Scenario('record_quiz_result', prepare=lambda transport, rng: ('POST', '/quizzes/results', {
+            'player': 'player {}'.format(rng.randrange(10000)),
+            'token': answered_session(transport, rng)}), weight=0.1),
+        Scenario('create_question', lambda rng: ('POST', '/questions', question(rng))),
+        Scenario('create_questions', lambda rng: ('POST', '/questions/batch', {
+            'questions': [question(rng) for _ in range(10)]}), weight=0.5),
+        Scenario('import_questions_in_bulk', lambda rng: (
+            'POST', '/questions/import', import_body(rng)), weight=0.1),
+        Scenario('create_category', lambda rng: (
+            'POST', '/categories', {'type': 'Category {}'.format(next(counter))}), weight=0.1),
+        Scenario('delete_question', lambda rng: (
+            'DELETE', '/questions/{}'.format(next(seeded_ids)), None)),
+        Scenario('delete_questions', lambda rng: ('DELETE', '/questions', {
+            'ids': [next(seeded_ids) for _ in range(10)]}), weight=0.5),
+    ]
+
+
+#  Transports
+#  ----------------------------------------------------------------
+
+def encode(body):
+    if body is None:
+        return None, {}
+    if isinstance(body, str):
+        return body.encode(), {'Content-Type': 'application/x-ndjson'}
+    return json.dumps(body).encode(), {'Content-Type': 'application/json'}
+
+
+class TestClientTransport(object):
+    """Requests handed to the app in process, no HTTP"""
+
+    name = 'test_client'
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        data, headers = encode(body)
+        res = self.client.open(path, method=method, data=data, headers=headers)
+        return res.status_code, res.get_data()
+
+    def close(self):
+        pass
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class WSGIServerTransport(object):
+    """The app served by werkzeug's threaded WSGI server, one keep-alive connection per client thread"""
+
+    name = 'wsgi'
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(
+                '127.0.0.1', self.server.server_port, timeout=300)
+        return connection
+
+    def request(self, method, path, body=None):
+        data, headers = encode(body)
+        connection = self.connection()
+        connection.request(method, path, body=data, headers=headers)
+        res = connection.getresponse()
+        return res.status, res.read()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+#  Runs
+#  ----------------------------------------------------------------
+
+def percentile(samples, share):
+    return samples[min(len(samples) - 1, int(len(samples) * share))]
+
+
+def sql_statements(app, endpoint):
+    """(statements, requests) recorded so far for `endpoint`"""
+    _, statements, requests = app.extensions['trivia_metrics'].statements.get(endpoint)
+    return statements, requests
+
+
+def run_scenario(app, transport, scenario, requests, concurrency, warmup, rng):
+    count = max(int(requests * scenario.weight), 1)
+    lock = threading.Lock()
+
+    def call(_):
+        with lock:
+            method, path, body = scenario.prepare(transport, rng)
+        start = time.perf_counter()
+        status, _ = transport.request(method, path, body)
+        return time.perf_counter() - start, status in scenario.statuses
+
+    for n in range(min(warmup, count)):
+        call(n)
+
+    statements_before, requests_before = sql_statements(app, scenario.endpoint)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        calls = list(pool.map(call, range(count)))
+    seconds = time.perf_counter() - start
+    statements, recorded = sql_statements(app, scenario.endpoint)
+
+    samples = sorted(sample for sample, _ in calls)
+    recorded -= requests_before
+    return {
+        'endpoint': scenario.name,
+        'requests': count,
+        'errors': sum(1 for _, ok in calls if not ok),
+        'requests_per_second': round(count / seconds, 1),
+        'p50_ms': round(percentile(samples, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'sql_statements_per_request': round((statements - statements_before) / recorded, 2) if recorded else None,
+    }
+
+
+def run(size, database, config, requests, concurrency, warmup, transports):
+    app_config = {'METRICS_ENABLED': True}
+    app_config.update(config)
+    if database is None or database.startswith('sqlite'):
+        # the WSGI server answers from its own threads
+        app_config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {'connect_args': {'check_same_thread': False}})
+    results = []
+    for transport_class in (TestClientTransport, WSGIServerTransport):
+        if transport_class.name not in transports:
+            continue
+        # a fresh bank per transport, the writes of one do not skew the other
+        app = create_bench_app(database, app_config)
+        seed(app, size)
+        transport = transport_class(app)
+        rng = random.Random(0)
+        try:
+            for scenario in scenarios(size):
+                result = run_scenario(app, transport, scenario, requests, concurrency, warmup, rng)
+                results.append(dict(result, questions=size, transport=transport.name))
+                print('{questions} {transport} {endpoint}: {requests_per_second} req/s, '
+                      'p50 {p50_ms}ms, p99 {p99_ms}ms'.format(**results[-1]), file=sys.stderr)
+        finally:
+            transport.close()
+            with app.app_context():
+                db.session.remove()
+                db.engine.dispose()
+    return results
+
+
+def environment(database):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': (database or 'sqlite').split(':', 1)[0],
+    }
+
+
+#  Regression gate
+#  ----------------------------------------------------------------
+
+def compare(results, baseline, tolerance):
+    """The regressions of `results` against the `baseline` results, as messages"""
+    previous = {(item['questions'], item['transport'], item['endpoint']): item for item in baseline}
+    regressions = []
+    for item in results:
+        key = (item['questions'], item['transport'], item['endpoint'])
+        before = previous.get(key)
+        if before is None:
+            continue
+        name = '{} {} {}'.format(*key)
+        if item['p50_ms'] > before['p50_ms'] * (1 + tolerance):
+            regressions.append('{}: p50 {}ms, was {}ms'.format(name, item['p50_ms'], before['p50_ms']))
+        if item['requests_per_second'] < before['requests_per_second'] / (1 + tolerance):
+            regressions.append('{}: {} req/s, was {}'.format(
+                name, item['requests_per_second'], before['requests_per_second']))
+        # statement counts do not vary between runs, any increase is a regression
+        if (item['sql_statements_per_request'] or 0) > (before['sql_statements_per_request'] or 0) + 0.01:
+            regressions.append('{}: {} SQL statements per request, was {}'.format(
+                name, item['sql_statements_per_request'], before['sql_statements_per_request']))
+        if item['errors'] > before['errors']:
+            regressions.append('{}: {} errors, was {}'.format(name, item['errors'], before['errors']))
+    return regressions
+
+
+def parse_config(items):
+    """['KEY=json value', ...] -> {KEY: value}, non JSON values are kept as text"""
+    config = {}
+    for item in items:
+        name, _, value = item.partition('=')
+        try:
+            config[name] = json.loads(value)
+        except ValueError:
+            config[name] = value
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='throughput, latency and SQL statements of every endpoint')
+    parser.add_argument('--sizes', default='10k', help='question bank sizes, e.g. 10k,100k,1M')
+    parser.add_argument('--database', help='database URI, a temporary SQLite file by default')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=1, help='clients sending requests at once')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--transports', default=','.join(TRANSPORTS))
+    parser.add_argument('--config', action='append', default=[], metavar='KEY=VALUE',
+                        help='app setting, e.g. --config QUESTION_SNAPSHOT=true')
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON report to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown against the baseline allowed before failing (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    transports = args.transports.split(',')
+    config = parse_config(args.config)
+    results = []
+    for size in parse_sizes(args.sizes):
+        results.extend(run(size, args.database, config, args.requests, args.concurrency,
+                           args.warmup, transports))
+
+    report = {
+        'environment': environment(args.database),
+        'settings': {'requests': args.requests, 'concurrency': args.concurrency, 'config': config},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file)['results'], args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,92 @@
+import csv
+import logging
+import math
 import os
+import time
 from unicodedata import category
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify, g, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import SQLAlchemyError
 from flask_cors import CORS, cross_origin
-import random
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 #----------------------------------------------------------------------------#
 # Models.
 #----------------------------------------------------------------------------#
 
-from models import setup_db, Question, Category
+from models import (
+    setup_db, database_path, memory_database, listen, setting, boolean, version_counter, pool_stats,
+    read_questions, format_row, Question, Category, CategoryCache)
+from .caching import CACHE_POLICIES, MUTATION_POLICY, make_etag, ResponseCache
+from .quiz import (
+    pick_random_question, quiz_category_id, previous_question_ids, quiz_selection, selection_ids,
+    new_session_state, draw_question, take_current_question, score_answer, MemoryQuizSessionStore)
+from .answers import AnswerCache
+from .adaptive import (
+    DIFFICULTIES, START_DIFFICULTY, DifficultyBuckets, new_adaptive_state, record_answer,
+    draw_adaptive_question, remaining_by_difficulty)
+from .results import LEADERBOARD_SIZE, LEADERBOARD_MAX_AGE, QuizResults, valid_player
+from .stats import STATS_SORTS, QuestionStats, category_stats
+from .metrics import Metrics, PROMETHEUS_CONTENT_TYPE, tracker, log_event, configure_logging
+from .ratelimit import LIMITED_ENDPOINTS, MemoryTokenBuckets, ConcurrencyLimiter, limit_key
+from .replicas import READ_ONLY_ENDPOINTS, STICKY_SECONDS, client_key, StickyWrites
+from .serialization import create_json_provider
+from .snapshot import SNAPSHOT_MAX_AGE, SnapshotStore
+from .search import create_search_backend, load_search_rows, PrefixIndex
+from .bulk import (
+    read_records, known_category_ids, clean_record, import_questions, export_questions, questions_cli,
+    IMPORT_BATCH_SIZE, BATCH_MAX_SIZE)
 
 #  Paginate Method
 #  ----------------------------------------------------------------
 
 QUESTIONS_PER_PAGE = 10
 
-def paginate_questions(request, selection):
+# One page of the questions, of one category when `category_id` is given:
+# the page is cut in SQL with LIMIT/OFFSET so only QUESTIONS_PER_PAGE rows
+# are loaded and formatted per request, and the total is counted in the
+# same statement. Returns (questions, total).
+# `?after_id=<id>` switches to keyset mode (rows with a greater id), which
+# keeps deep pages as cheap as the first one since no rows are skipped.
+# Only the formatted columns are read, see `models.read_questions`.
+def paginate_questions(request, category_id=None):
+    after_id = request.args.get("after_id", None, type=int)
+    if after_id is not None:
+        rows, total = read_questions(category_id, after_id=after_id, limit=QUESTIONS_PER_PAGE)
+        return [format_row(row) for row in rows], total
+
     page = request.args.get("page", 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
+    if page < 1:
+        return [], read_questions(category_id, count_only=True)
+
+    rows, total = read_questions(
+        category_id, offset=(page - 1) * QUESTIONS_PER_PAGE, limit=QUESTIONS_PER_PAGE)
+    return [format_row(row) for row in rows], total
+
+
+# the same over the in-memory question snapshot, optionally for one category
+def paginate_snapshot(request, snapshot, category_id=None):
+    after_id = request.args.get("after_id", None, type=int)
+    if after_id is not None:
+        return snapshot.after(after_id, QUESTIONS_PER_PAGE, category_id)
+
+    page = request.args.get("page", 1, type=int)
+    if page < 1:
+        return [], snapshot.count(category_id)
 
-    return current_questions
+    return snapshot.page((page - 1) * QUESTIONS_PER_PAGE, QUESTIONS_PER_PAGE, category_id)
+
+
+#  Autocomplete
+#  ----------------------------------------------------------------
+
+AUTOCOMPLETE_MAX_RESULTS = 50
+SNIPPET_LENGTH = 80
+
+def snippet(text):
+    if len(text) <= SNIPPET_LENGTH:
+        return text
+    return text[:SNIPPET_LENGTH - 3].rstrip() + '...'
 
 
 def create_app(test_config=None):
@@ -35,10 +97,170 @@ def create_app(test_config=None):
 
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
-    setup_db(app)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    setup_db(app, app.config.get("SQLALCHEMY_DATABASE_URI", database_path))
+    app.json = create_json_provider(app)
+    app.cli.add_command(questions_cli)
+
+    # bumped on every insert, update or delete, the ETags derive from it
+    data_version = version_counter(app, 'data')
+    app.extensions['trivia_data_version'] = data_version
+
+    # serialized responses of the hot read endpoints, see `invalidate_responses`
+    response_cache = ResponseCache(
+        max_entries=app.config.get("RESPONSE_CACHE_MAX_ENTRIES", 1024),
+        max_bytes=app.config.get("RESPONSE_CACHE_MAX_BYTES", 16 * 1024 * 1024),
+        ttl=app.config.get("RESPONSE_CACHE_TTL", 30),
+        version=data_version)
+    listen(app, lambda action, instance: response_cache.written(data_version.bump()))
+
+    # a question change alters every listing total and the search results,
+    # but only the pages of its own category
+    def invalidate_responses(action, instance):
+        if action == 'reset':
+            response_cache.clear()
+        elif action == 'insert_many':
+            response_cache.invalidate('questions', 'search', *{
+                'category:{}'.format(question.category) for question in instance})
+        elif isinstance(instance, Question):
+            category_tag = 'category' if action == 'update' else 'category:{}'.format(instance.category)
+            response_cache.invalidate('questions', 'search', category_tag)
+        elif isinstance(instance, Category):
+            response_cache.invalidate('categories')
+
+    listen(app, invalidate_responses)
+    app.extensions['trivia_response_cache'] = response_cache
+
+    # categories are served from memory until one is created
+    category_cache = CategoryCache(version_counter(app, 'categories'))
+    category_cache.listen(app)
+    app.extensions['trivia_category_cache'] = category_cache
+
+    # quiz sessions live in process memory unless a shared store is configured
+    quiz_sessions = app.config.get("QUIZ_SESSION_STORE") or MemoryQuizSessionStore(
+        ttl=app.config.get("QUIZ_SESSION_TTL", 3600))
+    app.extensions['trivia_quiz_sessions'] = quiz_sessions
+
+    # the normalized answers the guesses are checked against
+    answer_cache = AnswerCache(max_entries=app.config.get("ANSWER_CACHE_MAX_ENTRIES", 100000))
+    answer_cache.listen(app)
+
+    # with QUIZ_HIDE_ANSWERS on (the default), the quiz questions are sent
+    # without their answer: the players answer them through their session,
+    # which reveals it once per question
+    hide_answers = setting(app, 'QUIZ_HIDE_ANSWERS', boolean, True)
+    app.extensions['trivia_hide_answers'] = hide_answers
+
+    def quiz_question(question):
+        if question is None:
+            return None
+        formatted = question.format()
+        if hide_answers:
+            del formatted['answer']
+        # counted by `count_question_stats` once the response is ready
+        g.served_question = question.id
+        return formatted
+
+    # question ids by category and difficulty for the adaptive quizzes
+    difficulty_buckets = DifficultyBuckets(version=data_version)
+    difficulty_buckets.listen(app)
+
+    # the buffered writes below are made by background threads, which do
+    # not see an in-memory SQLite database: there flushing is left to the
+    # caller (the tests)
+    background_writes = not memory_database(app.config["SQLALCHEMY_DATABASE_URI"])
+
+    # quiz results are buffered and written in batches by a background
+    # thread, the leaderboards are served from memory
+    quiz_results = QuizResults(
+        app,
+        batch_size=setting(app, 'QUIZ_RESULTS_BATCH_SIZE', int, 500),
+        interval=setting(app, 'QUIZ_RESULTS_FLUSH_INTERVAL', float, 1.0 if background_writes else 0),
+        capacity=setting(app, 'LEADERBOARD_SIZE', int, LEADERBOARD_SIZE),
+        max_age=setting(app, 'LEADERBOARD_MAX_AGE', float, LEADERBOARD_MAX_AGE))
+    app.extensions['trivia_quiz_results'] = quiz_results
+
+    # how often each question is served and answered right, counted in
+    # memory and added to the question_stats table in batches
+    question_stats = QuestionStats(
+        app,
+        batch_size=setting(app, 'QUESTION_STATS_BATCH_SIZE', int, 500),
+        interval=setting(app, 'QUESTION_STATS_FLUSH_INTERVAL', float, 5.0 if background_writes else 0))
+    question_stats.listen(app)
+    app.extensions['trivia_question_stats'] = question_stats
+
+    # full text search on Postgres, an in-process inverted index otherwise
+    search_backend = create_search_backend(app)
+    app.extensions['trivia_search'] = search_backend
+
+    # with QUESTION_SNAPSHOT on, the question lists and the quizzes are
+    # served from an in-memory copy of the questions table
+    snapshots = None
+    if setting(app, 'QUESTION_SNAPSHOT', boolean, False):
+        snapshots = SnapshotStore(
+            max_age=setting(app, 'QUESTION_SNAPSHOT_MAX_AGE', float, SNAPSHOT_MAX_AGE), version=data_version)
+        snapshots.listen(app)
+    app.extensions['trivia_snapshots'] = snapshots
+
+    # typeahead suggestions come from an in-process prefix index
+    autocomplete_index = PrefixIndex(load_search_rows)
+    autocomplete_index.listen(app)
  
+    # clients that just wrote read from the primary, see `route_reads`
+    # (per worker unless a shared store is configured)
+    sticky_writes = app.config.get("REPLICA_STICKY_STORE") or StickyWrites(
+        app.config.get("REPLICA_STICKY_SECONDS", STICKY_SECONDS))
+    app.extensions['trivia_sticky_writes'] = sticky_writes
+
+    # latency, SQL and response size histograms, see GET /metrics
+    metrics = Metrics() if setting(app, 'METRICS_ENABLED', boolean, True) else None
+    app.extensions['trivia_metrics'] = metrics
+    configure_logging(app, setting(app, 'LOG_LEVEL', str), setting(app, 'LOG_SAMPLE_RATE', float, 1.0))
+
+    # per client token buckets and a cap on the concurrent requests of the
+    # search and quiz endpoints, both off unless configured
+    rate_limit = setting(app, 'RATE_LIMIT_PER_SECOND', float)
+    rate_limit_burst = setting(app, 'RATE_LIMIT_BURST', int, max(int(rate_limit or 1), 1))
+    token_buckets = app.config.get("RATE_LIMIT_STORE") or MemoryTokenBuckets()
+    max_concurrent = setting(app, 'MAX_CONCURRENT_REQUESTS', int)
+    concurrency_limiter = max_concurrent and ConcurrencyLimiter(
+        max_concurrent,
+        setting(app, 'MAX_QUEUED_REQUESTS', int, max_concurrent),
+        setting(app, 'QUEUE_TIMEOUT', float, 1.0))
+    app.extensions['trivia_token_buckets'] = token_buckets if rate_limit else None
+    app.extensions['trivia_concurrency_limiter'] = concurrency_limiter or None
+
+    # behind that many proxies, the client address is read from X-Forwarded-For
+    trusted_proxies = setting(app, 'TRUSTED_PROXIES', int, 0)
+    if trusted_proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies)
+
     # Setting up CORS. Allow '*' for origins.
     CORS(app)
+
+    # registered first so the other hooks (and the 304s) are timed too
+    if metrics:
+        @app.before_request
+        def start_timer():
+            g.request_started = time.perf_counter()
+            tracker.start()
+
+        @app.after_request
+        def record_metrics(response):
+            started = g.pop('request_started', None)
+            if started is not None:
+                statements, sql_seconds = tracker.stop()
+                metrics.observe_request(
+                    request.endpoint or 'unmatched', request.method, response.status_code,
+                    time.perf_counter() - started, statements, sql_seconds,
+                    None if response.is_streamed else response.calculate_content_length())
+            return response
+
+        @app.teardown_request
+        def stop_timer(error=None):
+            g.pop('request_started', None)
+            tracker.stop()
    
     # Setting Access-Control-Allow Using the after_request decorator
     # CORS Headers
@@ -46,8 +268,80 @@ def create_app(test_config=None):
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
         response.headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+
+        # Conditional requests
+        etag = g.pop('etag', None)
+        if etag and response.status_code in (200, 304):
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = CACHE_POLICIES[request.endpoint]
+        elif request.method in ('POST', 'PUT', 'PATCH', 'DELETE'):
+            response.headers['Cache-Control'] = MUTATION_POLICY
+            # the read-only POSTs (searches, quizzes...) do not pin the
+            # client to the primary
+            if response.status_code < 400 and request.endpoint not in READ_ONLY_ENDPOINTS:
+                sticky_writes.record(client_key(request))
         return response
 
+    # 429 once a client's bucket is empty, 503 when too many requests are
+    # running or waiting already
+    @app.before_request
+    def limit_requests():
+        if request.endpoint not in LIMITED_ENDPOINTS:
+            return
+        if rate_limit:
+            wait = token_buckets.take(limit_key(request), rate_limit, rate_limit_burst)
+            if wait:
+                abort(429, retry_after=math.ceil(wait))
+        if concurrency_limiter:
+            if not concurrency_limiter.acquire():
+                abort(503)
+            g.concurrency_slot = True
+
+    @app.teardown_request
+    def release_slot(error=None):
+        if g.pop('concurrency_slot', False):
+            concurrency_limiter.release()
+
+    # counts the question a quiz served, or the answer checked, of the
+    # requests that succeeded
+    @app.after_request
+    def count_question_stats(response):
+        served = g.pop('served_question', None)
+        answered = g.pop('answered_question', None)
+        if response.status_code == 200:
+            if served is not None:
+                question_stats.served(served)
+            if answered is not None:
+                question_stats.answered(*answered)
+        return response
+
+    @app.teardown_request
+    def forget_question_stats(error=None):
+        g.pop('served_question', None)
+        g.pop('answered_question', None)
+
+    # read-only views query a replica, unless the client wrote recently
+    @app.before_request
+    def route_reads():
+        g.use_replica = (request.endpoint in READ_ONLY_ENDPOINTS
+                         and not sticky_writes.is_recent(client_key(request)))
+
+    @app.teardown_request
+    def end_routing(error=None):
+        g.pop('use_replica', None)
+
+    # answers 304 Not Modified when the client already has the current data,
+    # without running the view (no database query, no JSON serialization)
+    @app.before_request
+    def check_etag():
+        if request.method != 'GET' or request.endpoint not in CACHE_POLICIES:
+            return None
+
+        g.etag = make_etag(data_version, request)
+        if request.if_none_match.contains(g.etag):
+            return app.response_class(status=304)
+        return None
+
     #----------------------------------------------------------------------------#
     # Controllers.
     #----------------------------------------------------------------------------#
@@ -59,10 +353,7 @@ def create_app(test_config=None):
     @app.route('/categories')
     def get_categories():
  
-        # sort alphabetically using order_by(Category.type)
-        # instead of order_by(Category.id)
-        categories = Category.query.order_by(Category.type).all()
-        formated_categories = {category.id:category.type for category in categories}
+        formated_categories = category_cache.types()
         return jsonify({
             'success' : True,
             'categories' : formated_categories  
@@ -70,23 +361,23 @@ def create_app(test_config=None):
 
     # an endpoint to get questions based on category.
     @app.route('/categories/<int:category_id>/questions')
+    @response_cache.cached('category', 'category:{category_id}')
     def get_questions_in_category(category_id):
 
-        if category_id >  Category.query.count():
+        categories = category_cache.types()
+        if category_id not in categories:
             abort(404)
            
-        category = Category.format(Category.query.get(category_id))
-        questions = Question.query.filter(
-            Question.category == str(category_id)
-            ).all()
-
-        questions_in_category = paginate_questions(request, questions)
+        if snapshots:
+            questions_in_category, total = paginate_snapshot(request, snapshots.get(), category_id)
+        else:
+            questions_in_category, total = paginate_questions(request, category_id)
         
         return jsonify({
             'success' : True,
             'questions' : questions_in_category,
-            'total_questions' : len(questions),
-            'current_category' : category['type'],
+            'total_questions' : total,
+            'current_category' : categories[category_id],
         })
     
     # an endpoint to create new category
@@ -100,8 +391,7 @@ def create_app(test_config=None):
                 # type = 'new category'
                 # type = data if data != None else 'new categeory'
             )
-            categories = Category.query.order_by(Category.type).all()
-            formated_categories = {category.id:category.type for category in categories}
+            formated_categories = category_cache.types()
 
             if category is None:
                 abort(404)
@@ -122,20 +412,22 @@ def create_app(test_config=None):
 
     # An endpoint to handle GET requests for questions,
     @app.route('/questions', methods=['GET']) 
+    @response_cache.cached('questions', 'categories')
     def get_questions():
-        selection = Question.query.order_by(Question.id).all()
-        current_questions = paginate_questions(request, selection)
+        if snapshots:
+            current_questions, total = paginate_snapshot(request, snapshots.get())
+        else:
+            current_questions, total = paginate_questions(request)
         
         if len(current_questions) == 0:
             abort(404)
 
-        categories = Category.query.order_by(Category.id).all()
-        categories_type = {category.id:category.type for category in categories}
+        categories_type = category_cache.types()
         
         return jsonify({
             'success' : True, 
             'questions' : current_questions, # list of questions
-            'total_questions' : Question.query.count(), # number of total questions
+            'total_questions' : total, # number of total questions
             'current_category' : None,  # current category
             'categories' : categories_type # categories
             })
@@ -144,16 +436,14 @@ def create_app(test_config=None):
     @app.route('/questions/<int:question_id>', methods=["DELETE"])
     def delete_question(question_id):
         try:
-            question = Question.query.filter(Question.id == question_id).one_or_none()
-            print(question)
+            question = Question.query.get(question_id)
+            log_event(app.logger, logging.DEBUG, 'question.delete', id=question_id, found=question is not None)
 
             if question is None:
                 abort(404)
             
             question.delete()
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
-            count = len(selection)
+            count = read_questions(count_only=True)
             # trying to solve this issue (deleting the 11th or 21th or n1th question)
             # recall the same page and not the page before it
             # if count % QUESTIONS_PER_PAGE == 0:
@@ -180,8 +470,7 @@ def create_app(test_config=None):
                 category = request.get_json().get('category', None),
                 difficulty = request.get_json().get('difficulty', None)
             )
-            categories = Category.query.order_by(Category.type).all()
-            formated_categories = {category.id:category.type for category in categories}
+            formated_categories = category_cache.types()
 
             if question is None:
                 abort(404)
@@ -196,24 +485,26 @@ def create_app(test_config=None):
         except:
             abort(422)
 
-    # a POST endpoint to get questions based on a search term
+    # a POST endpoint to get questions based on a search term,
+    # matched against the question and answer text, optionally in one category
     @app.route('/questions/search', methods=["POST"])
+    @response_cache.cached('search')
     def search():
         searchTerm = request.get_json().get('searchTerm', None)
-        print(searchTerm)
+        category = request.get_json().get('category', request.args.get('category'))
+        log_event(app.logger, logging.DEBUG, 'question.search', term=searchTerm, category=category)
         try:
             if searchTerm:
-                results = Question.query.filter(
-                    Question.question.ilike("%{}%".format(searchTerm))
-                    ).all()
-                
-                current_questions = paginate_questions(request, results)
-                # get an issue here, the pagination doesn't work for results questions
-                # it return paginate question not thoses related with the query
+                page = max(request.args.get("page", 1, type=int), 1)
+                results, total = search_backend.search(
+                    searchTerm, category,
+                    offset=(page - 1) * QUESTIONS_PER_PAGE,
+                    limit=QUESTIONS_PER_PAGE)
+
                 return jsonify({
                     'success' : True,
-                    'questions' : current_questions,
-                    'total_questions' :  len(results),
+                    'questions' : [format_row(row) for row in results],
+                    'total_questions' : total,
                     'current_category' : None
                 })
                 
@@ -221,6 +512,128 @@ def create_app(test_config=None):
             abort(422)
 
 
+    # a DELETE endpoint to remove many questions at once, the body is
+    # {"ids": [...]}: one SELECT, one DELETE and one COUNT for the batch
+    @app.route('/questions', methods=["DELETE"])
+    def delete_questions():
+        try:
+            ids = request.get_json().get('ids', None)
+            ids = list(dict.fromkeys(int(id) for id in ids))
+        except Exception:
+            abort(400)
+        if not ids or len(ids) > BATCH_MAX_SIZE:
+            abort(400)
+
+        deleted = {question.id for question in Question.delete_many(ids)}
+
+        return jsonify({
+            'success' : True,
+            'deleted' : [id for id in ids if id in deleted],
+            'not_found' : [id for id in ids if id not in deleted],
+            'total_questions' : read_questions(count_only=True)
+        })
+
+    # a POST endpoint to create many questions at once, the body is
+    # {"questions": [...]}. The valid ones are inserted in one transaction,
+    # `results` tells for each item its created id or its error.
+    @app.route('/questions/batch', methods=["POST"])
+    def create_questions():
+        try:
+            items = request.get_json().get('questions', None)
+            if not isinstance(items, list):
+                raise ValueError(items)
+        except Exception:
+            abort(400)
+        if not items or len(items) > BATCH_MAX_SIZE:
+            abort(400)
+
+        results = []
+        rows = []
+        categories = known_category_ids()
+        for index, item in enumerate(items):
+            try:
+                rows.append(clean_record(item, categories))
+                results.append({'index' : index})
+            except ValueError as error:
+                results.append({'index' : index, 'error' : str(error)})
+
+        try:
+            created = iter(Question.insert_many(rows))
+        except SQLAlchemyError:
+            # e.g. a category deleted meanwhile, nothing was inserted
+            abort(422)
+        for result in results:
+            if 'error' not in result:
+                result['created'] = next(created).id
+
+        return jsonify({
+            'success' : True,
+            'created' : [result['created'] for result in results if 'created' in result],
+            'results' : results,
+            'total_questions' : read_questions(count_only=True)
+        })
+
+    # a POST endpoint to import questions in bulk, the body is streamed as
+    # newline-delimited JSON (default) or CSV (text/csv or ?format=csv)
+    @app.route('/questions/import', methods=["POST"])
+    def import_questions_in_bulk():
+        format = request.args.get('format', 'csv' if request.mimetype == 'text/csv' else 'ndjson')
+        if format not in ('csv', 'ndjson'):
+            abort(400)
+
+        try:
+            result = import_questions(
+                read_records(request.stream, format),
+                app.config.get("IMPORT_BATCH_SIZE", IMPORT_BATCH_SIZE))
+        except (UnicodeDecodeError, csv.Error):
+            abort(400)
+
+        return jsonify(dict(result, success=True))
+
+    # a GET endpoint streaming every question as newline-delimited JSON
+    @app.route('/questions/export')
+    def export_questions_in_bulk():
+        return Response(
+            stream_with_context(export_questions()),
+            mimetype='application/x-ndjson')
+
+    # a GET endpoint for typeahead suggestions while typing a search,
+    # `q` is the text typed so far
+    @app.route('/questions/autocomplete')
+    def autocomplete():
+        limit = min(max(request.args.get('limit', 10, type=int), 1), AUTOCOMPLETE_MAX_RESULTS)
+        suggestions, truncated = autocomplete_index.complete(request.args.get('q', ''), limit)
+
+        return jsonify({
+            'success' : True,
+            'suggestions' : [
+                {'id' : id, 'question' : snippet(question)}
+                for id, question in suggestions
+            ],
+            'truncated' : truncated
+        })
+
+    # a POST endpoint to check a guess to a question, the body is
+    # {"answer": "..."}. Case, accents, punctuation, articles and a typo or
+    # two on longer answers do not count. The answer is only sent back to a
+    # right guess, a session reveals it (see `answer_quiz_question`).
+    @app.route('/questions/<int:question_id>/answer', methods=["POST"])
+    def check_answer(question_id):
+        guess = (request.get_json(silent=True) or {}).get('answer', None)
+        if not isinstance(guess, str):
+            abort(400)
+
+        result = answer_cache.check(question_id, guess)
+        if result is None:
+            abort(404)
+        correct, answer = result
+
+        return jsonify({
+            'success' : True,
+            'correct' : correct,
+            'answer' : answer if correct else None
+        })
+
     #  Quizzes endpoint
     #  ----------------------------------------------------------------
     
@@ -232,47 +645,294 @@ def create_app(test_config=None):
             current_category = category['type']
            
             previous_questions = request.get_json().get('previous_questions', None)
-            print(category)
-            print(previous_questions)
-            questions= {}
+            excluded = previous_question_ids(previous_questions)
+            log_event(app.logger, logging.DEBUG, 'quiz.draw', category=current_category,
+                      previous=previous_questions)
+            if snapshots:
+                category_id = quiz_category_id(category)
+            else:
+                selection = quiz_selection(category)
         
         except Exception:
             abort(400)
         
-        # pick all questions
-        if category['type'] == 'click':
-            query = Question.query.filter(
-                Question.id.notin_((previous_questions))
-                    ).all()
-            questions = paginate_questions(request, query)
-            print('all questions', questions)
-        
+        if snapshots:
+            question = snapshots.get().pick_random(category_id, excluded)
         else:
-            # pick selected category
-            query = Question.query.filter(
-                Question.category == category['id']).filter(
-                    Question.id.notin_((previous_questions))
-                ).all()
-            questions = paginate_questions(request, query)
-            print('questions by category:', questions)
-            
-        if questions:
-            current_question = questions[random.randint(0, len(questions)-1)]
-            print('current questions', current_question)
+            question = pick_random_question(selection, excluded)
             
-        
-        else:
-            print('no question')
+        if question is None:
+            log_event(app.logger, logging.DEBUG, 'quiz.exhausted', category=current_category)
             return jsonify({
                 'success': True,
                 "question": None
                 })
 
+        current_question = quiz_question(question)
+        log_event(app.logger, logging.DEBUG, 'quiz.question', id=current_question['id'])
+
         return jsonify({
             'success': True,
             'question' : current_question
             })
 
+    # a POST endpoint to start a quiz session, the server keeps the
+    # questions left to play so the client only sends its token afterwards
+    @app.route('/quizzes/sessions', methods=["POST"])
+    def start_quiz_session():
+        try:
+            category = request.get_json().get('quiz_category', None)
+            category_id = quiz_category_id(category)
+        except Exception:
+            abort(400)
+
+        if snapshots:
+            ids = snapshots.get().ids_of(category_id)
+        else:
+            ids = selection_ids(quiz_selection(category))
+
+        state = new_session_state(ids, category_id=category_id)
+        token = quiz_sessions.create(state)
+
+        return jsonify({
+            'success': True,
+            'token': token,
+            'total_questions': len(state['deck'])
+            })
+
+    # a POST endpoint to draw the next question of a quiz session
+    @app.route('/quizzes/sessions/<token>/next', methods=["POST"])
+    def next_quiz_question(token):
+        state = quiz_sessions.get(token)
+        if state is None or 'deck' not in state:
+            abort(404)
+
+        question = draw_question(state, snapshots.get().get if snapshots else None)
+        quiz_sessions.save(token, state)
+
+        return jsonify({
+            'success': True,
+            'question': quiz_question(question),
+            'remaining': len(state['deck'])
+            })
+
+    # a POST endpoint to answer the question drawn last in a quiz session or
+    # an adaptive quiz, the body is {"answer": "..."}. Each question drawn is
+    # answered once, the session keeps the score.
+    @app.route('/quizzes/sessions/<token>/answer', methods=["POST"])
+    def answer_quiz_question(token):
+        guess = (request.get_json(silent=True) or {}).get('answer', None)
+        if not isinstance(guess, str):
+            abort(400)
+        state = quiz_sessions.get(token)
+        if state is None:
+            abort(404)
+
+        question_id = take_current_question(state)
+        # nothing drawn, already answered, or deleted since it was drawn
+        result = answer_cache.check(question_id, guess) if question_id is not None else None
+        if result is None:
+            abort(422)
+        correct, answer = result
+        score_answer(state, correct)
+        if state.get('mode') == 'adaptive':
+            record_answer(state, correct)
+            # the `correct` sent with the next draw no longer counts
+            state['last_difficulty'] = None
+        quiz_sessions.save(token, state)
+        g.answered_question = (question_id, correct)
+
+        return jsonify({
+            'success': True,
+            'question': question_id,
+            'correct': correct,
+            'answer': answer,
+            'answered': state['answered'],
+            'score': state['score']
+            })
+
+    # an endpoint to end a quiz session before its deck is empty
+    @app.route('/quizzes/sessions/<token>', methods=["DELETE"])
+    def end_quiz_session(token):
+        if not quiz_sessions.delete(token):
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'deleted': token
+            })
+
+    #  Adaptive quizzes
+    #  ----------------------------------------------------------------
+
+    # a POST endpoint to start an adaptive quiz: the questions get harder
+    # after two right answers in a row and easier after a wrong one.
+    # `difficulty` is the one to start at.
+    @app.route('/quizzes/adaptive', methods=["POST"])
+    def start_adaptive_quiz():
+        try:
+            data = request.get_json()
+            category_id = quiz_category_id(data.get('quiz_category', None))
+            difficulty = int(data.get('difficulty', START_DIFFICULTY))
+        except Exception:
+            abort(400)
+        if difficulty not in DIFFICULTIES:
+            abort(400)
+
+        state = new_adaptive_state(category_id, difficulty)
+        token = quiz_sessions.create(state)
+
+        return jsonify({
+            'success': True,
+            'token': token,
+            'difficulty': difficulty,
+            'remaining': remaining_by_difficulty(state, difficulty_buckets)
+            })
+
+    # a POST endpoint to draw the next question of an adaptive quiz,
+    # `correct` tells whether the previous question was answered right
+    @app.route('/quizzes/adaptive/<token>/next', methods=["POST"])
+    def next_adaptive_question(token):
+        state = quiz_sessions.get(token)
+        if state is None or state.get('mode') != 'adaptive':
+            abort(404)
+        correct = (request.get_json(silent=True) or {}).get('correct', None)
+        if correct is not None and not isinstance(correct, bool):
+            abort(400)
+
+        if correct is not None:
+            record_answer(state, correct)
+        question = draw_adaptive_question(
+            state, difficulty_buckets, snapshots.get().get if snapshots else None)
+        quiz_sessions.save(token, state)
+
+        return jsonify({
+            'success': True,
+            'question': quiz_question(question),
+            'difficulty': state['target'],
+            'remaining': remaining_by_difficulty(state, difficulty_buckets)
+            })
+
+    # an endpoint to count the questions by difficulty, of one category
+    # with ?category=<id>, without querying the database
+    @app.route('/quizzes/difficulties')
+    def get_difficulties():
+        return jsonify({
+            'success': True,
+            'difficulties': difficulty_buckets.counts(request.args.get('category', None, type=int))
+            })
+
+    #  Question stats
+    #  ----------------------------------------------------------------
+
+    # an endpoint to get the stats of the questions of a category: how often
+    # they were served and answered (right), and the difficulty their
+    # success rate suggests. ?sort=hardest (default), easiest or served,
+    # ?min_answered=1 leaves out the questions answered fewer times.
+    @app.route('/categories/<int:category_id>/questions/stats')
+    def get_question_stats(category_id):
+        sort = request.args.get('sort', 'hardest')
+        limit = request.args.get('limit', 10, type=int)
+        min_answered = request.args.get('min_answered', 1, type=int)
+        if sort not in STATS_SORTS or limit < 1 or min_answered < 0:
+            abort(400)
+        if category_id not in category_cache.types():
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'category': category_id,
+            'sort': sort,
+            'questions': category_stats(
+                category_id, question_stats.pending(), sort, min_answered, min(limit, 100))
+            })
+
+    #  Quiz results
+    #  ----------------------------------------------------------------
+
+    # a POST endpoint to record the outcome of a quiz session, the body is
+    # {"player": "...", "token": "..."}. The score is the one the session
+    # kept from the answers it checked, and recording it ends the session.
+    # The result is written later, in a batch, but is on the leaderboard
+    # right away.
+    @app.route('/quizzes/results', methods=["POST"])
+    def record_quiz_result():
+        try:
+            data = request.get_json()
+            player = data['player'].strip()
+            token = data['token']
+        except Exception:
+            abort(400)
+        if not valid_player(player) or not isinstance(token, str):
+            abort(400)
+        state = quiz_sessions.get(token)
+        if state is None:
+            abort(404)
+        category_id = state.get('category_id')
+        if not state.get('answered') or (
+                category_id is not None and category_id not in category_cache.types()):
+            abort(422)
+        # only the request deleting the session records it
+        if not quiz_sessions.delete(token):
+            abort(404)
+
+        quiz_results.add(player, category_id, state['score'], state['answered'])
+
+        return jsonify({
+            'success': True,
+            'score': state['score'],
+            'total': state['answered'],
+            'rank': quiz_results.board().rank(player, category_id)
+            })
+
+    # an endpoint to get the best players, of one category with
+    # ?category=<id>, with their best score
+    @app.route('/leaderboard')
+    def get_leaderboard():
+        category_id = request.args.get('category', None, type=int)
+        limit = min(max(request.args.get('limit', 10, type=int), 1), quiz_results.capacity)
+
+        return jsonify({
+            'success': True,
+            'category': category_id,
+            'leaderboard': [{'rank': rank, 'player': player, 'score': score}
+                            for rank, (player, score)
+                            in enumerate(quiz_results.board().top(category_id, limit), 1)]
+            })
+
+    #  Stats
+    #  ----------------------------------------------------------------
+
+    # an endpoint to follow the response cache hit rate under load
+    @app.route('/stats/cache')
+    def get_cache_stats():
+        return jsonify({
+            'success' : True,
+            'response_cache' : response_cache.stats()
+            })
+
+    # an endpoint to watch the quiz results buffer
+    @app.route('/stats/results')
+    def get_results_stats():
+        return jsonify({
+            'success' : True,
+            'results' : quiz_results.stats()
+            })
+
+    # an endpoint to watch the database connection pool
+    @app.route('/stats/pool')
+    def get_pool_stats():
+        return jsonify({
+            'success' : True,
+            'pool' : pool_stats()
+            })
+
+    # the histograms in the Prometheus text format
+    if metrics:
+        @app.route('/metrics')
+        def get_metrics():
+            return Response(metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
     #----------------------------------------------------------------------------#
     # some error handlers 
     #----------------------------------------------------------------------------#
@@ -328,6 +988,17 @@ def create_app(test_config=None):
             'message' : 'Unprocessable Entity'
         }), 422
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        headers = {}
+        if getattr(error, 'retry_after', None) is not None:
+            headers['Retry-After'] = str(error.retry_after)
+        return jsonify({
+            'success' : False,
+            'error' : 429,
+            'message' : 'Too Many Requests'
+        }), 429, headers
+
     #  on server Side
     #  ----------------------------------------------------------------
     
@@ -0,0 +1,248 @@
+import random
+import threading
+
+from models import db, listen, primary_reads, Question
+from .quiz import new_score
+
+#----------------------------------------------------------------------------#
+# Adaptive difficulty quizzes.
+#
+# The question ids are kept in memory in one bucket per (category,
+# difficulty), so the next question of an adaptive quiz is drawn at the
+# player's target difficulty without querying the questions table, and the
+# bucket sizes are known without a COUNT.
+#----------------------------------------------------------------------------#
+
+DIFFICULTIES = (1, 2, 3, 4, 5)
+START_DIFFICULTY = 3
+
+# correct answers in a row before the target difficulty goes up, one
+# wrong answer brings it down (a 2-up / 1-down staircase)
+UP_STREAK = 2
+
+# random probes into a bucket before falling back to a scan, when the
+# probed questions were already played
+PICK_PROBES = 8
+
+
+class IdBucket(object):
+    """A set of ids with O(1) add, remove and uniform random choice"""
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id):
+        if id not in self.positions:
+            self.positions[id] = len(self.ids)
+            self.ids.append(id)
+
+    # the last id takes the place of the removed one
+    def remove(self, id):
+        position = self.positions.pop(id, None)
+        if position is None:
+            return
+        last = self.ids.pop()
+        if last != id:
+            self.ids[position] = last
+            self.positions[last] = position
+
+    # an id not in `excluded`, None when there is none left
+    def pick(self, excluded=(), rng=random):
+        if not self.ids:
+            return None
+        for _ in range(PICK_PROBES):
+            id = self.ids[rng.randrange(len(self.ids))]
+            if id not in excluded:
+                return id
+        candidates = [id for id in self.ids if id not in excluded]
+        return rng.choice(candidates) if candidates else None
+
+
+# files question `id` in its buckets, `keys` maps the ids to their bucket
+def add_question(buckets, keys, id, category_id, difficulty):
+    if difficulty not in DIFFICULTIES:
+        return
+    keys[id] = (category_id, difficulty)
+    for key in ((category_id, difficulty), (None, difficulty)):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = IdBucket()
+        bucket.add(id)
+
+
+def load_bucket_rows():
+    return db.session.query(
+        Question.id, Question.category_id, Question.difficulty).yield_per(10000)
+
+
+class DifficultyBuckets(object):
+    """
+    The question ids by (category id, difficulty), and by (None, difficulty)
+    for the quizzes over every category. Questions without a difficulty in
+    DIFFICULTIES are left out.
+    Loaded on first use and kept up to date by the commit hooks. A write
+    made by another worker changes `version` (the app's data version), and
+    the buckets are then reloaded on next use, by one request: they are
+    built aside and swapped in whole. A change committed during the load
+    makes the next use load them again.
+    """
+
+    def __init__(self, loader=load_bucket_rows, version=None):
+        self.loader = loader
+        self.version = version
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.buckets = None
+        self.keys = {}
+        self.seen = None
+        self.changes = 0
+        self.stale = False
+
+    def listen(self, app):
+        listen(app, self.on_change)
+
+    def on_change(self, action, instance):
+        with self.lock:
+            self.changes += 1
+            if self.buckets is not None:
+                if action == 'reset':
+                    self.buckets = None
+                elif action == 'insert_many':
+                    for question in instance:
+                        add_question(self.buckets, self.keys, question.id, question.category_id,
+                                     question.difficulty)
+                elif isinstance(instance, Question):
+                    self._remove(instance.id)
+                    if action in ('insert', 'update'):
+                        add_question(self.buckets, self.keys, instance.id, instance.category_id,
+                                     instance.difficulty)
+            self.seen = self._version()
+
+    def _version(self):
+        return None if self.version is None else self.version.get()
+
+    def _remove(self, id):
+        key = self.keys.pop(id, None)
+        if key is not None:
+            self.buckets[key].remove(id)
+            self.buckets[(None, key[1])].remove(id)
+
+    # loads the buckets aside and swaps them in, returns them
+    def load(self):
+        with self.lock:
+            seen, changes = self._version(), self.changes
+        buckets, keys = {}, {}
+        with primary_reads():
+            for id, category_id, difficulty in self.loader():
+                add_question(buckets, keys, id, category_id, difficulty)
+        with self.lock:
+            self.buckets, self.keys, self.seen = buckets, keys, seen
+            self.stale = self.changes != changes
+        return buckets
+
+    def _fresh(self):
+        return self.buckets is not None and not self.stale and self._version() == self.seen
+
+    def _ready(self):
+        if not self._fresh():
+            with self.load_lock:
+                if not self._fresh():
+                    return self.load()
+        return self.buckets
+
+    def bucket(self, category_id, difficulty):
+        return self._ready().get((category_id, difficulty)) or IdBucket()
+
+    # {difficulty: number of questions} of a category, of all of them for None
+    def counts(self, category_id=None):
+        buckets = self._ready()
+        return {difficulty: len(buckets.get((category_id, difficulty), ()))
+                for difficulty in DIFFICULTIES}
+
+    # a question id of the category at `difficulty`, else at the closest
+    # difficulty with questions left (the easier one on a tie). Returns
+    # (id, difficulty), or (None, None) once every question was played.
+    def pick(self, category_id, difficulty, excluded=(), rng=random):
+        buckets = self._ready()
+        # the commit hooks change the buckets in place
+        with self.lock:
+            for candidate in sorted(DIFFICULTIES, key=lambda level: (abs(level - difficulty), level)):
+                bucket = buckets.get((category_id, candidate))
+                id = bucket.pick(excluded, rng) if bucket else None
+                if id is not None:
+                    return id, candidate
+        return None, None
+
+    def difficulty_of(self, id):
+        self._ready()
+        key = self.keys.get(id)
+        return None if key is None else key[1]
+
+    def forget(self, id):
+        with self.lock:
+            if self.buckets is not None:
+                self._remove(id)
+
+
+#  Adaptive sessions
+#  ----------------------------------------------------------------
+
+def new_adaptive_state(category_id, difficulty=START_DIFFICULTY):
+    return dict(
+        new_score(),
+        mode='adaptive',
+        category_id=category_id,
+        target=difficulty,
+        streak=0,
+        played=[],
+        last_difficulty=None,
+    )
+
+
+# the target difficulty after an answer to the last question
+def record_answer(state, correct):
+    if state['last_difficulty'] is None:
+        return
+    if correct:
+        state['streak'] += 1
+        if state['streak'] >= UP_STREAK:
+            state['target'] = min(state['target'] + 1, DIFFICULTIES[-1])
+            state['streak'] = 0
+    else:
+        state['target'] = max(state['target'] - 1, DIFFICULTIES[0])
+        state['streak'] = 0
+
+
+# Draws the next question of an adaptive session. `lookup(id)` loads a
+# question, ids it cannot find (deleted by another worker) are dropped
+# from the buckets and another one is drawn. Returns None once every
+# question of the category was played.
+def draw_adaptive_question(state, buckets, lookup=None, rng=random):
+    lookup = lookup or Question.query.get
+    played = set(state['played'])
+    while True:
+        id, difficulty = buckets.pick(state['category_id'], state['target'], played, rng)
+        if id is None:
+            state['last_difficulty'] = state['current'] = None
+            return None
+        question = lookup(id)
+        if question is not None:
+            state['played'].append(id)
+            state['last_difficulty'] = difficulty
+            state['current'] = id
+            return question
+        buckets.forget(id)
+
+
+# {difficulty: questions not played yet} of a session
+def remaining_by_difficulty(state, buckets):
+    counts = buckets.counts(state['category_id'])
+    for id in state['played']:
+        difficulty = buckets.difficulty_of(id)
+        if difficulty is not None:
+            counts[difficulty] -= 1
+    return counts
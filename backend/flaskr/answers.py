@@ -0,0 +1,159 @@
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from models import db, listen, Question
+
+#----------------------------------------------------------------------------#
+# Answer checking.
+#
+# A guess is compared with the answer once both are normalized (case,
+# accents, punctuation and articles left out), allowing a few typos on
+# longer answers. The normalized answers are cached per question id.
+#----------------------------------------------------------------------------#
+
+ARTICLES = frozenset(('a', 'an', 'the'))
+
+# typos (edits) allowed for a normalized answer of up to so many characters
+TYPOS_BY_LENGTH = ((3, 0), (7, 1))
+MAX_TYPOS = 2
+
+# words a guess may add around the answer's ('it is lake victoria'), more
+# would let a guess list many candidate answers
+MAX_EXTRA_WORDS = 3
+
+
+# runs of characters other than letters and digits separate the words
+SEPARATORS = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    """'The Beatles!' -> 'beatles', 'Café Müller' -> 'cafe muller'"""
+    text = text.casefold()
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+    words = SEPARATORS.sub(' ', text).split()
+    kept = [word for word in words if word not in ARTICLES]
+    # an answer made of articles only ('A') keeps them
+    return ' '.join(kept or words)
+
+
+def allowed_typos(answer):
+    for length, typos in TYPOS_BY_LENGTH:
+        if len(answer) <= length:
+            return typos
+    return MAX_TYPOS
+
+
+def edit_distance(a, b, limit):
+    """
+    The edit distance of `a` and `b` (insertions, deletions, substitutions
+    and swaps of two neighbouring characters), `limit + 1` once it is over
+    `limit`. Only the cells within `limit` of the diagonal are computed.
+    """
+    over = limit + 1
+    if abs(len(a) - len(b)) > limit:
+        return over
+    before = None
+    previous = [min(column, over) for column in range(len(b) + 1)]
+    for row in range(1, len(a) + 1):
+        current = [min(row, over)] + [over] * len(b)
+        char = a[row - 1]
+        best = current[0]
+        for column in range(max(1, row - limit), min(len(b), row + limit) + 1):
+            other = b[column - 1]
+            value = previous[column - 1] + (char != other)
+            if previous[column] + 1 < value:
+                value = previous[column] + 1
+            if current[column - 1] + 1 < value:
+                value = current[column - 1] + 1
+            if (before is not None and column > 1 and char == b[column - 2]
+                    and a[row - 2] == other and before[column - 2] + 1 < value):
+                value = before[column - 2] + 1
+            current[column] = value
+            if value < best:
+                best = value
+        # the distance only grows from one row to the next
+        if best > limit:
+            return over
+        before, previous = previous, current
+    return min(previous[-1], over)
+
+
+def digits(text):
+    return [char for char in text if char.isdigit()]
+
+
+# Whether the normalized `guess` matches the normalized `answer`: equal
+# within the allowed typos, or containing the answer's words with at most
+# MAX_EXTRA_WORDS others (as the frontend used to check, e.g. 'lake
+# victoria in africa'). Numbers must be exact, '1990' is not a typo of '1991'.
+def matches(guess, answer):
+    if guess == answer:
+        return True
+    if ' {} '.format(answer) in ' {} '.format(guess):
+        return guess.count(' ') - answer.count(' ') <= MAX_EXTRA_WORDS
+    typos = allowed_typos(answer)
+    return (typos > 0 and digits(guess) == digits(answer)
+            and edit_distance(guess, answer, typos) <= typos)
+
+
+def load_answer(id):
+    return db.session.query(Question.answer).filter(Question.id == id).scalar()
+
+
+class AnswerCache(object):
+    """
+    (answer, normalized answer) of the questions by id, the least recently
+    used beyond `max_entries` are evicted. `loader(id)` reads an answer,
+    None for an unknown question. Updated and deleted questions are dropped
+    through the commit hooks.
+    """
+
+    def __init__(self, loader=load_answer, max_entries=100000):
+        self.loader = loader
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def listen(self, app):
+        listen(app, self.on_change)
+
+    def on_change(self, action, instance):
+        if action == 'reset':
+            self.clear()
+        elif isinstance(instance, Question) and action in ('update', 'delete'):
+            with self.lock:
+                self.entries.pop(instance.id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # (answer, normalized answer) of question `id`, None when it does not exist
+    def get(self, id):
+        with self.lock:
+            entry = self.entries.get(id)
+            if entry is not None:
+                self.entries.move_to_end(id)
+                return entry
+
+        answer = self.loader(id)
+        if answer is None:
+            return None
+        entry = (answer, normalize(answer))
+        with self.lock:
+            self.entries[id] = entry
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    # (correct, answer) for a guess to question `id`, None for an unknown question
+    def check(self, id, guess):
+        entry = self.get(id)
+        if entry is None:
+            return None
+        answer, normalized = entry
+        return matches(normalize(guess), normalized), answer
@@ -0,0 +1,472 @@
+import json
+import logging
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from urllib.parse import parse_qsl
+
+from asgiref.sync import SyncToAsync
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.http import parse_etags
+
+from models import Question, Category, QUESTION_COLUMNS, category_id, engine_options, setting
+from . import create_app, QUESTIONS_PER_PAGE
+from .caching import CACHE_POLICIES, MUTATION_POLICY, make_etag, cache_key
+from .metrics import log_event
+from .quiz import MAX_EXCLUDED_IN_SQL, previous_question_ids
+from .ratelimit import LIMITED_ENDPOINTS
+from .replicas import client_key
+
+#----------------------------------------------------------------------------#
+# Async serving mode.
+#
+# An ASGI application answering the read-heavy endpoints (GET /categories,
+# GET /questions, GET /categories/<id>/questions, POST /questions/search and
+# POST /quizzes) with an async SQLAlchemy engine, so a worker holds no
+# thread while a query is in flight. Every other request, and every error
+# response, is handed to the Flask app on a pool of threads (see
+# `ThreadedWsgiToAsgi`), so the JSON contract stays the one of `create_app`. So are the searches and quizzes
+# when they are rate limited or capped (see `flaskr.ratelimit`), and every
+# request in snapshot mode, where the Flask app reads from memory.
+# The async views share the Flask app's category and response caches,
+# replica routing, metrics and question stats.
+#
+#     uvicorn --factory flaskr.asgi:create_asgi_app
+#----------------------------------------------------------------------------#
+
+ASYNC_DRIVERS = {
+    'postgresql' : 'postgresql+asyncpg',
+    'sqlite' : 'sqlite+aiosqlite',
+}
+
+
+def create_asgi_app(test_config=None):
+    return AsyncTriviaApp(create_app(test_config))
+
+
+# the async driver URL of the database URI, ASYNC_DATABASE_URI when set
+def async_database_url(app):
+    return async_url(app.config.get('ASYNC_DATABASE_URI') or app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+def async_url(uri):
+    url = make_url(uri)
+    if '+' in url.drivername:
+        return url
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+# an async engine with the pool settings of `models.engine_options`
+def create_engine_for(app, url):
+    options = engine_options(app, url)
+    # asyncio engines use their own (adapted) queue pool
+    options.pop('poolclass', None)
+    connect_args = options.pop('connect_args', None)
+    statement_timeout = setting(app, 'DB_STATEMENT_TIMEOUT', int)
+    if connect_args and statement_timeout:
+        # asyncpg takes the server settings apart
+        options['connect_args'] = {'server_settings': {'statement_timeout': str(statement_timeout)}}
+    return create_async_engine(url, **options)
+
+
+class ThreadedWsgiInstance(WsgiToAsgiInstance):
+    """Runs the WSGI app on `executor` rather than on asgiref's single sync thread"""
+
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.run_wsgi_app = SyncToAsync(
+            partial(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func, self),
+            thread_sensitive=False, executor=executor)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi answering concurrent requests on a pool of threads"""
+
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiInstance(self.wsgi_application, self.executor)(scope, receive, send)
+
+
+class Fallback(Exception):
+    """Raised by an async view to have the Flask app answer the request"""
+
+
+class AsyncRequest(object):
+    """The parts of an ASGI request the async views read"""
+
+    def __init__(self, scope, body):
+        query_string = scope.get('query_string', b'').decode('latin-1')
+        self.method = scope['method']
+        self.path = scope['path']
+        self.full_path = '{}?{}'.format(self.path, query_string)
+        self.args = MultiDict(parse_qsl(query_string, keep_blank_values=True))
+        self.headers = Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                                for name, value in scope.get('headers', ())])
+        self.body = body
+        self.remote_addr = (scope.get('client') or (None,))[0]
+        # SQL run for the request, see CountingConnection
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+    def get_json(self):
+        return json.loads(self.body)
+
+
+class CountingConnection(object):
+    """An async connection counting the statements it runs for `request`"""
+
+    def __init__(self, connection, request):
+        self.connection = connection
+        self.request = request
+
+    async def execute(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await self.connection.execute(*args, **kwargs)
+        finally:
+            self.request.statements += 1
+            self.request.sql_seconds += time.perf_counter() - started
+
+
+class AsyncTriviaApp(object):
+
+    def __init__(self, app, engine=None, replica_engines=None):
+        self.app = app
+        # the requests handed to the Flask app, ASGI_WSGI_THREADS at a time
+        self.executor = ThreadPoolExecutor(setting(app, 'ASGI_WSGI_THREADS', int), 'wsgi')
+        self.wsgi = ThreadedWsgiToAsgi(app, self.executor)
+        self.engine = engine or create_engine_for(app, async_database_url(app))
+        # the read replicas of the Flask app, see `models.RoutingSession`
+        if replica_engines is None:
+            replica_engines = [create_engine_for(app, async_url(app.config['SQLALCHEMY_BINDS'][bind]))
+                               for bind in app.extensions['trivia_replicas']]
+        self.replica_engines = replica_engines
+        self.data_version = app.extensions['trivia_data_version']
+        self.search_backend = app.extensions['trivia_search']
+        self.category_cache = app.extensions['trivia_category_cache']
+        self.response_cache = app.extensions['trivia_response_cache']
+        self.sticky_writes = app.extensions['trivia_sticky_writes']
+        self.metrics = app.extensions['trivia_metrics']
+        self.question_stats = app.extensions['trivia_question_stats']
+        self.hide_answers = app.extensions['trivia_hide_answers']
+        # the rate limit and the concurrency cap are enforced by the Flask
+        # app, the limited endpoints go to it when either one is on
+        self.limited = bool(app.extensions['trivia_token_buckets']
+                            or app.extensions['trivia_concurrency_limiter'])
+        self.routes = [
+            ('GET', re.compile(r'/categories$'), 'get_categories', self.get_categories),
+            ('GET', re.compile(r'/questions$'), 'get_questions', self.get_questions),
+            ('GET', re.compile(r'/categories/(?P<category_id>\d+)/questions$'),
+             'get_questions_in_category', self.get_questions_in_category),
+            ('POST', re.compile(r'/questions/search$'), 'search', self.search),
+            ('POST', re.compile(r'/quizzes$'), 'play_quizz', self.play_quizz),
+        ]
+        if app.extensions['trivia_snapshots']:
+            self.routes = []
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        route = self.match(scope) if scope['type'] == 'http' else None
+        if route is None:
+            return await self.wsgi(scope, receive, send)
+
+        started = time.perf_counter()
+        body = await read_body(receive)
+        request = AsyncRequest(scope, body)
+        endpoint, view, view_args = route
+        try:
+            status, data, etag = await self.dispatch(request, endpoint, view, view_args)
+        except Exception:
+            # Fallback, bad payloads and failed queries alike: the Flask
+            # view answers with its usual (error) response
+            return await self.wsgi(scope, replay(body), send)
+        size = await self.respond(send, request, endpoint, status, data, etag)
+        if self.metrics:
+            self.metrics.observe_request(
+                endpoint, request.method, status, time.perf_counter() - started,
+                request.statements, request.sql_seconds, size)
+
+    def match(self, scope):
+        for method, pattern, endpoint, view in self.routes:
+            if self.limited and endpoint in LIMITED_ENDPOINTS:
+                continue
+            if scope['method'] == method:
+                found = pattern.match(scope['path'])
+                if found:
+                    return endpoint, view, found.groupdict()
+        return None
+
+    # (status, data or serialized body, etag), the bodies of the views the
+    # Flask app caches are cached the same way, in the same cache
+    async def dispatch(self, request, endpoint, view, view_args):
+        etag = None
+        if endpoint in CACHE_POLICIES:
+            etag = make_etag(self.data_version, request)
+            if parse_etags(request.headers.get('If-None-Match')).contains(etag):
+                return 304, None, etag
+
+        tags = getattr(self.app.view_functions[endpoint], 'cache_tags', None)
+        if tags is None:
+            return 200, await view(request, **view_args), etag
+        version = self.response_cache.sync()
+        key = cache_key(request.path, request.args, request.body)
+        body = self.response_cache.get(key)
+        if body is None:
+            body = self.app.json.response(await view(request, **view_args)).get_data()
+            self.response_cache.set(key, body, [tag.format(**view_args) for tag in tags], version)
+        return 200, body, etag
+
+    # the headers `create_app` adds (CORS, ETag and Cache-Control),
+    # returns the size of the body
+    async def respond(self, send, request, endpoint, status, data, etag):
+        if data is None:
+            body, headers = b'', Headers()
+        else:
+            if isinstance(data, bytes):
+                response = self.app.response_class(data, mimetype='application/json')
+            else:
+                response = self.app.json.response(data)
+            body, headers = response.get_data(), Headers(response.headers)
+        headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
+        headers.add('Access-Control-Allow-Methods', 'GET,PUT,POST,DELETE,OPTIONS')
+        if etag:
+            headers['ETag'] = '"{}"'.format(etag)
+            headers['Cache-Control'] = CACHE_POLICIES[endpoint]
+        elif request.method == 'POST':
+            headers['Cache-Control'] = MUTATION_POLICY
+        origin = request.headers.get('Origin')
+        headers['Access-Control-Allow-Origin'] = origin or '*'
+        if origin:
+            headers.add('Vary', 'Origin')
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers.items()],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+        return len(body)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispose(self):
+        for engine in [self.engine] + self.replica_engines:
+            await engine.dispose()
+        self.executor.shutdown(wait=False)
+
+    # a connection to a replica, unless the client wrote recently (every
+    # async view only reads), as `flaskr.route_reads` decides, or `primary`
+    @asynccontextmanager
+    async def connect(self, request, primary=False):
+        engine = self.engine
+        if self.replica_engines and not primary and not self.sticky_writes.is_recent(client_key(request)):
+            engine = random.choice(self.replica_engines)
+        async with engine.connect() as connection:
+            yield CountingConnection(connection, request)
+
+    # {id: type} from the Flask app's category cache, filled on a miss
+    async def categories(self, request, connection=None):
+        items = self.category_cache.current()
+        if items is None:
+            version = self.category_cache.version.get()
+            # from the primary, as `models.CategoryCache.items`
+            if connection is None or self.replica_engines:
+                async with self.connect(request, primary=True) as connection:
+                    items = await fetch_categories(connection)
+            else:
+                items = await fetch_categories(connection)
+            self.category_cache.store(version, items)
+        return dict(items)
+
+    #  Views
+    #  ----------------------------------------------------------------
+
+    async def get_categories(self, request):
+        return {
+            'success' : True,
+            'categories' : await self.categories(request)
+        }
+
+    async def get_questions(self, request):
+        async with self.connect(request) as connection:
+            questions, total = await paginate_questions(connection, request, select(*QUESTION_COLUMNS))
+            if not questions:
+                raise Fallback()
+            categories = await self.categories(request, connection)
+        return {
+            'success' : True,
+            'questions' : questions,
+            'total_questions' : total,
+            'current_category' : None,
+            'categories' : categories
+        }
+
+    async def get_questions_in_category(self, request, category_id):
+        category_id = int(category_id)
+        async with self.connect(request) as connection:
+            categories = await self.categories(request, connection)
+            if category_id not in categories:
+                raise Fallback()
+            questions, total = await paginate_questions(connection, request, select(
+                *QUESTION_COLUMNS).where(Question.category_id == category_id))
+        return {
+            'success' : True,
+            'questions' : questions,
+            'total_questions' : total,
+            'current_category' : categories[category_id],
+        }
+
+    # the in-process search indexes have no async counterpart, their
+    # searches go to the Flask view
+    async def search(self, request):
+        clauses = getattr(self.search_backend, 'clauses', None)
+        data = request.get_json()
+        term = data.get('searchTerm', None)
+        category = data.get('category', request.args.get('category'))
+        if clauses is None or not term:
+            raise Fallback()
+
+        questions, total = [], 0
+        clauses = clauses(term)
+        if clauses is not None:
+            condition, ordering = clauses
+            selection = select(*QUESTION_COLUMNS).where(condition)
+            if category is not None:
+                selection = selection.where(Question.category_id == category_id(category))
+            page = max(request.args.get('page', 1, type=int), 1)
+            async with self.connect(request) as connection:
+                questions, total = await page_with_total(
+                    connection, selection.order_by(*ordering),
+                    (page - 1) * QUESTIONS_PER_PAGE, QUESTIONS_PER_PAGE)
+        return {
+            'success' : True,
+            'questions' : questions,
+            'total_questions' : total,
+            'current_category' : None
+        }
+
+    # same draw as `quiz.pick_random_question`: COUNT, then one row at a
+    # random OFFSET
+    async def play_quizz(self, request):
+        data = request.get_json()
+        category = data.get('quiz_category', None)
+        previous_questions = data.get('previous_questions', None)
+        excluded = previous_question_ids(previous_questions)
+        if len(excluded) > MAX_EXCLUDED_IN_SQL:
+            raise Fallback()
+        log_event(self.app.logger, logging.DEBUG, 'quiz.draw', category=category['type'],
+                  previous=previous_questions)
+
+        selection = select(*QUESTION_COLUMNS)
+        if category['type'] != 'click':
+            selection = selection.where(Question.category_id == int(category['id']))
+        if excluded:
+            selection = selection.where(Question.id.notin_(excluded))
+
+        question = None
+        async with self.connect(request) as connection:
+            total = await count(connection, selection)
+            if total:
+                row = (await connection.execute(selection.order_by(Question.id).offset(
+                    random.randrange(total)).limit(1))).first()
+                question = row and row._asdict()
+        if question is None:
+            log_event(self.app.logger, logging.DEBUG, 'quiz.exhausted', category=category['type'])
+        else:
+            log_event(self.app.logger, logging.DEBUG, 'quiz.question', id=question['id'])
+            self.question_stats.served(question['id'])
+            if self.hide_answers:
+                del question['answer']
+        return {
+            'success': True,
+            'question' : question
+        }
+
+
+#  Queries
+#  ----------------------------------------------------------------
+
+# [(id, type)] sorted by type, as `models.CategoryCache.items`
+async def fetch_categories(connection):
+    result = await connection.execute(
+        select(Category.id, Category.type).order_by(Category.type))
+    return [tuple(row) for row in result]
+
+
+async def count(connection, selection):
+    result = await connection.execute(
+        select(func.count()).select_from(selection.order_by(None).subquery()))
+    return result.scalar()
+
+
+# async `models.page_with_total` over a select of QUESTION_COLUMNS,
+# returns the page as dicts
+async def page_with_total(connection, selection, offset, limit):
+    result = await connection.execute(
+        selection.add_columns(func.count().over().label('total')).offset(offset).limit(limit))
+    rows = result.all()
+    if not rows:
+        return [], await count(connection, selection)
+    return [dict(zip(row._fields[:-1], row[:-1])) for row in rows], rows[0].total
+
+
+# `flaskr.paginate_questions`: ?page=<n>, or keyset mode with ?after_id=<id>
+async def paginate_questions(connection, request, selection):
+    after_id = request.args.get('after_id', None, type=int)
+    selection = selection.order_by(Question.id)
+
+    if after_id is not None:
+        result = await connection.execute(
+            selection.where(Question.id > after_id).limit(QUESTIONS_PER_PAGE))
+        return [row._asdict() for row in result], await count(connection, selection)
+
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        return [], await count(connection, selection)
+
+    return await page_with_total(
+        connection, selection, (page - 1) * QUESTIONS_PER_PAGE, QUESTIONS_PER_PAGE)
+
+
+#  ASGI plumbing
+#  ----------------------------------------------------------------
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+# a `receive` handing the already read body to the Flask app
+def replay(body):
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        return {'type': 'http.disconnect'}
+    return receive
@@ -0,0 +1,183 @@
+import codecs
+import csv
+import json
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, notify, category_id, Category, Question
+
+#----------------------------------------------------------------------------#
+# Bulk question import and export.
+#
+# Imports are streamed: records are read one at a time and written with a
+# single executemany INSERT and one commit per batch, so memory stays flat
+# whatever the size of the file. Exports stream rows with yield_per.
+#----------------------------------------------------------------------------#
+
+IMPORT_BATCH_SIZE = 1000
+# questions per POST /questions/batch or DELETE /questions request
+BATCH_MAX_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+# errors reported back in detail, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+EXPORT_COLUMNS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+
+#  Reading
+#  ----------------------------------------------------------------
+
+# yields (line number, record) for newline-delimited JSON, blank lines
+# are skipped and a line that isn't a JSON object gives a None record
+def read_ndjson(lines):
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else None
+
+
+# yields (line number, record) for CSV with a header row
+def read_csv(lines):
+    reader = csv.DictReader(lines)
+    for record in reader:
+        yield reader.line_num, record
+
+
+def read_records(stream, format):
+    lines = codecs.getreader('utf-8')(stream)
+    if format == 'csv':
+        return read_csv(lines)
+    return read_ndjson(lines)
+
+
+# the ids of the categories the records may refer to
+def known_category_ids():
+    return {id for (id,) in db.session.query(Category.id)}
+
+
+# the row to insert for one record, ValueError when it isn't a valid question
+# or, given the `categories` ids, when its category doesn't exist
+def clean_record(record, categories=None):
+    if not isinstance(record, dict):
+        raise ValueError('not a JSON object')
+
+    question = record.get('question') or ''
+    answer = record.get('answer') or ''
+    if not isinstance(question, str) or not isinstance(answer, str):
+        raise ValueError('question and answer must be strings')
+    question, answer = question.strip(), answer.strip()
+    if not question or not answer:
+        raise ValueError('question and answer are required')
+
+    category = record.get('category')
+    if category is not None and not isinstance(category, (str, int)):
+        raise ValueError('category must be a string or an integer')
+    difficulty = record.get('difficulty')
+    try:
+        difficulty = int(difficulty) if difficulty not in (None, '') else None
+    except (TypeError, ValueError):
+        raise ValueError('difficulty must be an integer')
+
+    id = category_id(category)
+    if categories is not None and id is not None and id not in categories:
+        raise ValueError('unknown category')
+
+    return {
+        'question': question,
+        'answer': answer,
+        'category': None if category in (None, '') else str(category),
+        'category_id': id,
+        'difficulty': difficulty,
+    }
+
+
+#  Import / Export
+#  ----------------------------------------------------------------
+
+def import_questions(records, batch_size=IMPORT_BATCH_SIZE):
+    result = {'imported': 0, 'batches': 0, 'error_count': 0, 'errors': []}
+    categories = known_category_ids()
+    batch = []
+    lines = []
+
+    def report(line, message):
+        result['error_count'] += 1
+        if len(result['errors']) < MAX_REPORTED_ERRORS:
+            result['errors'].append({'line': line, 'message': message})
+
+    def flush():
+        try:
+            db.session.execute(Question.__table__.insert(), batch)
+            db.session.commit()
+        except SQLAlchemyError:
+            # e.g. a category deleted meanwhile: the batch is left out and
+            # reported, the import goes on with the next one
+            db.session.rollback()
+            for line in lines:
+                report(line, 'refused by the database')
+        else:
+            result['imported'] += len(batch)
+            result['batches'] += 1
+        batch.clear()
+        lines.clear()
+
+    try:
+        for line, record in records:
+            try:
+                batch.append(clean_record(record, categories))
+            except ValueError as error:
+                report(line, str(error))
+                continue
+            lines.append(line)
+            if len(batch) >= batch_size:
+                flush()
+
+        if batch:
+            flush()
+    finally:
+        # rows written without the ORM: in-memory indexes and caches start
+        # over, once for the whole import
+        if result['batches']:
+            notify('reset', None)
+    return result
+
+
+# yields the questions as NDJSON lines, ordered by id
+def export_questions(batch_size=EXPORT_BATCH_SIZE):
+    columns = [getattr(Question, column) for column in EXPORT_COLUMNS]
+    for row in db.session.query(*columns).order_by(Question.id).yield_per(batch_size):
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n'
+
+
+#  CLI
+#  ----------------------------------------------------------------
+
+questions_cli = AppGroup('questions', help='Bulk import and export of questions.')
+
+
+@questions_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True)
+def import_command(path, batch_size):
+    """Import questions from a .ndjson or .csv file."""
+    format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    with open(path, 'rb') as stream:
+        result = import_questions(read_records(stream, format), batch_size)
+
+    click.echo('imported {imported} questions in {batches} batches, {error_count} errors'.format(**result))
+    for error in result['errors']:
+        click.echo('line {line}: {message}'.format(**error), err=True)
+
+
+@questions_cli.command('export')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+def export_command(path):
+    """Export every question to a .ndjson file."""
+    with open(path, 'w', encoding='utf-8') as output:
+        output.writelines(export_questions())
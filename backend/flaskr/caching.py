@@ -0,0 +1,184 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, make_response, request
+
+#----------------------------------------------------------------------------#
+# HTTP caching.
+#----------------------------------------------------------------------------#
+
+# Cache-Control of the GET endpoints answered with an ETag. Categories
+# barely change, questions are revalidated on every poll (a 304 is cheap).
+CACHE_POLICIES = {
+    'get_categories' : 'public, max-age=60',
+    'get_questions' : 'no-cache',
+    'get_questions_in_category' : 'no-cache',
+}
+
+# responses that change data must never be stored
+MUTATION_POLICY = 'no-store'
+
+
+# The ETag only depends on the data version and the requested URL, so a
+# matching If-None-Match can be answered before touching the database.
+def make_etag(version, request):
+    key = '{}:{}:{}'.format(version.epoch, version.get(), request.full_path)
+    return hashlib.sha1(key.encode()).hexdigest()[:24]
+
+
+#  Response cache
+#  ----------------------------------------------------------------
+
+# the key of a response: path, query string and request body
+def cache_key(path, args, body):
+    return (path, tuple(sorted(args.items(multi=True))), body)
+
+
+class ResponseCache(object):
+    """
+    In-process cache of serialized JSON responses, keyed by path, query
+    string and request body. Entries expire after `ttl` seconds, the least
+    recently used ones are evicted beyond `max_entries` or `max_bytes`.
+    Each entry carries tags so a write only drops the responses it affects.
+    Entries also carry the data `version` read before their view ran
+    (see `sync`). The writes of this worker come through `written` and the
+    tags; a version this worker did not write (another worker's, through
+    a shared CACHE_STORE) drops every entry stored before it, and a body
+    whose view ran while a write committed is not stored.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024, ttl=30, clock=time.monotonic,
+                 version=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.version = version
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        # the last version whose writes the entries reflect, and the oldest
+        # version an entry may be stored at
+        self.synced = self.floor = version.get() if version else 0
+        self.counters = dict.fromkeys(
+            ('hits', 'misses', 'evictions', 'expirations', 'invalidations'), 0)
+
+    # the current data version, to pass to `set`. Entries stored before a
+    # version this worker did not write are stale from now on.
+    def sync(self):
+        if self.version is None:
+            return None
+        current = self.version.get()
+        with self.lock:
+            if current < self.synced:
+                # the shared counter was reset
+                self._clear()
+                self.synced = self.floor = current
+            elif current > self.synced:
+                self.synced = self.floor = current
+        return current
+
+    # `version` was written by this worker, its commit hook drops the
+    # entries it affects by tag. A gap is another worker's write.
+    def written(self, version):
+        with self.lock:
+            if version != self.synced + 1:
+                self.floor = max(self.floor, version - 1)
+            self.synced = max(self.synced, version)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                self._remove(key)
+                self.counters['expirations'] += 1
+                entry = None
+            elif entry is not None and entry[3] < self.floor:
+                self._remove(key)
+                self.counters['invalidations'] += 1
+                entry = None
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return entry[1]
+
+    # stores `body`, unless a write was seen since `version` (from `sync`)
+    def set(self, key, body, tags=(), version=None):
+        if len(body) > self.max_bytes or self.max_entries < 1:
+            return
+        with self.lock:
+            if version is None:
+                version = self.synced
+            elif version != self.synced:
+                return
+            self._remove(key)
+            self.entries[key] = (self.clock() + self.ttl, body, tuple(tags), version)
+            self.size += len(body)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    # drops every response carrying one of `tags`
+    def invalidate(self, *tags):
+        with self.lock:
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self._remove(key)
+                    self.counters['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def _clear(self):
+        self.counters['invalidations'] += len(self.entries)
+        self.entries.clear()
+        self.tags.clear()
+        self.size = 0
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(entries=len(self.entries), bytes=self.size)
+            return stats
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[1])
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+    # Decorates a view so its successful responses are served from the
+    # cache. `tags` are formatted with the view arguments, e.g.
+    # 'category:{category_id}'. They are kept on the view as `cache_tags`
+    # for the async app (see `flaskr.asgi`).
+    def cached(self, *tags):
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                version = self.sync()
+                key = cache_key(request.path, request.args, request.get_data())
+                body = self.get(key)
+                if body is not None:
+                    return current_app.response_class(body, mimetype='application/json')
+
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200:
+                    self.set(key, response.get_data(), [tag.format(**kwargs) for tag in tags], version)
+                return response
+            wrapper.cache_tags = tags
+            return wrapper
+        return decorator
@@ -0,0 +1,209 @@
+import bisect
+import logging
+import random
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#----------------------------------------------------------------------------#
+# Instrumentation.
+#
+# Per route latency, SQL statements and response size histograms, served
+# at GET /metrics in the Prometheus text format, and the structured,
+# sampled log events of the views.
+#----------------------------------------------------------------------------#
+
+# upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    """
+    A Prometheus histogram: the number of observations per bucket, their
+    sum and count, for each set of label values
+    """
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    # (bucket counts, sum, count) of one set of label values
+    def get(self, *label_values):
+        with self.lock:
+            counts, total, count = self.series.get(label_values, ([0] * (len(self.buckets) + 1), 0, 0))
+            return list(counts), total, count
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            series = sorted((values, list(counts), total, count)
+                            for values, (counts, total, count) in self.series.items())
+        for values, counts, total, count in series:
+            labels = list(zip(self.labels, values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(labels + [('le', format_value(bound))]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(labels), count))
+        return lines
+
+
+def format_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace(
+        '"', r'\"').replace('\n', r'\n')) for name, value in labels) + '}'
+
+
+class Metrics(object):
+    """The histograms recorded for every request answered by the Flask app"""
+
+    def __init__(self):
+        self.latency = Histogram(
+            'trivia_request_duration_seconds', 'Time spent answering a request.',
+            ('endpoint', 'method', 'status'), LATENCY_BUCKETS)
+        self.statements = Histogram(
+            'trivia_request_sql_statements', 'SQL statements run per request.',
+            ('endpoint',), STATEMENT_BUCKETS)
+        self.sql_time = Histogram(
+            'trivia_request_sql_duration_seconds', 'Time spent in SQL statements per request.',
+            ('endpoint',), LATENCY_BUCKETS)
+        self.response_size = Histogram(
+            'trivia_response_size_bytes', 'Size of the response bodies.',
+            ('endpoint',), SIZE_BUCKETS)
+
+    def observe_request(self, endpoint, method, status, seconds, statements, sql_seconds, size):
+        self.latency.observe(seconds, endpoint, method, str(status))
+        self.statements.observe(statements, endpoint)
+        self.sql_time.observe(sql_seconds, endpoint)
+        # streamed responses have no size until they are sent
+        if size is not None:
+            self.response_size.observe(size, endpoint)
+
+    def render(self):
+        lines = []
+        for histogram in (self.latency, self.statements, self.sql_time, self.response_size):
+            lines.extend(histogram.render())
+        return '\n'.join(lines) + '\n'
+
+
+#  SQL statements
+#  ----------------------------------------------------------------
+
+class RequestTracker(threading.local):
+    """Counts the SQL statements run by the request being answered on this thread"""
+
+    def __init__(self):
+        self.active = False
+        self.statements = 0
+        self.seconds = 0.0
+        self.started = None
+
+    def start(self):
+        self.active, self.statements, self.seconds = True, 0, 0.0
+
+    # (statements, seconds) since `start`
+    def stop(self):
+        self.active = False
+        return self.statements, self.seconds
+
+
+tracker = RequestTracker()
+
+
+# Listening on the Engine class covers the primary, the replicas and the
+# engines of every app. Outside of a request it only reads `active`.
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if tracker.active:
+        tracker.started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if tracker.active and tracker.started is not None:
+        tracker.statements += 1
+        tracker.seconds += time.perf_counter() - tracker.started
+        tracker.started = None
+
+
+#  Logging
+#  ----------------------------------------------------------------
+
+class SamplingFilter(logging.Filter):
+    """Keeps a `rate` share of the records under WARNING, and every other one"""
+
+    def __init__(self, rate, rng=random.random):
+        super().__init__()
+        self.rate = rate
+        self.rng = rng
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rng() < self.rate
+
+
+class Fields(object):
+    """The key=value text of a log event, only built when the record is written"""
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join('{}={}'.format(name, quote(value)) for name, value in self.fields.items())
+
+
+def quote(value):
+    text = str(value)
+    if not text or any(char in text for char in ' ="\n'):
+        return '"{}"'.format(text.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+    return text
+
+
+# Logs `event` with its fields as "event key=value ...". The record also
+# carries `event` and `fields` for formatters writing JSON. Costs a level
+# check when the level is disabled.
+def log_event(logger, level, event, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, '%s %s', event, Fields(fields), extra={'event': event, 'fields': fields})
+
+
+# LOG_LEVEL sets the level of the app logger, LOG_SAMPLE_RATE the share
+# of its records under WARNING that are written
+def configure_logging(app, level=None, sample_rate=1.0):
+    if level is not None:
+        app.logger.setLevel(level.upper() if isinstance(level, str) else level)
+    # the logger is shared by every app of the process
+    for existing in [f for f in app.logger.filters if isinstance(f, SamplingFilter)]:
+        app.logger.removeFilter(existing)
+    if sample_rate < 1:
+        app.logger.addFilter(SamplingFilter(sample_rate))
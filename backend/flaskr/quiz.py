@@ -0,0 +1,257 @@
+import json
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from models import Question
+
+#----------------------------------------------------------------------------#
+# Quiz question selection.
+#----------------------------------------------------------------------------#
+
+# exclusion lists longer than this are filtered in Python on the id column
+# rather than sent to the database as one huge NOT IN (...) clause
+MAX_EXCLUDED_IN_SQL = 500
+
+
+# the category id of the `quiz_category` payload sent by the frontend,
+# None for type 'click' which stands for all categories
+def quiz_category_id(category):
+    if category['type'] == 'click':
+        return None
+    return int(category['id'])
+
+
+# the ids of the `previous_questions` payload, ValueError unless it is a
+# list of integers (or null)
+def previous_question_ids(previous_questions):
+    if previous_questions is None:
+        return set()
+    if not isinstance(previous_questions, list) or not all(type(id) is int for id in previous_questions):
+        raise ValueError(previous_questions)
+    return set(previous_questions)
+
+
+# the questions a quiz draws from
+def quiz_selection(category):
+    category_id = quiz_category_id(category)
+    if category_id is None:
+        return Question.query
+
+    return Question.query.filter(Question.category_id == category_id)
+
+
+# Picks one question of `selection` (a Question query) uniformly at random,
+# skipping the ids in `previous_questions`. Returns None once every
+# candidate has been played.
+#
+# The database does the work: COUNT the candidates, then fetch the single
+# row at a random OFFSET, so only one Question is ever loaded.
+def pick_random_question(selection, previous_questions=None, rng=random):
+    excluded = set(previous_questions or ())
+
+    if len(excluded) > MAX_EXCLUDED_IN_SQL:
+        return _pick_from_ids(selection, excluded, rng)
+
+    if excluded:
+        selection = selection.filter(Question.id.notin_(excluded))
+
+    total = selection.count()
+    if total == 0:
+        return None
+
+    return selection.order_by(Question.id).offset(rng.randrange(total)).first()
+
+
+# only the id column is read, so this stays cheap even for big categories
+def _pick_from_ids(selection, excluded, rng):
+    candidates = [id for (id,) in selection.with_entities(Question.id) if id not in excluded]
+    if not candidates:
+        return None
+
+    return Question.query.get(rng.choice(candidates))
+
+
+#  Quiz sessions
+#  ----------------------------------------------------------------
+
+# the ids of a Question query, only the id column is read
+def selection_ids(selection):
+    return [id for (id,) in selection.with_entities(Question.id)]
+
+
+# A session holds a pre-shuffled deck of question ids, so drawing the next
+# question is a pop() plus a primary key lookup whatever the round. The
+# score is kept with it, from the answers checked by the server.
+def new_session_state(ids, rng=random, category_id=None):
+    deck = list(ids)
+    rng.shuffle(deck)
+    return dict(new_score(), deck=deck, category_id=category_id)
+
+
+# the score of a session: the question drawn last, waiting for its answer,
+# and the questions answered (right)
+def new_score():
+    return {'current': None, 'answered': 0, 'score': 0}
+
+
+# the next id of a deck (a list, or a `SharedDeck`), None once it is empty
+def pop_id(deck):
+    if isinstance(deck, list):
+        return deck.pop() if deck else None
+    return deck.pop()
+
+
+# Pops ids off the session deck until one still exists (questions may have
+# been deleted since the session started). Returns None when the deck is empty.
+# `lookup(id)` loads a question, Question.query.get by default.
+def draw_question(state, lookup=None):
+    lookup = lookup or Question.query.get
+    deck = state['deck']
+    state['current'] = None
+    while True:
+        id = pop_id(deck)
+        if id is None:
+            return None
+        question = lookup(id)
+        if question is not None:
+            state['current'] = question.id
+            return question
+
+
+# The id of the question waiting for an answer, which is then no longer
+# waiting: each question drawn is answered once. None when there is none.
+def take_current_question(state):
+    id = state.get('current')
+    state['current'] = None
+    return id
+
+
+def score_answer(state, correct):
+    state['answered'] = state.get('answered', 0) + 1
+    state['score'] = state.get('score', 0) + int(correct)
+
+
+class MemoryQuizSessionStore(object):
+    """
+    Keeps quiz session states in process memory.
+    Sessions expire `ttl` seconds after their last use, and the least
+    recently used ones are evicted beyond `max_sessions`.
+    """
+
+    def __init__(self, ttl=3600, max_sessions=10000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def create(self, state):
+        token = secrets.token_urlsafe(16)
+        self.save(token, state)
+        return token
+
+    def get(self, token):
+        with self.lock:
+            self._evict()
+            entry = self.sessions.get(token)
+            if entry is None:
+                return None
+            self.sessions.move_to_end(token)
+            entry[0] = self.clock() + self.ttl
+            return entry[1]
+
+    def save(self, token, state):
+        with self.lock:
+            self.sessions[token] = [self.clock() + self.ttl, state]
+            self.sessions.move_to_end(token)
+            self._evict()
+
+    def delete(self, token):
+        with self.lock:
+            return self.sessions.pop(token, None) is not None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    # entries are kept in last-use order, so expired ones sit at the front
+    def _evict(self):
+        now = self.clock()
+        while self.sessions:
+            token, (expires_at, _) = next(iter(self.sessions.items()))
+            if expires_at > now and len(self.sessions) <= self.max_sessions:
+                break
+            del self.sessions[token]
+
+
+class SharedDeck(object):
+    """
+    The deck of a session kept in a shared store, as a list at `key`: a
+    draw pops one id off it, the rest of the deck is not read.
+    """
+
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+
+    def pop(self):
+        id = self.client.rpop(self.key)
+        return None if id is None else int(id)
+
+    def __len__(self):
+        return self.client.llen(self.key)
+
+
+class SharedQuizSessionStore(object):
+    """
+    Keeps quiz session states in a shared key/value store, so every worker
+    sees the same sessions. `client` is anything with the redis-py
+    get / set(ex=) / delete / expire and rpush / rpop / llen methods, the
+    store's own expiry does the eviction. The deck of a session is a list
+    of its own (see `SharedDeck`), the rest of the state one JSON value.
+    """
+
+    # ids per RPUSH when a deck is stored
+    push_size = 10000
+
+    def __init__(self, client, ttl=3600, prefix='trivia:quiz:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def create(self, state):
+        token = secrets.token_urlsafe(16)
+        self.save(token, state)
+        return token
+
+    def get(self, token):
+        value = self.client.get(self.prefix + token)
+        if value is None:
+            return None
+        state = json.loads(value)
+        if 'deck' in state:
+            state['deck'] = SharedDeck(self.client, self._deck_key(token))
+        return state
+
+    def save(self, token, state):
+        deck = state.get('deck')
+        if isinstance(deck, list):
+            self._store_deck(token, deck)
+        if 'deck' in state:
+            state = dict(state, deck=None)
+            self.client.expire(self._deck_key(token), self.ttl)
+        self.client.set(self.prefix + token, json.dumps(state), ex=self.ttl)
+
+    def delete(self, token):
+        return bool(self.client.delete(self.prefix + token, self._deck_key(token)))
+
+    def _deck_key(self, token):
+        return self.prefix + token + ':deck'
+
+    def _store_deck(self, token, deck):
+        key = self._deck_key(token)
+        self.client.delete(key)
+        for start in range(0, len(deck), self.push_size):
+            self.client.rpush(key, *deck[start:start + self.push_size])
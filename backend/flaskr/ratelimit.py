@@ -0,0 +1,141 @@
+import math
+import threading
+import time
+
+#----------------------------------------------------------------------------#
+# Rate limiting and load shedding.
+#
+# The search and quiz endpoints are the most expensive ones: each client
+# gets a token bucket of requests on them, and the number of them running
+# at once in a worker is capped, with a short queue in front.
+#----------------------------------------------------------------------------#
+
+LIMITED_ENDPOINTS = frozenset((
+    'search',
+    'play_quizz',
+    'start_quiz_session',
+    'next_quiz_question',
+    'answer_quiz_question',
+    'start_adaptive_quiz',
+    'next_adaptive_question',
+    'record_quiz_result',
+))
+
+
+# The client a bucket belongs to: its address, which a client cannot pick
+# the way it picks X-Client-Id (see `replicas.client_key`). Behind proxies,
+# TRUSTED_PROXIES has it read from X-Forwarded-For.
+def limit_key(request):
+    return request.remote_addr
+
+
+class MemoryTokenBuckets(object):
+    """
+    Token buckets kept in process memory: each client has up to `burst`
+    tokens, refilled at `rate` per second, and a request takes one.
+    """
+
+    # full (idle) buckets are swept once the table grows past this
+    sweep_size = 10000
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    # 0 when the request may go on, else the seconds before a token is back
+    def take(self, key, rate, burst):
+        with self.lock:
+            now = self.clock()
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                wait = 0
+            else:
+                self.buckets[key] = (tokens, now)
+                wait = (1 - tokens) / rate
+            if len(self.buckets) > self.sweep_size:
+                self.sweep(now, rate, burst)
+            return wait
+
+    def sweep(self, now, rate, burst):
+        self.buckets = {key: (tokens, updated) for key, (tokens, updated) in self.buckets.items()
+                        if tokens + (now - updated) * rate < burst}
+
+
+class SharedTokenBuckets(object):
+    """
+    The same buckets kept in a shared key/value store, so the limit holds
+    across workers. `client` is anything with the redis-py get / set(ex=) /
+    incr / expire methods.
+    Each client has a single counter, the time (in milliseconds) at which
+    its bucket will be full again, moved forward by INCR so concurrent
+    requests are counted atomically. A bucket left idle starts over from
+    the current time. Two racing requests can both restart it, letting an
+    extra request through.
+    """
+
+    def __init__(self, client, prefix='trivia:ratelimit:', clock=time.time):
+        self.client = client
+        self.prefix = prefix
+        self.clock = clock
+
+    def take(self, key, rate, burst):
+        key = self.prefix + key
+        now = int(self.clock() * 1000)
+        interval = max(int(1000 / rate), 1)
+        ttl = math.ceil(burst / rate) + 1
+
+        full_at = self.client.incr(key, interval)
+        if full_at <= now + interval:
+            full_at = now + interval
+            self.client.set(key, full_at, ex=ttl)
+        else:
+            self.client.expire(key, ttl)
+
+        excess = full_at - now - burst * interval
+        if excess <= 0:
+            return 0
+        # a refused request takes no token
+        self.client.incr(key, -interval)
+        return excess / 1000
+
+
+class ConcurrencyLimiter(object):
+    """
+    At most `max_active` requests at once; up to `max_queued` more wait
+    for their turn, at most `timeout` seconds. `acquire` is False for a
+    request that was shed.
+    """
+
+    def __init__(self, max_active, max_queued=0, timeout=1.0):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_active)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.shed = 0
+
+    def acquire(self):
+        if self.slots.acquire(blocking=False):
+            return True
+
+        with self.lock:
+            if self.queued >= self.max_queued:
+                self.shed += 1
+                return False
+            self.queued += 1
+        acquired = False
+        try:
+            acquired = self.slots.acquire(timeout=self.timeout)
+        finally:
+            with self.lock:
+                self.queued -= 1
+                if not acquired:
+                    self.shed += 1
+        return acquired
+
+    def release(self):
+        self.slots.release()
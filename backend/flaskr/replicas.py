@@ -0,0 +1,86 @@
+import math
+import threading
+import time
+
+#----------------------------------------------------------------------------#
+# Read replica routing.
+#
+# The views below only read, their queries may go to a replica (see
+# `models.RoutingSession`). A client that just wrote keeps reading from the
+# primary for a few seconds so it sees its own writes despite replication lag.
+#----------------------------------------------------------------------------#
+
+READ_ONLY_ENDPOINTS = frozenset((
+    'get_categories',
+    'get_questions',
+    'get_questions_in_category',
+    'search',
+    'autocomplete',
+    'check_answer',
+    'export_questions_in_bulk',
+    'play_quizz',
+    'start_quiz_session',
+    'next_quiz_question',
+    'answer_quiz_question',
+    'start_adaptive_quiz',
+    'next_adaptive_question',
+    'get_difficulties',
+    'get_leaderboard',
+    'get_question_stats',
+    'get_cache_stats',
+))
+
+STICKY_SECONDS = 5
+
+
+# the X-Client-Id header when the client sends one, its address otherwise
+def client_key(request):
+    return request.headers.get('X-Client-Id') or request.remote_addr
+
+
+class StickyWrites(object):
+    """When each client last wrote, kept for `window` seconds"""
+
+    # expired entries are swept once the table grows past this
+    sweep_size = 10000
+
+    def __init__(self, window=STICKY_SECONDS, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self.writes = {}
+        self.lock = threading.Lock()
+
+    def record(self, client):
+        if self.window <= 0:
+            return
+        with self.lock:
+            now = self.clock()
+            self.writes[client] = now
+            if len(self.writes) > self.sweep_size:
+                self.writes = {client: at for client, at in self.writes.items()
+                               if now - at < self.window}
+
+    def is_recent(self, client):
+        written_at = self.writes.get(client)
+        return written_at is not None and self.clock() - written_at < self.window
+
+
+class SharedStickyWrites(object):
+    """
+    The same kept in a shared key/value store, so a write served by one
+    worker sends the client's next reads to the primary on every worker.
+    `client` is anything with the redis-py get / set(ex=) methods, the
+    store's own expiry ends the stickiness (rounded up to a second).
+    """
+
+    def __init__(self, client, window=STICKY_SECONDS, prefix='trivia:sticky:'):
+        self.client = client
+        self.window = window
+        self.prefix = prefix
+
+    def record(self, client):
+        if self.window > 0:
+            self.client.set(self.prefix + client, 1, ex=max(math.ceil(self.window), 1))
+
+    def is_recent(self, client):
+        return self.window > 0 and self.client.get(self.prefix + client) is not None
@@ -0,0 +1,334 @@
+import atexit
+import bisect
+import logging
+import threading
+import time
+import unicodedata
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as PoolTimeout
+
+from models import db, primary_reads, QuizResult
+from .metrics import log_event
+
+#----------------------------------------------------------------------------#
+# Quiz results and leaderboards.
+#
+# Results are buffered in memory and written in batches by a background
+# thread; the leaderboards are sorted lists kept up to date as results
+# come in, so a top-N read is a slice.
+#----------------------------------------------------------------------------#
+
+LEADERBOARD_SIZE = 1000
+
+# seconds before the leaderboard is reloaded with the other workers' results
+LEADERBOARD_MAX_AGE = 60
+
+# failed writes of a result on its own before it is set aside
+MAX_ATTEMPTS = 3
+
+# errors of the database itself (down, unreachable, out of connections),
+# the results are kept as they are for the next flush
+UNAVAILABLE_ERRORS = (OperationalError, InterfaceError, PoolTimeout)
+
+
+class Board(object):
+    """
+    The best score of each player, sorted: (-score, player) keys, the ties
+    in player order. Only the `capacity` best players are kept.
+    """
+
+    def __init__(self, capacity=LEADERBOARD_SIZE):
+        self.capacity = capacity
+        self.keys = []
+        self.best = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def record(self, player, score):
+        best = self.best.get(player)
+        if best is not None:
+            if score <= best:
+                return
+            del self.keys[bisect.bisect_left(self.keys, (-best, player))]
+        elif len(self.keys) >= self.capacity and (-score, player) >= self.keys[-1]:
+            return
+
+        bisect.insort(self.keys, (-score, player))
+        self.best[player] = score
+        if len(self.keys) > self.capacity:
+            _, dropped = self.keys.pop()
+            del self.best[dropped]
+
+    # [(player, score)] of the `limit` best players
+    def top(self, limit):
+        return [(player, -score) for score, player in self.keys[:limit]]
+
+    # 1 for the best player, None for a player not on the board
+    def rank(self, player):
+        best = self.best.get(player)
+        if best is None:
+            return None
+        return bisect.bisect_left(self.keys, (-best, player)) + 1
+
+
+class Leaderboard(object):
+    """A Board over every result (None) and one per category id"""
+
+    def __init__(self, capacity=LEADERBOARD_SIZE):
+        self.capacity = capacity
+        self.boards = {}
+
+    def record(self, player, category_id, score):
+        scopes = (None,) if category_id is None else (None, category_id)
+        for scope in scopes:
+            board = self.boards.get(scope)
+            if board is None:
+                board = self.boards[scope] = Board(self.capacity)
+            board.record(player, score)
+
+    def top(self, category_id=None, limit=10):
+        board = self.boards.get(category_id)
+        return board.top(limit) if board else []
+
+    def rank(self, player, category_id=None):
+        board = self.boards.get(category_id)
+        return board.rank(player) if board else None
+
+
+# 1 to 80 characters, without control characters or lone surrogates, which
+# the database may refuse (PostgreSQL does NUL)
+def valid_player(player):
+    return 0 < len(player) <= 80 and not any(
+        unicodedata.category(char) in ('Cc', 'Cs') for char in player)
+
+
+# the best score of each player in each category
+def load_leaderboard_rows():
+    return db.session.query(
+        QuizResult.player, QuizResult.category_id, func.max(QuizResult.score)
+    ).group_by(QuizResult.category_id, QuizResult.player)
+
+
+def insert_results(rows):
+    db.session.execute(QuizResult.__table__.insert(), rows)
+    db.session.commit()
+
+
+class FlushWorker(object):
+    """
+    Calls `flush()` every `interval` seconds, or sooner when woken up, from
+    a daemon thread started on first use, and once more at exit for what
+    the thread did not write. Without an `interval` the thread is not
+    started and flushing is left to the caller.
+    """
+
+    def __init__(self, flush, interval, name):
+        self.flush = flush
+        self.interval = interval
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        if self.started or self.stopped or not self.interval:
+            return
+        with self.lock:
+            if not self.started:
+                self.started = True
+                atexit.register(self.flush)
+                self.thread.start()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    # stops the thread after a last flush
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.flush()
+
+
+class QuizResults(object):
+    """
+    Records quiz results: each one goes on the leaderboard right away and
+    into a buffer, written by `flush` in one INSERT per batch. A FlushWorker,
+    started with the first result, flushes every `interval` seconds, or as
+    soon as `batch_size` results are waiting.
+    When the database is unavailable a flush puts its results back in the
+    buffer, in order, for the next one to retry. A batch failing on its data
+    is split in halves until the results at fault are found, so the others
+    are written; a result failing on its own `MAX_ATTEMPTS` times while
+    others are written is set aside in `rejected`.
+    The leaderboard is loaded from the table on first use, and again after
+    `max_age` seconds to pick up the results of the other workers: by one
+    request, the others keep the current one meanwhile. No flush runs during
+    a load, so a result is either in the table or still in the buffer.
+    `write(rows)` and `loader()` run in an app context of `app`.
+    """
+
+    def __init__(self, app, write=insert_results, loader=load_leaderboard_rows,
+                 batch_size=500, interval=1.0, capacity=LEADERBOARD_SIZE,
+                 max_age=LEADERBOARD_MAX_AGE, clock=time.monotonic):
+        self.app = app
+        self.write = write
+        self.loader = loader
+        self.batch_size = batch_size
+        self.interval = interval
+        self.capacity = capacity
+        self.max_age = max_age
+        self.clock = clock
+        self.pending = deque()
+        self.attempts = {}
+        self.rejected = deque(maxlen=100)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.worker = FlushWorker(self.flush, interval, 'quiz-results')
+        self.leaderboard = None
+        self.loaded_at = None
+        self.counters = dict.fromkeys(('recorded', 'written', 'batches', 'failures', 'rejected'), 0)
+
+    def add(self, player, category_id, score, total):
+        row = {
+            'player': player,
+            'category_id': category_id,
+            'score': score,
+            'total': total,
+            'created_at': datetime.utcnow(),
+        }
+        with self.lock:
+            self.pending.append(row)
+            self.counters['recorded'] += 1
+            if self.leaderboard is not None:
+                self.leaderboard.record(player, category_id, score)
+            full = len(self.pending) >= self.batch_size
+        self.worker.start()
+        if full:
+            self.worker.wake()
+
+    # writes the buffered results, returns how many were written
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                rows = list(self.pending)
+                self.pending.clear()
+            if not rows:
+                return 0
+
+            batches = [rows[start:start + self.batch_size] for start in range(0, len(rows), self.batch_size)]
+            batches.reverse()
+            written, failed, error = 0, [], None
+            try:
+                with self.app.app_context():
+                    try:
+                        while batches:
+                            batch = batches.pop()
+                            try:
+                                self.write(batch)
+                            except UNAVAILABLE_ERRORS as unavailable:
+                                db.session.rollback()
+                                error = unavailable
+                                failed.extend(batch)
+                                break
+                            except Exception as invalid:
+                                db.session.rollback()
+                                error = invalid
+                                if len(batch) > 1:
+                                    half = len(batch) // 2
+                                    batches.extend((batch[half:], batch[:half]))
+                                else:
+                                    failed.extend(batch)
+                                continue
+                            written += len(batch)
+                            self.counters['batches'] += 1
+                            for row in batch:
+                                self.attempts.pop(id(row), None)
+                    finally:
+                        db.session.remove()
+            except Exception as unexpected:
+                error = unexpected
+            # in order, the batches not tried after an unavailable database
+            failed.extend(row for batch in reversed(batches) for row in batch)
+
+            if error is not None:
+                self.counters['failures'] += 1
+                log_event(self.app.logger, logging.WARNING, 'results.flush_failed',
+                          pending=len(failed), error=repr(error))
+            # a result is only at fault when others could be written
+            if written and not isinstance(error, UNAVAILABLE_ERRORS):
+                failed = [row for row in failed if not self._reject(row, error)]
+            with self.lock:
+                # ahead of the results recorded meanwhile
+                self.pending.extendleft(reversed(failed))
+            self.counters['written'] += written
+            return written
+
+    # counts a failed write of `row`, True when it is set aside
+    def _reject(self, row, error):
+        attempts = self.attempts.get(id(row), 0) + 1
+        if attempts < MAX_ATTEMPTS:
+            self.attempts[id(row)] = attempts
+            return False
+        self.attempts.pop(id(row), None)
+        self.rejected.append(row)
+        self.counters['rejected'] += 1
+        log_event(self.app.logger, logging.ERROR, 'results.rejected',
+                  player=row['player'], score=row['score'], error=repr(error))
+        return True
+
+    # stops the worker after a last flush
+    def stop(self):
+        self.worker.stop()
+
+    def stats(self):
+        return dict(self.counters, pending=len(self.pending))
+
+    #  Leaderboard
+    #  ----------------------------------------------------------------
+
+    # the current leaderboard, with the results not written yet
+    def board(self):
+        leaderboard = self.leaderboard
+        if leaderboard is not None and not self._expired():
+            return leaderboard
+        # while another request reloads it, a stale leaderboard is served
+        if not self.load_lock.acquire(blocking=leaderboard is None):
+            return leaderboard
+        try:
+            if self.leaderboard is not None and not self._expired():
+                return self.leaderboard
+            return self._load()
+        finally:
+            self.load_lock.release()
+
+    def _expired(self):
+        return bool(self.max_age) and self.clock() - self.loaded_at >= self.max_age
+
+    def _load(self):
+        leaderboard = Leaderboard(self.capacity)
+        with self.flush_lock:
+            with primary_reads():
+                for player, category_id, score in self.loader():
+                    leaderboard.record(player, category_id, score)
+            with self.lock:
+                for row in self.pending:
+                    leaderboard.record(row['player'], row['category_id'], row['score'])
+                self.leaderboard, self.loaded_at = leaderboard, self.clock()
+        return leaderboard
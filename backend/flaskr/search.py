@@ -0,0 +1,339 @@
+import bisect
+import heapq
+import re
+import sys
+import threading
+from array import array
+
+from sqlalchemy import func, literal_column, or_
+
+from models import (
+    db, listen, category_id, page_with_total, Question, QUESTION_COLUMNS, SEARCH_DOCUMENT)
+
+#----------------------------------------------------------------------------#
+# Question search.
+#
+# Every backend answers search(term, category, offset, limit) with the
+# page of matching questions, as rows of `models.QUESTION_COLUMNS`, and
+# the total number of matches.
+#----------------------------------------------------------------------------#
+
+TOKEN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN.findall((text or '').casefold())
+
+
+# picks the backend for the SEARCH_BACKEND setting, 'auto' uses the
+# Postgres full text index when the database is Postgres
+def create_search_backend(app):
+    backend = app.config.get('SEARCH_BACKEND', 'auto')
+    if backend == 'auto':
+        backend = 'postgres' if db.get_engine(app).dialect.name == 'postgresql' else 'memory'
+
+    if backend == 'postgres':
+        return PostgresSearch()
+    if backend == 'like':
+        return LikeSearch()
+    if backend == 'memory':
+        index = InvertedIndex(load_search_rows)
+        index.listen(app)
+        return index
+    raise ValueError('unknown SEARCH_BACKEND {!r}'.format(backend))
+
+
+def load_search_rows():
+    return db.session.query(
+        Question.id, Question.question, Question.answer, Question.category
+    ).yield_per(10000)
+
+
+def _filter_category(selection, category):
+    if category is None:
+        return selection
+    return selection.filter(Question.category_id == category_id(category))
+
+
+def _search(clauses, category, offset, limit):
+    if clauses is None:
+        return [], 0
+    condition, ordering = clauses
+    selection = _filter_category(
+        Question.query.with_entities(*QUESTION_COLUMNS).filter(condition), category)
+    return page_with_total(selection.order_by(*ordering), offset, limit)
+
+
+#  ILIKE
+#  ----------------------------------------------------------------
+
+class LikeSearch(object):
+    """Substring match with ILIKE, a full scan of the table on every search"""
+
+    # (condition, ordering) of the matching questions, None when nothing can match
+    def clauses(self, term):
+        pattern = '%{}%'.format(term)
+        return or_(Question.question.ilike(pattern), Question.answer.ilike(pattern)), (Question.id,)
+
+    def search(self, term, category=None, offset=0, limit=10):
+        return _search(self.clauses(term), category, offset, limit)
+
+
+#  Postgres full text search
+#  ----------------------------------------------------------------
+
+class PostgresSearch(object):
+    """
+    tsvector search served by the `ix_questions_search` GIN index,
+    results ranked with ts_rank. Every word of the term is matched as a prefix.
+    """
+
+    document = literal_column(SEARCH_DOCUMENT)
+
+    def clauses(self, term):
+        terms = tokenize(term)
+        if not terms:
+            return None
+
+        query = func.to_tsquery(
+            literal_column("'english'"), ' & '.join(term + ':*' for term in terms))
+        return self.document.op('@@')(query), (func.ts_rank(self.document, query).desc(), Question.id)
+
+    def search(self, term, category=None, offset=0, limit=10):
+        return _search(self.clauses(term), category, offset, limit)
+
+
+#  In-process indexes
+#  ----------------------------------------------------------------
+
+class LiveIndex(object):
+    """
+    Base for the indexes kept in process memory. The index is built from
+    `loader` rows (id, question, answer, category) on first use, then kept
+    current by the commit hooks as questions are inserted, updated or deleted.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.lock = threading.RLock()
+        self.ready = False
+
+    def listen(self, app):
+        listen(app, self.on_change)
+
+    def on_change(self, action, instance):
+        if action == 'reset':
+            # bulk writes: rebuilt from the database on next use
+            self.ready = False
+            return
+        if action == 'insert_many':
+            with self.lock:
+                if self.ready:
+                    for question in instance:
+                        self.add(question.id, question.question, question.answer, question.category)
+            return
+        if not isinstance(instance, Question):
+            return
+        with self.lock:
+            if not self.ready:
+                return
+            self.remove(instance.id)
+            if action in ('insert', 'update'):
+                self.add(instance.id, instance.question, instance.answer, instance.category)
+
+    def _ensure_built(self):
+        if not self.ready:
+            with self.lock:
+                if not self.ready:
+                    self.build(self.loader())
+
+
+class InvertedIndex(LiveIndex):
+    """
+    Word -> question ids index, the search backend for SQLite and tests.
+    Every word of the term must match (as a prefix), questions matching
+    in their text rank before answer-only matches.
+    """
+
+    def build(self, rows):
+        with self.lock:
+            self.docs = {}
+            self.question_postings = {}
+            self.answer_postings = {}
+            self.words = []
+            for id, question, answer, category in rows:
+                self._add(id, question, answer, category)
+            self.words = sorted(set(self.question_postings) | set(self.answer_postings))
+            self.ready = True
+
+    def add(self, id, question, answer, category):
+        with self.lock:
+            for word in self._add(id, question, answer, category):
+                index = bisect.bisect_left(self.words, word)
+                if index == len(self.words) or self.words[index] != word:
+                    self.words.insert(index, word)
+
+    def _add(self, id, question, answer, category):
+        question_words = frozenset(tokenize(question))
+        answer_words = frozenset(tokenize(answer))
+        self.docs[id] = (category, question_words, answer_words)
+        for words, postings in ((question_words, self.question_postings),
+                                (answer_words, self.answer_postings)):
+            for word in words:
+                postings.setdefault(word, set()).add(id)
+        return question_words | answer_words
+
+    # words left without postings stay in the vocabulary, they just match nothing
+    def remove(self, id):
+        with self.lock:
+            doc = self.docs.pop(id, None)
+            if doc is None:
+                return
+            for words, postings in ((doc[1], self.question_postings),
+                                    (doc[2], self.answer_postings)):
+                for word in words:
+                    postings[word].discard(id)
+
+    # vocabulary words starting with `prefix`
+    def _expand(self, prefix):
+        start = bisect.bisect_left(self.words, prefix)
+        end = bisect.bisect_left(self.words, prefix + '\U0010ffff', start)
+        return self.words[start:end]
+
+    # {id: score} of the matching questions
+    def match(self, term, category=None):
+        terms = tokenize(term)
+        if not terms:
+            return {}
+
+        self._ensure_built()
+        with self.lock:
+            scores = None
+            for term in terms:
+                term_scores = {}
+                for word in self._expand(term):
+                    bonus = 1 if word == term else 0
+                    for id in self.answer_postings.get(word, ()):
+                        term_scores[id] = max(term_scores.get(id, 0), 1 + bonus)
+                    for id in self.question_postings.get(word, ()):
+                        term_scores[id] = max(term_scores.get(id, 0), 3 + bonus)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {id: scores[id] + score
+                              for id, score in term_scores.items() if id in scores}
+                if not scores:
+                    return {}
+
+            if category is not None:
+                category = str(category)
+                scores = {id: score for id, score in scores.items()
+                          if self.docs[id][0] == category}
+
+        return scores
+
+    # only the requested page is ranked, not every match
+    def search(self, term, category=None, offset=0, limit=10):
+        scores = self.match(term, category)
+        page = heapq.nsmallest(offset + limit, scores, key=lambda id: (-scores[id], id))[offset:]
+        if not page:
+            return [], len(scores)
+
+        questions = {row.id: row for row in
+                     db.session.query(*QUESTION_COLUMNS).filter(Question.id.in_(page))}
+        return [questions[id] for id in page if id in questions], len(scores)
+
+
+class PrefixIndex(LiveIndex):
+    """
+    Typeahead index over the question text: a sorted array of
+    (word, question id) entries, kept as a list of interned words and a
+    parallel array of ids. A completion is a bisect to the first word
+    starting with the typed prefix, then a scan until `limit` questions
+    are found, so shorter (exact) word completions come first. The words
+    of each question are kept as a set, so the earlier typed words are
+    checked without tokenizing the candidates again.
+    """
+
+    # entries looked at per completion, bounds the cost of rare matches
+    max_scan = 5000
+
+    def build(self, rows):
+        with self.lock:
+            entries = []
+            self.texts = {}
+            self.tokens = {}
+            for id, question, answer, category in rows:
+                self.texts[id] = question or ''
+                self.tokens[id] = frozenset(tokenize(question))
+                entries.extend((word, id) for word in self.tokens[id])
+            entries.sort()
+            self.words = [sys.intern(word) for word, id in entries]
+            self.ids = array('l', (id for word, id in entries))
+            self.ready = True
+
+    def add(self, id, question, answer=None, category=None):
+        with self.lock:
+            self.texts[id] = question or ''
+            self.tokens[id] = frozenset(tokenize(question))
+            for word in self.tokens[id]:
+                position = self._position(word, id)
+                self.words.insert(position, sys.intern(word))
+                self.ids.insert(position, id)
+
+    def remove(self, id):
+        with self.lock:
+            self.texts.pop(id, None)
+            tokens = self.tokens.pop(id, None)
+            if tokens is None:
+                return
+            for word in tokens:
+                position = self._position(word, id)
+                if position < len(self.ids) and self.ids[position] == id and self.words[position] == word:
+                    del self.words[position]
+                    del self.ids[position]
+
+    # where (word, id) is, or would be inserted
+    def _position(self, word, id):
+        low = bisect.bisect_left(self.words, word)
+        high = bisect.bisect_right(self.words, word, low)
+        while low < high:
+            middle = (low + high) // 2
+            if self.ids[middle] < id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # ([(id, question)], truncated) of up to `limit` questions containing
+    # every typed word, the last one possibly unfinished. `truncated` is
+    # True when the scan stopped at `max_scan` entries with words starting
+    # with the prefix left, so there may be more matches.
+    def complete(self, text, limit=10):
+        terms = tokenize(text)
+        if not terms:
+            return [], False
+
+        self._ensure_built()
+        prefix, words = terms[-1], set(terms[:-1])
+        results = []
+        seen = set()
+        truncated = False
+        with self.lock:
+            start = bisect.bisect_left(self.words, prefix)
+            end = min(len(self.words), start + self.max_scan)
+            for position in range(start, end):
+                if not self.words[position].startswith(prefix):
+                    break
+                id = self.ids[position]
+                if id in seen:
+                    continue
+                seen.add(id)
+                if words and not words.issubset(self.tokens[id]):
+                    continue
+                results.append((id, self.texts[id]))
+                if len(results) == limit:
+                    break
+            else:
+                truncated = end < len(self.words) and self.words[end].startswith(prefix)
+        return results, truncated
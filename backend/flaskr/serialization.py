@@ -0,0 +1,91 @@
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#----------------------------------------------------------------------------#
+# JSON serialization.
+#
+# The responses are serialized by orjson when it is installed, with output
+# byte for byte identical to Flask's default (stdlib json) provider.
+#----------------------------------------------------------------------------#
+
+# the arguments Flask's `jsonify` dumps with outside of debug mode
+COMPACT = {'separators': (',', ':')}
+
+# Where orjson and the stdlib disagree on numbers: floats written with an
+# exponent, or between 1e-5 and 1e-4. Looked for with every digit turned
+# into a 0, which also matches some strings, costing them a stdlib run.
+ZERO_DIGITS = bytes.maketrans(b'123456789', b'000000000')
+
+
+def stdlib_numbers(data):
+    data = data.translate(ZERO_DIGITS)
+    return b'0e' in data or b'0E' in data or b'0.0000' in data
+
+
+# the provider picked by the JSON_BACKEND setting: 'auto' (orjson when it
+# is installed), 'orjson' or 'stdlib'
+def create_json_provider(app):
+    backend = app.config.get('JSON_BACKEND', 'auto')
+    if backend == 'auto':
+        backend = 'stdlib' if orjson is None else 'orjson'
+
+    if backend == 'orjson':
+        if orjson is None:
+            raise ValueError('JSON_BACKEND is orjson but orjson is not installed')
+        return OrjsonProvider(app)
+    if backend == 'stdlib':
+        return DefaultJSONProvider(app)
+    raise ValueError('unknown JSON_BACKEND {!r}'.format(backend))
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Flask's JSON provider, with the compact `jsonify` output done by orjson.
+    Anything orjson would write differently goes through the stdlib instead:
+    most non string keys (sorted as numbers by the stdlib), integers over 64 bits,
+    non ASCII text and DEL (escaped by the stdlib), some floats and the types Flask
+    encodes itself (dates, decimals, subclasses of the JSON types).
+    NaN and infinities come out as null.
+    """
+
+    option = None if orjson is None else (
+        orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_SUBCLASS)
+
+    def dumps(self, obj, **kwargs):
+        if kwargs != COMPACT or not (self.sort_keys and self.ensure_ascii):
+            return super().dumps(obj, **kwargs)
+        try:
+            data = orjson.dumps(obj, option=self.option)
+        except TypeError:
+            data = self._dumps_with_int_keys(obj)
+        # the stdlib escapes DEL, orjson writes it as is
+        if data is None or not data.isascii() or b'\x7f' in data or stdlib_numbers(data):
+            return super().dumps(obj, **kwargs)
+        return data.decode()
+
+    # The {id: type} category maps of the responses: a top level value
+    # with integer keys is written by orjson as long as the keys sort the
+    # same as text and as numbers (ids 1 to 9, or 10 to 99...). None otherwise.
+    def _dumps_with_int_keys(self, obj):
+        if type(obj) is not dict:
+            return None
+        converted = dict(obj)
+        for name, value in obj.items():
+            if type(value) is not dict or all(type(key) is str for key in value):
+                continue
+            if not all(type(key) is int for key in value):
+                return None
+            keys = sorted(value)
+            text_keys = [str(key) for key in keys]
+            if text_keys != sorted(text_keys):
+                return None
+            converted[name] = {text: value[key] for text, key in zip(text_keys, keys)}
+        try:
+            return orjson.dumps(converted, option=self.option)
+        except TypeError:
+            return None
@@ -0,0 +1,205 @@
+import bisect
+import random
+import sys
+import threading
+import time
+from array import array
+
+from models import db, listen, primary_reads, Question, QuestionRow
+
+#----------------------------------------------------------------------------#
+# In-memory question snapshot.
+#
+# For deployments where the question bank does not change (events), the
+# listing and quiz endpoints are served from a read-only copy of the
+# questions table held in columns instead of ORM objects.
+#----------------------------------------------------------------------------#
+
+# seconds after which a snapshot is reloaded anyway, to pick up the rows
+# written without the commit hooks (e.g. straight to the database)
+SNAPSHOT_MAX_AGE = 300
+
+
+class ValueTable(object):
+    """A column of repeated values: each distinct value is stored once, rows hold its code"""
+
+    def __init__(self, typecode='l'):
+        self.values = []
+        self.codes = array(typecode)
+        self.index = {}
+
+    def append(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(sys.intern(value) if isinstance(value, str) else value)
+        self.codes.append(code)
+
+    def __getitem__(self, position):
+        return self.values[self.codes[position]]
+
+
+class QuestionSnapshot(object):
+    """
+    Columnar, immutable copy of the questions ordered by id: an array of
+    ids, the question texts, and value tables for the answers, categories
+    and difficulties. `by_category` maps each category id to the array of
+    positions of its questions, so a category page is a slice.
+    `rows` are (id, question, answer, category, category_id, difficulty)
+    tuples in id order.
+    """
+
+    def __init__(self, rows):
+        self.ids = array('q')
+        self.questions = []
+        self.answers = ValueTable()
+        self.categories = ValueTable('H')
+        self.difficulties = ValueTable('B')
+        by_category = {}
+        for id, question, answer, category, category_id, difficulty in rows:
+            by_category.setdefault(category_id, array('l')).append(len(self.ids))
+            self.ids.append(id)
+            self.questions.append(question)
+            self.answers.append(answer)
+            self.categories.append(category)
+            self.difficulties.append(difficulty)
+        self.by_category = by_category
+        self.all = range(len(self.ids))
+        self.loaded_at = time.time()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, position):
+        return QuestionRow(
+            self.ids[position], self.questions[position], self.answers[position],
+            self.categories[position], self.difficulties[position])
+
+    def positions(self, category_id=None):
+        if category_id is None:
+            return self.all
+        return self.by_category.get(category_id, ())
+
+    # index in `positions` of the question `id`, None when not there
+    def _index(self, positions, id):
+        position = bisect.bisect_left(self.ids, id)
+        if position == len(self.ids) or self.ids[position] != id:
+            return None
+        index = bisect.bisect_left(positions, position)
+        if index == len(positions) or positions[index] != position:
+            return None
+        return index
+
+    def get(self, id):
+        index = self._index(self.all, id)
+        return None if index is None else self.row(index)
+
+    def count(self, category_id=None):
+        return len(self.positions(category_id))
+
+    def ids_of(self, category_id=None):
+        return [self.ids[position] for position in self.positions(category_id)]
+
+    # (formatted questions, total) of the questions `offset` to `offset + limit`
+    def page(self, offset, limit, category_id=None):
+        positions = self.positions(category_id)
+        return ([self.row(position).format() for position in positions[offset:offset + limit]],
+                len(positions))
+
+    # the same, for the questions with an id greater than `after_id`
+    def after(self, after_id, limit, category_id=None):
+        positions = self.positions(category_id)
+        start = bisect.bisect_left(positions, bisect.bisect_right(self.ids, after_id))
+        return ([self.row(position).format() for position in positions[start:start + limit]],
+                len(positions))
+
+    # a question of the category picked uniformly at random, skipping the
+    # `excluded` ids, None once every one has been played
+    def pick_random(self, category_id=None, excluded=(), rng=random):
+        positions = self.positions(category_id)
+        skipped = sorted({index for index in (self._index(positions, id) for id in set(excluded))
+                          if index is not None})
+        remaining = len(positions) - len(skipped)
+        if remaining <= 0:
+            return None
+
+        index = rng.randrange(remaining)
+        for skipped_index in skipped:
+            if skipped_index > index:
+                break
+            index += 1
+        return self.row(positions[index])
+
+
+def load_snapshot_rows():
+    return db.session.query(
+        Question.id, Question.question, Question.answer, Question.category,
+        Question.category_id, Question.difficulty
+    ).order_by(Question.id).yield_per(10000)
+
+
+class SnapshotStore(object):
+    """
+    The current QuestionSnapshot, loaded on first use. Any committed write
+    (see `models.listen`), a change of `version` (the app's data version,
+    bumped by the writes of every worker when it is shared) or an age over
+    `max_age` seconds has it reloaded on next use; `refresh()` reloads it
+    right away. Readers keep the snapshot they got while a new one is
+    swapped in.
+    One reader loads it, under a lock that re-checks it: after a write the
+    others wait for it, an outdated snapshot is served meanwhile. A
+    snapshot loaded across a write is used once, not kept.
+    """
+
+    def __init__(self, loader=load_snapshot_rows, max_age=None, clock=time.monotonic, version=None):
+        self.loader = loader
+        self.max_age = max_age
+        self.clock = clock
+        self.version = version
+        self.lock = threading.Lock()
+        self.swap_lock = threading.Lock()
+        self.snapshot = None
+        self.loaded_at = None
+        self.seen = None
+        self.changes = 0
+
+    def listen(self, app):
+        listen(app, lambda action, instance: self.invalidate())
+
+    def invalidate(self):
+        with self.swap_lock:
+            self.changes += 1
+            self.snapshot = None
+
+    def refresh(self):
+        with self.lock:
+            return self._load()
+
+    def _version(self):
+        return None if self.version is None else self.version.get()
+
+    def _load(self):
+        changes, seen = self.changes, self._version()
+        with primary_reads():
+            snapshot = QuestionSnapshot(self.loader())
+        with self.swap_lock:
+            if self.changes == changes:
+                self.snapshot, self.loaded_at, self.seen = snapshot, self.clock(), seen
+        return snapshot
+
+    def _outdated(self):
+        return ((bool(self.max_age) and self.clock() - self.loaded_at >= self.max_age)
+                or self._version() != self.seen)
+
+    def get(self):
+        snapshot = self.snapshot
+        if snapshot is not None and not self._outdated():
+            return snapshot
+        if not self.lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            if self.snapshot is not None and not self._outdated():
+                return self.snapshot
+            return self._load()
+        finally:
+            self.lock.release()
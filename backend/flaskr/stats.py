@@ -0,0 +1,230 @@
+import heapq
+import logging
+import threading
+
+from sqlalchemy import Float, cast, func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, listen, Question, QuestionStat
+from .adaptive import DIFFICULTIES
+from .metrics import log_event
+from .results import FlushWorker
+
+#----------------------------------------------------------------------------#
+# Per question statistics.
+#
+# The quizzes and the session answers count into in-memory deltas, merged
+# into the question_stats table by a background thread with one upsert per
+# batch, so the counts are never computed from raw events.
+#----------------------------------------------------------------------------#
+
+COUNTERS = ('served', 'answered', 'correct')
+
+# answers needed before a difficulty is suggested from the success rate
+CALIBRATION_MIN_ANSWERS = 20
+
+STATS_SORTS = ('hardest', 'easiest', 'served')
+
+# pending question ids per IN (...) query of `category_stats`
+PENDING_CHUNK_SIZE = 500
+
+
+# the INSERT ... ON CONFLICT of the supported databases
+UPSERT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def upsert_stats(rows):
+    """Adds the counts of `rows` to question_stats, creating the missing rows"""
+    table = QuestionStat.__table__
+    statement = UPSERT_INSERTS[db.session().get_bind().dialect.name](table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.question_id],
+        set_={name: table.c[name] + statement.excluded[name] for name in COUNTERS})
+    db.session.execute(statement, rows)
+    db.session.commit()
+
+
+# the ids of `ids` still in the questions table
+def existing_question_ids(ids):
+    return {id for (id,) in db.session.query(Question.id).filter(Question.id.in_(ids))}
+
+
+class QuestionStats(object):
+    """
+    Counts of the questions served and answered (right), kept as deltas by
+    question id until `flush` adds them to question_stats, in batches of
+    `batch_size` questions. A FlushWorker started with the first count
+    flushes every `interval` seconds. A failed flush adds its deltas back
+    for the next one. Deltas of deleted questions are dropped, through the
+    commit hooks and, for the questions deleted by another worker, before
+    each flush.
+    `write(rows)` runs in an app context of `app`.
+    """
+
+    def __init__(self, app, write=upsert_stats, batch_size=500, interval=5.0):
+        self.app = app
+        self.write = write
+        self.batch_size = batch_size
+        self.deltas = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.worker = FlushWorker(self.flush, interval, 'question-stats')
+        self.counters = dict.fromkeys(('written', 'batches', 'failures'), 0)
+
+    def listen(self, app):
+        listen(app, self.on_change)
+
+    def on_change(self, action, instance):
+        if action == 'reset':
+            with self.lock:
+                self.deltas.clear()
+        elif isinstance(instance, Question) and action == 'delete':
+            with self.lock:
+                self.deltas.pop(instance.id, None)
+
+    def count(self, question_id, served=0, answered=0, correct=0):
+        with self.lock:
+            delta = self.deltas.get(question_id)
+            if delta is None:
+                delta = self.deltas[question_id] = [0, 0, 0]
+            delta[0] += served
+            delta[1] += answered
+            delta[2] += correct
+        self.worker.start()
+
+    def served(self, question_id):
+        self.count(question_id, served=1)
+
+    def answered(self, question_id, correct):
+        self.count(question_id, answered=1, correct=int(correct))
+
+    # {question id: (served, answered, correct)} not written yet
+    def pending(self):
+        with self.lock:
+            return {id: tuple(delta) for id, delta in self.deltas.items()}
+
+    def _restore(self, rows):
+        with self.lock:
+            for row in rows:
+                delta = self.deltas.get(row['question_id'])
+                if delta is None:
+                    delta = self.deltas[row['question_id']] = [0, 0, 0]
+                for index, name in enumerate(COUNTERS):
+                    delta[index] += row[name]
+
+    # writes the deltas, returns the number of questions updated
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                deltas, self.deltas = self.deltas, {}
+            if not deltas:
+                return 0
+            rows = [dict(zip(COUNTERS, delta), question_id=id) for id, delta in deltas.items()]
+
+            written = 0
+            try:
+                with self.app.app_context():
+                    try:
+                        for start in range(0, len(rows), self.batch_size):
+                            batch = rows[start:start + self.batch_size]
+                            ids = existing_question_ids([row['question_id'] for row in batch])
+                            batch = [row for row in batch if row['question_id'] in ids]
+                            if batch:
+                                self.write(batch)
+                                self.counters['batches'] += 1
+                            written = start + self.batch_size
+                    finally:
+                        db.session.remove()
+            except Exception as error:
+                self._restore(rows[written:])
+                self.counters['failures'] += 1
+                log_event(self.app.logger, logging.WARNING, 'stats.flush_failed',
+                          pending=len(rows) - written, error=repr(error))
+            written = min(written, len(rows))
+            self.counters['written'] += written
+            return written
+
+    def stop(self):
+        self.worker.stop()
+
+    def stats(self):
+        return dict(self.counters, pending=len(self.deltas))
+
+
+#  Reading the stats
+#  ----------------------------------------------------------------
+
+# the difficulty matching a success rate: 1 for 80% right answers or more,
+# 5 below 20%. None until enough answers were checked.
+def suggested_difficulty(answered, correct):
+    if answered < CALIBRATION_MIN_ANSWERS:
+        return None
+    return DIFFICULTIES[-1] - min(correct * len(DIFFICULTIES) // answered, len(DIFFICULTIES) - 1)
+
+
+# The stats of the questions of a category answered at least `min_answered`
+# times, as (id, question, difficulty, served, answered, correct) rows in the
+# order of `sort`: ORDER BY and LIMIT run in the database, on the written
+# counts. `ids` only keeps these questions.
+def load_category_stats(category_id, sort='hardest', min_answered=1, limit=None, ids=None):
+    served, answered, correct = (
+        func.coalesce(column, 0)
+        for column in (QuestionStat.served, QuestionStat.answered, QuestionStat.correct))
+    query = db.session.query(
+        Question.id, Question.question, Question.difficulty, served, answered, correct,
+    ).outerjoin(QuestionStat, QuestionStat.question_id == Question.id).filter(
+        Question.category_id == category_id)
+    if ids is not None:
+        query = query.filter(Question.id.in_(ids))
+    else:
+        query = query.filter(answered >= min_answered)
+
+    if sort == 'served':
+        order = (served.desc(), Question.id)
+    else:
+        rate = cast(correct, Float) / func.nullif(answered, 0)
+        order = (answered == 0, rate if sort == 'hardest' else rate.desc(), answered.desc(), Question.id)
+    return query.order_by(*order).limit(limit)
+
+
+def stats_key(sort):
+    if sort == 'served':
+        return lambda stat: (-stat['served'], stat['id'])
+    sign = 1 if sort == 'hardest' else -1
+    return lambda stat: (not stat['answered'], sign * stat['correct'] / (stat['answered'] or 1),
+                         -stat['answered'], stat['id'])
+
+
+# Stats of the questions of a category answered at least `min_answered`
+# times, with the deltas not written yet. `sort` is one of STATS_SORTS:
+# the lowest success rate first, the highest, or the most served.
+# Only the questions with `pending` deltas are merged in Python, the best
+# `limit` of the others come sorted from the database.
+def category_stats(category_id, pending, sort='hardest', min_answered=1, limit=10):
+    stats = []
+    ids = list(pending)
+    for start in range(0, len(ids), PENDING_CHUNK_SIZE):
+        for id, question, difficulty, *counts in load_category_stats(
+                category_id, ids=ids[start:start + PENDING_CHUNK_SIZE]):
+            stats.append(format_stats(id, question, difficulty, *(
+                count + delta for count, delta in zip(counts, pending[id]))))
+    changed = {stat['id'] for stat in stats}
+    stats = [stat for stat in stats if stat['answered'] >= min_answered]
+    # the changed questions may take some of the places
+    for row in load_category_stats(category_id, sort, min_answered, limit + len(changed)):
+        if row[0] not in changed:
+            stats.append(format_stats(*row))
+    return heapq.nsmallest(limit, stats, key=stats_key(sort))
+
+
+def format_stats(id, question, difficulty, served, answered, correct):
+    return {
+        'id': id,
+        'question': question,
+        'difficulty': difficulty,
+        'served': served,
+        'answered': answered,
+        'correct': correct,
+        'success_rate': round(correct / answered, 4) if answered else None,
+        'suggested_difficulty': suggested_difficulty(answered, correct),
+    }
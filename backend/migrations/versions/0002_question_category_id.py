@@ -0,0 +1,62 @@
+"""integer category foreign key and indexes on questions
+
+Adds questions.category_id, backfilled from the category string column,
+with a (category_id, id) index for the paginated category and quiz reads,
+and the full text search index on Postgres.
+
+Revision ID: 0002_question_category_id
+Revises: 0001_initial
+Create Date: 2022-10-15 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002_question_category_id'
+down_revision = '0001_initial'
+branch_labels = None
+depends_on = None
+
+SEARCH_DOCUMENT = "to_tsvector('english', coalesce(question, '') || ' ' || coalesce(answer, ''))"
+
+
+def upgrade():
+    dialect = op.get_context().dialect.name
+
+    with op.batch_alter_table('questions') as batch_op:
+        batch_op.add_column(sa.Column('category_id', sa.Integer(), nullable=True))
+
+    # backfill: numeric category strings pointing at an existing category
+    if dialect == 'postgresql':
+        op.execute(
+            "UPDATE questions SET category_id = CAST(category AS INTEGER) "
+            "WHERE category ~ '^[0-9]+$'")
+    else:
+        op.execute(
+            "UPDATE questions SET category_id = CAST(category AS INTEGER) "
+            "WHERE category <> '' AND category NOT GLOB '*[^0-9]*'")
+    op.execute(
+        "UPDATE questions SET category_id = NULL "
+        "WHERE category_id NOT IN (SELECT id FROM categories)")
+
+    with op.batch_alter_table('questions') as batch_op:
+        batch_op.create_foreign_key(
+            'fk_questions_category_id', 'categories', ['category_id'], ['id'])
+        batch_op.create_index('ix_questions_category_id_id', ['category_id', 'id'])
+
+    if dialect == 'postgresql':
+        op.execute(
+            "CREATE INDEX IF NOT EXISTS ix_questions_search ON questions "
+            "USING gin ({})".format(SEARCH_DOCUMENT))
+
+
+def downgrade():
+    if op.get_context().dialect.name == 'postgresql':
+        op.execute("DROP INDEX IF EXISTS ix_questions_search")
+
+    with op.batch_alter_table('questions') as batch_op:
+        batch_op.drop_index('ix_questions_category_id_id')
+        batch_op.drop_constraint('fk_questions_category_id', type_='foreignkey')
+        batch_op.drop_column('category_id')
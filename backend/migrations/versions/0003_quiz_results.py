@@ -0,0 +1,39 @@
+"""quiz results
+
+Adds the quiz_results table the leaderboards are built from, with a
+(category_id, player) index for loading the best score per player.
+
+Revision ID: 0003_quiz_results
+Revises: 0002_question_category_id
+Create Date: 2022-10-29 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003_quiz_results'
+down_revision = '0002_question_category_id'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'quiz_results',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('player', sa.String(length=80), nullable=False),
+        sa.Column('category_id', sa.Integer(), nullable=True),
+        sa.Column('score', sa.Integer(), nullable=False),
+        sa.Column('total', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['category_id'], ['categories.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_quiz_results_category_id_player', 'quiz_results', ['category_id', 'player'])
+
+
+def downgrade():
+    op.drop_index('ix_quiz_results_category_id_player', table_name='quiz_results')
+    op.drop_table('quiz_results')
@@ -0,0 +1,35 @@
+"""question stats
+
+Adds the question_stats table: how often each question was served and
+answered (right), one row per question, deleted with it.
+
+Revision ID: 0004_question_stats
+Revises: 0003_quiz_results
+Create Date: 2022-11-05 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004_question_stats'
+down_revision = '0003_quiz_results'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'question_stats',
+        sa.Column('question_id', sa.Integer(), nullable=False),
+        sa.Column('served', sa.Integer(), nullable=False),
+        sa.Column('answered', sa.Integer(), nullable=False),
+        sa.Column('correct', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['question_id'], ['questions.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('question_id')
+    )
+
+
+def downgrade():
+    op.drop_table('question_stats')
@@ -1,23 +1,263 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import random
+import secrets
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from sqlalchemy import (
+    Column, String, Integer, DateTime, ForeignKey, Index, create_engine, DDL, event, func, select)
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import orm
+from sqlalchemy.orm import validates
+from sqlalchemy.pool import QueuePool
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from flask_migrate import Migrate
 import json
 
 database_name = 'trivia'
-database_path = 'postgresql://{}:{}@{}/{}'.format('postgres','lol','localhost:5432', database_name)
+database_path = os.environ.get(
+    'DATABASE_URL',
+    'postgresql://{}:{}@{}/{}'.format('postgres','lol','localhost:5432', database_name))
+
+"""
+RoutingSession
+    sends the queries of a read-only request (`g.use_replica`) to one of the
+    replica binds, picked at random. Writes, flushes and every other
+    request use the primary.
+"""
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replicas = self.app.extensions.get('trivia_replicas')
+        if replicas and not self._flushing and has_app_context() and g.get('use_replica'):
+            return db.get_engine(self.app, bind=random.choice(replicas))
+        return super().get_bind(mapper, clause)
 
-db = SQLAlchemy()
+
+"""
+primary_reads()
+    has the queries run inside the block read from the primary, also in a
+    read-only request. The caches kept under a version (or for a while)
+    load through it: a replica lagging behind a write would otherwise be
+    cached as the data of the new version.
+"""
+@contextmanager
+def primary_reads():
+    if not has_app_context():
+        yield
+        return
+    use_replica = g.pop('use_replica', None)
+    try:
+        yield
+    finally:
+        if use_replica is not None:
+            g.use_replica = use_replica
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+migrate = Migrate()
+
+migrations_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service.
+    The tables are only created when DB_CREATE_ALL is set, the schema is
+    otherwise managed by the migrations.
+    Read replicas are listed in SQLALCHEMY_REPLICA_URIS (or the comma
+    separated DATABASE_REPLICA_URLS environment variable), each one becomes
+    a `replica_<n>` bind used by `RoutingSession`.
 """
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dict(
+        engine_options(app, database_path), **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+
+    replica_uris = app.config.get("SQLALCHEMY_REPLICA_URIS")
+    if replica_uris is None:
+        replica_uris = [uri.strip() for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                        if uri.strip()]
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    replicas = []
+    for n, uri in enumerate(replica_uris):
+        replicas.append('replica_{}'.format(n))
+        binds[replicas[-1]] = uri
+    app.config["SQLALCHEMY_BINDS"] = binds or None
+    app.extensions['trivia_replicas'] = replicas
+
     db.app = app
     db.init_app(app)
-    db.create_all()
+    migrate.init_app(app, db, directory=migrations_directory)
+    if setting(app, 'DB_CREATE_ALL', boolean, False):
+        db.create_all()
+
+"""
+setting(app, name, type, default)
+    a setting from the app config, else from the environment variable of
+    the same name
+"""
+def setting(app, name, type, default=None):
+    value = app.config.get(name, os.environ.get(name))
+    if value is None or value == '':
+        return default
+    return type(value)
+
+def boolean(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+"""
+engine_options(app, database_path)
+    connection pool settings:
+        DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (seconds): pool sizing
+        DB_POOL_RECYCLE (seconds): replaces connections older than this
+        DB_POOL_PRE_PING: tests connections before handing them out
+        DB_STATEMENT_TIMEOUT (milliseconds): Postgres statement_timeout
+    SQLite keeps the pools Flask-SQLAlchemy picks for it.
+"""
+def engine_options(app, database_path):
+    url = make_url(database_path)
+    options = {'pool_pre_ping': setting(app, 'DB_POOL_PRE_PING', boolean, True)}
+
+    recycle = setting(app, 'DB_POOL_RECYCLE', int)
+    if recycle is not None:
+        options['pool_recycle'] = recycle
+
+    if url.get_backend_name() == 'sqlite':
+        return options
+
+    options['poolclass'] = TimedQueuePool
+    for name, option, type in (('DB_POOL_SIZE', 'pool_size', int),
+                               ('DB_MAX_OVERFLOW', 'max_overflow', int),
+                               ('DB_POOL_TIMEOUT', 'pool_timeout', float)):
+        value = setting(app, name, type)
+        if value is not None:
+            options[option] = value
+
+    statement_timeout = setting(app, 'DB_STATEMENT_TIMEOUT', int)
+    if statement_timeout and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {'options': '-c statement_timeout={}'.format(statement_timeout)}
+    return options
+
+"""
+memory_database(database_path)
+    whether the database is an in-memory SQLite one, which each thread
+    sees separately
+"""
+def memory_database(database_path):
+    url = make_url(database_path)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+"""
+TimedQueuePool
+    QueuePool recording how long requests wait to get a connection
+"""
+class TimedQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+"""
+pool_stats(engine)
+    a snapshot of the connection pool: connections checked out, idle and
+    in overflow, and the time spent waiting for one
+"""
+def pool_stats(engine=None):
+    pool = (engine or db.engine).pool
+    stats = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow)
+    if isinstance(pool, TimedQueuePool):
+        stats.update(
+            checkouts=pool.checkouts,
+            wait_seconds_total=round(pool.wait_seconds, 6),
+            wait_seconds_max=round(pool.max_wait_seconds, 6))
+    return stats
+
+"""
+listen(app, callback)
+    registers callback(action, instance), called once an insert, update or
+    delete of a Question or Category has been committed on that app.
+    In-memory indexes and caches use it to stay up to date. The questions
+    of `Question.insert_many` come in one ('insert_many', [questions]),
+    other bulk writes done without the ORM send a single ('reset', None).
+"""
+def listen(app, callback):
+    app.extensions.setdefault('trivia_listeners', []).append(callback)
+
+def notify(action, instance):
+    app = db.get_app()
+    for callback in app.extensions.get('trivia_listeners', ()):
+        callback(action, instance)
+
+"""
+page_with_total(selection, offset, limit, entities=False)
+    one page of an ordered query and the number of rows it matches, counted
+    by a COUNT(*) OVER () window labelled `total` in the same statement.
+    The page holds the selected columns of each row as a tuple, or with
+    `entities` the single entity the query selects (Question instances for
+    Question.query). Only a page past the end costs a second (COUNT) query.
+"""
+def page_with_total(selection, offset, limit, entities=False):
+    rows = selection.add_columns(func.count().over().label('total')).offset(offset).limit(limit).all()
+    if not rows:
+        return [], selection.order_by(None).count()
+    if entities:
+        return [row[0] for row in rows], rows[0].total
+    return [row[:-1] for row in rows], rows[0].total
+
+"""
+category_id(category)
+    the integer id of an API category value ('3' or 3), None if not numeric
+"""
+def category_id(category):
+    try:
+        return int(category)
+    except (TypeError, ValueError):
+        return None
+
+"""
+match_returned_rows(rows, returned)
+    the `returned` rows of an INSERT ... RETURNING in the order of the
+    inserted `rows`. RETURNING does not promise the order of the VALUES, so
+    they are matched on the inserted columns, equal rows being
+    interchangeable.
+"""
+def match_returned_rows(rows, returned):
+    names = list(rows[0])
+    by_values = {}
+    for row in returned:
+        by_values.setdefault(tuple(row[name] for name in names), []).append(row)
+    return [by_values[tuple(row[name] for name in names)].pop() for row in rows]
 
 """
 Question
@@ -25,11 +265,18 @@ Question
 """
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        # category pages and quiz draws filter on the category, ordered by id
+        Index('ix_questions_category_id_id', 'category_id', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
+    # `category` is what the API sends and returns, `category_id` the
+    # foreign key the queries filter on, kept in sync by `sync_category_id`
     category = Column(String)
+    category_id = Column(Integer, ForeignKey('categories.id'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -38,16 +285,76 @@ class Question(db.Model):
         self.category = category
         self.difficulty = difficulty
 
+    @validates('category')
+    def sync_category_id(self, key, category):
+        self.category_id = category_id(category)
+        return None if category is None else str(category)
+
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        notify('insert', self)
 
     def update(self):
         db.session.commit()
+        notify('update', self)
 
     def delete(self):
         db.session.delete(self)
         db.session.commit()
+        notify('delete', self)
+
+    """
+    insert_many(rows)
+        inserts the rows (column dicts) in one transaction, with one
+        multi-row INSERT ... RETURNING where the database supports it, and
+        rolls it back when the database refuses them. Returns the created
+        questions, in the order of the rows.
+    """
+    @classmethod
+    def insert_many(cls, rows):
+        table = cls.__table__
+        if not rows:
+            return []
+        try:
+            if db.session().get_bind().dialect.full_returning:
+                result = db.session.execute(table.insert().values(rows).returning(*table.c))
+                created = match_returned_rows(rows, result.mappings().all())
+            else:
+                created = [dict(row, id=db.session.execute(table.insert(), row).inserted_primary_key[0])
+                           for row in rows]
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+
+        questions = []
+        for row in created:
+            question = cls(row['question'], row['answer'], row['category'], row['difficulty'])
+            question.id = row['id']
+            questions.append(question)
+        notify('insert_many', questions)
+        return questions
+
+    """
+    delete_many(ids)
+        deletes the questions with these ids in one DELETE statement and
+        one transaction. Returns the deleted questions.
+    """
+    @classmethod
+    def delete_many(cls, ids):
+        questions = cls.query.filter(cls.id.in_(ids)).all()
+        if questions:
+            cls.query.filter(cls.id.in_([question.id for question in questions])).delete(
+                synchronize_session=False)
+            # keep them readable once the commit has expired the session
+            for question in questions:
+                db.session.expunge(question)
+        db.session.commit()
+
+        for question in questions:
+            notify('delete', question)
+        return questions
 
     def format(self):
         return {
@@ -58,6 +365,69 @@ class Question(db.Model):
             'difficulty': self.difficulty
             }
 
+"""
+QUESTION_COLUMNS, format_row(row)
+    the columns of Question.format(), and the same dict built straight from
+    a result row of these columns, with no Question instance
+"""
+QUESTION_COLUMNS = (
+    Question.id, Question.question, Question.answer, Question.category, Question.difficulty)
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+def format_row(row):
+    return dict(zip(QUESTION_FIELDS, row))
+
+# a question read without the ORM, formats like a Question
+class QuestionRow(namedtuple('QuestionRow', QUESTION_FIELDS)):
+    __slots__ = ()
+
+    def format(self):
+        return self._asdict()
+
+"""
+read_questions(in_category, offset, limit, after_id, count_only)
+    read-only query layer of the list endpoints: plain SELECTs of the
+    QUESTION_COLUMNS on the questions table, ordered by id, run without
+    the ORM (no Question instances, nothing in the session identity map).
+    Returns (rows, total), the rows being QuestionRow named tuples:
+        offset/limit: one page, counted with COUNT(*) OVER () as in
+                      `page_with_total`
+        after_id:     the `limit` rows with a greater id (keyset pagination)
+    With count_only, returns the total alone from a single
+    SELECT count(*), for the endpoints that only report total_questions.
+    `in_category` narrows it all down to one category id.
+"""
+def read_questions(in_category=None, offset=0, limit=None, after_id=None, count_only=False):
+    table = Question.__table__
+    criteria = [] if in_category is None else [table.c.category_id == in_category]
+    count = select(func.count()).select_from(table).where(*criteria)
+    if count_only:
+        return db.session.execute(count).scalar()
+
+    columns = [table.c[name] for name in QUESTION_FIELDS]
+    selection = select(*columns).where(*criteria).order_by(table.c.id)
+    if after_id is not None:
+        rows = db.session.execute(selection.where(table.c.id > after_id).limit(limit))
+        return [QuestionRow._make(row) for row in rows], db.session.execute(count).scalar()
+
+    rows = db.session.execute(
+        selection.add_columns(func.count().over()).offset(offset).limit(limit)).all()
+    if not rows:
+        return [], db.session.execute(count).scalar()
+    return [QuestionRow._make(row[:-1]) for row in rows], rows[0][-1]
+
+"""
+full text search on Postgres: GIN index over the question and answer
+text, `flaskr.search.PostgresSearch` queries the very same expression
+"""
+SEARCH_DOCUMENT = "to_tsvector('english', coalesce(question, '') || ' ' || coalesce(answer, ''))"
+
+event.listen(
+    Question.__table__,
+    'after_create',
+    DDL("CREATE INDEX IF NOT EXISTS ix_questions_search ON questions USING gin ({})".format(
+        SEARCH_DOCUMENT)).execute_if(dialect='postgresql'))
+
 """
 Category
 
@@ -74,9 +444,154 @@ class Category(db.Model):
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        notify('insert', self)
         
     def format(self):
         return {
             'id': self.id,
             'type': self.type
             }
+
+"""
+QuizResult
+    the outcome of a played quiz: `score` right answers out of `total`
+    questions, in a category (None when the quiz was over every category).
+    Written in batches, see `flaskr.results`.
+"""
+class QuizResult(db.Model):
+    __tablename__ = 'quiz_results'
+    __table_args__ = (
+        # the leaderboards are loaded as the best score per category and player
+        Index('ix_quiz_results_category_id_player', 'category_id', 'player'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    player = Column(String(80), nullable=False)
+    category_id = Column(Integer, ForeignKey('categories.id'))
+    score = Column(Integer, nullable=False)
+    total = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'player': self.player,
+            'category_id': self.category_id,
+            'score': self.score,
+            'total': self.total,
+            'created_at': self.created_at.isoformat()
+            }
+
+"""
+QuestionStat
+    how often a question was served by the quizzes, answered through
+    POST /questions/<id>/answer, and answered right. The counts are added
+    to in batches, see `flaskr.stats`.
+"""
+class QuestionStat(db.Model):
+    __tablename__ = 'question_stats'
+
+    question_id = Column(Integer, ForeignKey('questions.id', ondelete='CASCADE'), primary_key=True)
+    served = Column(Integer, nullable=False, default=0)
+    answered = Column(Integer, nullable=False, default=0)
+    correct = Column(Integer, nullable=False, default=0)
+
+    def format(self):
+        return {
+            'question_id': self.question_id,
+            'served': self.served,
+            'answered': self.answered,
+            'correct': self.correct
+            }
+
+"""
+VersionCounter()
+    process local version number, bumped whenever cached data goes stale
+SharedVersionCounter(client, key)
+    the same kept in a shared store, so the bumps of one worker are seen by
+    all of them. `client` is anything with the redis-py get / incr methods
+version_counter(app, name)
+    the shared counter when the app has a CACHE_STORE, a local one otherwise
+"""
+class VersionCounter(object):
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+        # tells this process' numbers apart from another's, or a restarted one's
+        self.epoch = secrets.token_hex(4)
+
+    def get(self):
+        return self.value
+
+    def bump(self):
+        with self.lock:
+            self.value += 1
+            return self.value
+
+
+class SharedVersionCounter(object):
+
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+        self.epoch = ''
+
+    def get(self):
+        return int(self.client.get(self.key) or 0)
+
+    def bump(self):
+        return self.client.incr(self.key)
+
+
+def version_counter(app, name):
+    store = app.config.get('CACHE_STORE')
+    if store is None:
+        return VersionCounter()
+    return SharedVersionCounter(store, 'trivia:{}:version'.format(name))
+
+"""
+CategoryCache(version)
+    read-through cache of the categories, kept in memory until `version`
+    changes. Category.insert bumps it through the commit hooks.
+"""
+class CategoryCache(object):
+
+    def __init__(self, version=None):
+        self.version = version or VersionCounter()
+        self.cached = (None, None)
+
+    def listen(self, app):
+        listen(app, self.on_change)
+
+    def on_change(self, action, instance):
+        if isinstance(instance, Category):
+            self.invalidate()
+
+    def invalidate(self):
+        self.version.bump()
+
+    # [(id, type)] sorted by type
+    def items(self):
+        items = self.current()
+        if items is None:
+            version = self.version.get()
+            with primary_reads():
+                items = db.session.query(Category.id, Category.type).order_by(Category.type).all()
+            self.store(version, items)
+        return items
+
+    # the cached items while they are up to date, else None
+    def current(self):
+        cached_version, items = self.cached
+        if items is None or cached_version != self.version.get():
+            return None
+        return items
+
+    # caches the items read at `version` (read before the query)
+    def store(self, version, items):
+        self.cached = (version, items)
+
+    # {id: type}
+    def types(self):
+        return dict(self.items())
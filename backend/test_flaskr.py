@@ -1,11 +1,33 @@
+import asyncio
+import contextvars
+import logging
 import os
+import tempfile
+from contextlib import contextmanager
+from functools import partial
 from queue import Empty
+import random
+import threading
+import time
 import unittest
 import json
+from datetime import date, datetime
+from decimal import Decimal
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
+import flask
+import flask_migrate
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import IntegrityError, OperationalError
 
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import create_app, QUESTIONS_PER_PAGE
+from models import setup_db, db, Question, Category, QuizResult, QuestionStat, CategoryCache, SharedVersionCounter
+import models
+from flaskr import quiz, search, caching, replicas, serialization, metrics, ratelimit, adaptive, answers, results, stats, snapshot
+from flaskr.asgi import AsyncTriviaApp
+from flaskr.snapshot import QuestionSnapshot, SnapshotStore, load_snapshot_rows
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -271,6 +293,2646 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['deleted'])
         self.assertEqual(question,None)
 
+
+#----------------------------------------------------------------------------#
+# SQLite backed tests
+#----------------------------------------------------------------------------#
+
+# writes the buffered quiz results and question stats while the database
+# is still there, instead of at exit
+def stop_background_writes(app):
+    for name in ('trivia_quiz_results', 'trivia_question_stats'):
+        app.extensions[name].stop()
+
+
+# (status, headers, body) of a request sent to an ASGI app
+def asgi_request(asgi, method, path, json_body=None, headers=None):
+    path, _, query_string = path.partition('?')
+    body = b'' if json_body is None else json.dumps(json_body).encode()
+    headers = dict(headers or {})
+    if json_body is not None:
+        headers['Content-Type'] = 'application/json'
+        headers['Content-Length'] = str(len(body))
+    scope = {
+        'type': 'http', 'http_version': '1.1', 'scheme': 'http',
+        'method': method, 'path': path, 'raw_path': path.encode(), 'root_path': '',
+        'query_string': query_string.encode(),
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        'server': ('localhost', 80), 'client': ('127.0.0.1', 50000),
+    }
+    received = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return received.pop() if received else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    # outside of the test's app context, as under an ASGI server
+    contextvars.Context().run(asyncio.run, asgi(scope, receive, send))
+    start = sent[0]
+    return (start['status'],
+            {name.decode(): value.decode() for name, value in start['headers']},
+            b''.join(message.get('body', b'') for message in sent[1:]))
+
+
+class FakeRedis(object):
+    """A local stand-in for the redis-py client used by the shared stores"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    def incr(self, key, amount=1):
+        value = int(self.data.get(key, 0)) + amount
+        self.data[key] = str(value).encode()
+        return value
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def rpush(self, key, *values):
+        items = self.data.setdefault(key, [])
+        items.extend(str(value).encode() for value in values)
+        return len(items)
+
+    def rpop(self, key):
+        items = self.data.get(key)
+        if not items:
+            return None
+        value = items.pop()
+        if not items:
+            del self.data[key]
+        return value
+
+    def llen(self, key):
+        return len(self.data.get(key, ()))
+
+
+# `case` run again with its `setting` store backed by a FakeRedis, a fresh
+# one per test (`self.redis`); `store` wraps the client in the shared store
+def shared_store_case(case, setting, store=lambda client: client):
+    class SharedStoreCase(case):
+        def setUp(self):
+            self.redis = FakeRedis()
+            self.config = dict(case.config, **{setting: store(self.redis)})
+            super().setUp()
+
+    SharedStoreCase.__name__ = SharedStoreCase.__qualname__ = 'Shared' + case.__name__
+    SharedStoreCase.__doc__ = '{} Same tests, with {} in a shared store'.format(case.__doc__, setting)
+    return SharedStoreCase
+
+
+class SQLiteTestCase(unittest.TestCase):
+    """Runs the app against a throwaway in-memory SQLite database"""
+
+    config = {}
+    questions_per_category = 5
+
+    def setUp(self):
+        config = {'SQLALCHEMY_DATABASE_URI': 'sqlite://'}
+        config.update(self.config)
+        self.app = create_app(config)
+        self.client = self.app.test_client
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.seed()
+
+    def tearDown(self):
+        stop_background_writes(self.app)
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def seed(self):
+        categories = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+        db.session.add_all([Category(type=type) for type in categories])
+        db.session.add_all([
+            Question(
+                question='Question {} in category {}'.format(n, category_id),
+                answer='Answer {}'.format(n),
+                category=str(category_id),
+                difficulty=n % 5 + 1)
+            for category_id in range(1, len(categories) + 1)
+            for n in range(self.questions_per_category)
+        ])
+        db.session.commit()
+
+    # collects the SQL statements run inside the block
+    @contextmanager
+    def count_queries(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class PaginationTestCase(SQLiteTestCase):
+    """Tests for the SQL side pagination of the listing endpoints"""
+
+    def test_pages_are_cut_in_order(self):
+        first = json.loads(self.client().get('/questions').data)
+        second = json.loads(self.client().get('/questions?page=2').data)
+
+        self.assertEqual([q['id'] for q in first['questions']], list(range(1, 11)))
+        self.assertEqual([q['id'] for q in second['questions']], list(range(11, 21)))
+        self.assertEqual(first['total_questions'], 30)
+
+    def test_after_id_cursor(self):
+        res = self.client().get('/questions?after_id=25')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([q['id'] for q in data['questions']], list(range(26, 31)))
+        self.assertEqual(data['total_questions'], 30)
+
+    def test_after_id_past_the_end(self):
+        res = self.client().get('/questions?after_id=30')
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_invalid_page(self):
+        res = self.client().get('/questions?page=0')
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_category_total_is_counted_in_sql(self):
+        data = json.loads(self.client().get('/categories/2/questions?page=1').data)
+
+        self.assertEqual(data['total_questions'], self.questions_per_category)
+        self.assertEqual({q['category'] for q in data['questions']}, {'2'})
+
+    def test_search_is_paginated(self):
+        data = json.loads(self.client().post(
+            '/questions/search?page=2', json={'searchTerm': 'question'}).data)
+
+        self.assertEqual(data['total_questions'], 30)
+        self.assertEqual(len(data['questions']), QUESTIONS_PER_PAGE)
+        self.assertEqual(data['questions'][0]['id'], 11)
+
+class QuizSelectionTestCase(SQLiteTestCase):
+    """Tests for the random quiz question selection"""
+
+    draws = 3000
+
+    def draw_counts(self, selection, previous_questions):
+        rng = random.Random(42)
+        counts = {}
+        for _ in range(self.draws):
+            question = quiz.pick_random_question(selection, previous_questions, rng)
+            counts[question.id] = counts.get(question.id, 0) + 1
+        return counts
+
+    def assertUniform(self, counts, expected_ids, tolerance=0.15):
+        self.assertEqual(set(counts), set(expected_ids))
+        expected = self.draws / len(expected_ids)
+        for count in counts.values():
+            self.assertLess(abs(count - expected), expected * tolerance)
+
+    def test_distribution_is_uniform(self):
+        selection = Question.query.filter(Question.category == '1')
+        counts = self.draw_counts(selection, [2, 4])
+
+        self.assertUniform(counts, [1, 3, 5])
+
+    def test_distribution_with_large_exclusion_list(self):
+        previous = list(range(1000, 1000 + quiz.MAX_EXCLUDED_IN_SQL)) + [1, 2]
+        counts = self.draw_counts(Question.query.filter(Question.category == '1'), previous)
+
+        self.assertUniform(counts, [3, 4, 5])
+
+    def test_all_questions_are_reachable(self):
+        counts = self.draw_counts(Question.query, [])
+
+        self.assertUniform(counts, range(1, 31), tolerance=0.4)
+
+    def test_exhausted_category(self):
+        selection = Question.query.filter(Question.category == '1')
+
+        self.assertIsNone(quiz.pick_random_question(selection, [1, 2, 3, 4, 5]))
+
+    def test_quizz_endpoint(self):
+        res = self.client().post('/quizzes', json={
+            'quiz_category': {'type': 'Art', 'id': '2'},
+            'previous_questions': [6, 7, 8, 9],
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['id'], 10)
+
+    def test_quizz_endpoint_exhausted(self):
+        res = self.client().post('/quizzes', json={
+            'quiz_category': {'type': 'Art', 'id': 2},
+            'previous_questions': [6, 7, 8, 9, 10],
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(data['question'])
+
+class QuizSessionTestCase(SQLiteTestCase):
+    """Tests for the server side quiz sessions"""
+
+    def start(self, category):
+        res = self.client().post('/quizzes/sessions', json={'quiz_category': category})
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def draw(self, token):
+        return self.client().post('/quizzes/sessions/{}/next'.format(token))
+
+    def test_session_deals_every_question_once(self):
+        session = self.start({'type': 'Art', 'id': 2})
+        self.assertEqual(session['total_questions'], self.questions_per_category)
+
+        drawn = []
+        for remaining in reversed(range(self.questions_per_category)):
+            data = json.loads(self.draw(session['token']).data)
+            self.assertEqual(data['remaining'], remaining)
+            drawn.append(data['question']['id'])
+
+        self.assertEqual(sorted(drawn), [6, 7, 8, 9, 10])
+        self.assertIsNone(json.loads(self.draw(session['token']).data)['question'])
+
+    def test_deleted_questions_are_skipped(self):
+        session = self.start({'type': 'click', 'id': 0})
+        Question.query.filter(Question.category != '3').delete()
+        db.session.commit()
+
+        drawn = [json.loads(self.draw(session['token']).data)['question'] for _ in range(6)]
+
+        self.assertEqual({q['category'] for q in drawn if q}, {'3'})
+        self.assertEqual(sum(1 for q in drawn if q), self.questions_per_category)
+
+    def test_unknown_session(self):
+        res = self.draw('nope')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_end_session(self):
+        token = self.start({'type': 'click', 'id': 0})['token']
+
+        self.assertEqual(self.client().delete('/quizzes/sessions/' + token).status_code, 200)
+        self.assertEqual(self.draw(token).status_code, 404)
+
+    def test_start_session_error(self):
+        res = self.client().post('/quizzes/sessions', json={})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_memory_store_ttl_and_capacity(self):
+        now = [0]
+        store = quiz.MemoryQuizSessionStore(ttl=10, max_sessions=2, clock=lambda: now[0])
+        first = store.create({'deck': [1]})
+        second = store.create({'deck': [2]})
+
+        now[0] = 5
+        self.assertEqual(store.get(first), {'deck': [1]})
+        now[0] = 8
+        third = store.create({'deck': [3]})
+        # `second` was the least recently used
+        self.assertIsNone(store.get(second))
+
+        now[0] = 16
+        self.assertIsNone(store.get(first))
+        self.assertEqual(store.get(third), {'deck': [3]})
+
+    def test_shared_store(self):
+        client = FakeRedis()
+        store = quiz.SharedQuizSessionStore(client)
+        token = store.create({'deck': [1, 2, 3], 'score': 0})
+
+        state = store.get(token)
+        self.assertEqual(len(state['deck']), 3)
+        self.assertEqual(state['score'], 0)
+        self.assertEqual(quiz.draw_question(state, {2: Question.query.get(2)}.get).id, 2)
+        store.save(token, state)
+        # the deck is popped in place, never read or written whole
+        self.assertEqual(client.data['trivia:quiz:' + token + ':deck'], [b'1'])
+        self.assertEqual(json.loads(client.data['trivia:quiz:' + token]),
+                         {'deck': None, 'score': 0, 'current': 2})
+        self.assertTrue(store.delete(token))
+        self.assertIsNone(store.get(token))
+        self.assertEqual(client.data, {})
+
+
+SharedQuizSessionTestCase = shared_store_case(
+    QuizSessionTestCase, 'QUIZ_SESSION_STORE', quiz.SharedQuizSessionStore)
+
+class SearchTestCase(SQLiteTestCase):
+    """Tests for the in-process search index behind /questions/search"""
+
+    def search(self, body):
+        res = self.client().post('/questions/search', json=body)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)
+
+    def test_search_matches_answers(self):
+        data = self.search({'searchTerm': 'answer'})
+
+        self.assertEqual(data['total_questions'], 30)
+        self.assertEqual(len(data['questions']), QUESTIONS_PER_PAGE)
+
+    def test_search_ranks_question_matches_first(self):
+        Question(question='Who painted Guernica?', answer='Picasso', category='2', difficulty=2).insert()
+        Question(question='Name a cubist painter', answer='Guernica painter Picasso', category='2', difficulty=2).insert()
+
+        data = self.search({'searchTerm': 'guernica'})
+
+        self.assertEqual([q['id'] for q in data['questions']], [31, 32])
+
+    def test_search_by_prefix_and_category(self):
+        data = self.search({'searchTerm': 'quest', 'category': 4})
+
+        self.assertEqual(data['total_questions'], self.questions_per_category)
+        self.assertEqual({q['category'] for q in data['questions']}, {'4'})
+
+    def test_index_follows_inserts_and_deletes(self):
+        self.assertEqual(self.search({'searchTerm': 'France'})['total_questions'], 0)
+
+        question = Question(question='What is the capital of France ?', answer='Paris', category='3', difficulty=1)
+        question.insert()
+        self.assertEqual(self.search({'searchTerm': 'France'})['questions'][0]['id'], question.id)
+
+        question.delete()
+        self.assertEqual(self.search({'searchTerm': 'France'})['total_questions'], 0)
+
+    def test_search_without_results(self):
+        data = self.search({'searchTerm': 'lol'})
+
+        self.assertEqual(data['total_questions'], 0)
+        self.assertEqual(data['questions'], [])
+
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize("What's the CAPITAL, of France?"),
+                         ['what', 's', 'the', 'capital', 'of', 'france'])
+
+
+class LikeSearchTestCase(SQLiteTestCase):
+    """Tests for the legacy substring search backend"""
+
+    config = {'SEARCH_BACKEND': 'like'}
+
+    def test_substring_search(self):
+        data = json.loads(self.client().post(
+            '/questions/search', json={'searchTerm': 'ion 4 in category', 'category': '5'}).data)
+
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['questions'][0]['question'], 'Question 4 in category 5')
+
+class AutocompleteTestCase(SQLiteTestCase):
+    """Tests for the typeahead endpoint and its prefix index"""
+
+    def complete(self, q, limit=None):
+        url = '/questions/autocomplete?q=' + q
+        if limit:
+            url += '&limit={}'.format(limit)
+        res = self.client().get(url)
+        self.assertEqual(res.status_code, 200)
+        return json.loads(res.data)['suggestions']
+
+    def test_prefix_completion(self):
+        Question(question='Which river flows through Paris?', answer='Seine', category='3', difficulty=1).insert()
+        Question(question='Who painted the Mona Lisa?', answer='Da Vinci', category='2', difficulty=1).insert()
+
+        self.assertEqual([s['id'] for s in self.complete('pari')], [31])
+        self.assertEqual([s['id'] for s in self.complete('the mon')], [32])
+        self.assertEqual(self.complete('the pari'), [])
+
+    def test_limit_and_order(self):
+        suggestions = self.complete('que', limit=3)
+
+        self.assertEqual([s['id'] for s in suggestions], [1, 2, 3])
+        self.assertEqual(suggestions[0]['question'], 'Question 0 in category 1')
+
+    def test_index_follows_inserts_and_deletes(self):
+        self.assertEqual(self.complete('guernica'), [])
+        question = Question(question='Who painted Guernica? ' + 'x' * 100, answer='Picasso', category='2', difficulty=2)
+        question.insert()
+
+        suggestions = self.complete('guer')
+        self.assertEqual(suggestions[0]['id'], question.id)
+        self.assertTrue(suggestions[0]['question'].endswith('...'))
+
+        question.delete()
+        self.assertEqual(self.complete('guer'), [])
+
+    def test_empty_query(self):
+        self.assertEqual(self.complete(''), [])
+
+    def test_truncation_is_reported(self):
+        rows = [(id, 'Question {}'.format(id), 'Answer', 1) for id in range(1, 11)]
+        index = search.PrefixIndex(lambda: rows)
+        index.max_scan = 5
+
+        self.assertEqual(index.complete('9 quest', 3), ([], True))
+        self.assertEqual(len(index.complete('que', 3)[0]), 3)
+        self.assertEqual(index.complete('que', 3)[1], False)
+        self.assertEqual(index.complete('10', 3), ([(10, 'Question 10')], False))
+
+        data = json.loads(self.client().get('/questions/autocomplete?q=que').data)
+        self.assertFalse(data['truncated'])
+
+    def test_candidates_are_not_tokenized_again(self):
+        rows = [(id, 'Question {}'.format(id), 'Answer', 1) for id in range(1, 11)]
+        index = search.PrefixIndex(lambda: rows)
+        index.complete('que')
+        calls = []
+        tokenize = search.tokenize
+        search.tokenize = lambda text: calls.append(text) or tokenize(text)
+        try:
+            self.assertEqual(index.complete('question 1')[0], [(1, 'Question 1'), (10, 'Question 10')])
+        finally:
+            search.tokenize = tokenize
+        self.assertEqual(calls, ['question 1'])
+
+class CategoryCacheTestCase(SQLiteTestCase):
+    """Tests for the read-through category cache"""
+
+    def test_categories_are_read_once(self):
+        self.client().get('/categories')
+        with self.count_queries() as statements:
+            data = json.loads(self.client().get('/categories').data)
+            self.client().get('/categories/2/questions')
+
+        self.assertEqual(data['categories']['1'], 'Science')
+        self.assertFalse([sql for sql in statements if 'FROM categories' in sql])
+
+    def test_create_category_invalidates(self):
+        self.client().get('/categories')
+        self.client().post('/categories', json={'type': 'Music'})
+
+        data = json.loads(self.client().get('/categories').data)
+        self.assertEqual(data['categories']['7'], 'Music')
+        self.assertEqual(self.client().get('/categories/7/questions').status_code, 200)
+
+    def test_unknown_category(self):
+        res = self.client().get('/categories/7/questions')
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_shared_version_keeps_workers_coherent(self):
+        store = FakeRedis()
+        worker_one = CategoryCache(SharedVersionCounter(store, 'categories'))
+        worker_two = CategoryCache(SharedVersionCounter(store, 'categories'))
+        self.assertEqual(len(worker_one.types()), 6)
+
+        db.session.add(Category(type='Music'))
+        db.session.commit()
+        self.assertEqual(len(worker_one.types()), 6)
+
+        worker_two.invalidate()
+        self.assertEqual(worker_one.types()[7], 'Music')
+
+
+SharedCategoryCacheTestCase = shared_store_case(CategoryCacheTestCase, 'CACHE_STORE')
+
+class ConditionalRequestTestCase(SQLiteTestCase):
+    """Tests for the ETag / If-None-Match handling of the read endpoints"""
+
+    def test_etag_and_cache_control(self):
+        res = self.client().get('/questions')
+
+        self.assertTrue(res.headers['ETag'])
+        self.assertEqual(res.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(self.client().get('/categories').headers['Cache-Control'], 'public, max-age=60')
+
+    def test_not_modified_skips_the_database(self):
+        etag = self.client().get('/categories/1/questions').headers['ETag']
+
+        with self.count_queries() as statements:
+            res = self.client().get('/categories/1/questions', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(statements, [])
+
+    def test_etag_depends_on_the_url(self):
+        first = self.client().get('/questions').headers['ETag']
+        second = self.client().get('/questions?page=2').headers['ETag']
+
+        self.assertNotEqual(first, second)
+        res = self.client().get('/questions?page=2', headers={'If-None-Match': first})
+        self.assertEqual(res.status_code, 200)
+
+    def test_writes_change_the_etag(self):
+        etag = self.client().get('/questions').headers['ETag']
+        res = self.client().post('/questions', json={
+            'question': 'Q', 'answer': 'A', 'category': 1, 'difficulty': 1})
+        self.assertEqual(res.headers['Cache-Control'], 'no-store')
+
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['total_questions'], 31)
+
+    def test_errors_have_no_etag(self):
+        res = self.client().get('/questions?page=100')
+
+        self.assertEqual(res.status_code, 404)
+        self.assertNotIn('ETag', res.headers)
+
+class ResponseCacheTestCase(SQLiteTestCase):
+    """Tests for the server side response cache"""
+
+    def stats(self):
+        return json.loads(self.client().get('/stats/cache').data)['response_cache']
+
+    def test_hits_skip_the_database(self):
+        first = self.client().get('/questions?page=2')
+        with self.count_queries() as statements:
+            second = self.client().get('/questions?page=2')
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(statements, [])
+        self.assertEqual(self.stats()['hits'], 1)
+
+    def test_search_is_keyed_by_body(self):
+        france = self.client().post('/questions/search', json={'searchTerm': 'category 1'})
+        other = self.client().post('/questions/search', json={'searchTerm': 'category 2'})
+
+        self.assertNotEqual(france.data, other.data)
+        self.assertEqual(self.stats()['misses'], 2)
+
+    def test_writes_invalidate_only_affected_responses(self):
+        self.client().get('/categories/1/questions')
+        self.client().get('/categories/2/questions')
+        self.client().get('/questions')
+
+        Question(question='New', answer='A', category='2', difficulty=1).insert()
+
+        self.client().get('/categories/1/questions')
+        self.assertEqual(self.stats()['hits'], 1)
+        data = json.loads(self.client().get('/categories/2/questions').data)
+        self.assertEqual(data['total_questions'], self.questions_per_category + 1)
+        data = json.loads(self.client().get('/questions').data)
+        self.assertEqual(data['total_questions'], 31)
+
+    def test_new_category_invalidates_question_list(self):
+        self.client().get('/questions')
+        self.client().post('/categories', json={'type': 'Music'})
+
+        data = json.loads(self.client().get('/questions').data)
+        self.assertEqual(data['categories']['7'], 'Music')
+
+    def test_errors_are_not_cached(self):
+        self.client().get('/questions?page=100')
+        Question(question='New', answer='A', category='2', difficulty=1).insert()
+
+        self.assertEqual(self.stats()['entries'], 0)
+
+    def test_lru_ttl_and_memory_cap(self):
+        now = [0]
+        cache = caching.ResponseCache(max_entries=2, max_bytes=10, ttl=5, clock=lambda: now[0])
+        cache.set('a', b'1234', ['x'])
+        cache.set('b', b'1234', ['y'])
+        cache.get('a')
+        cache.set('c', b'1234', ['y'])
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1234')
+        cache.set('d', b'12345678')
+        self.assertEqual(cache.stats()['bytes'], 8)
+
+        cache.set('e', b'1', ['x'])
+        now[0] = 6
+        self.assertIsNone(cache.get('e'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['evictions'], 3)
+
+    def test_invalidate_by_tag(self):
+        cache = caching.ResponseCache()
+        cache.set('a', b'1', ['x', 'y'])
+        cache.set('b', b'2', ['y'])
+        cache.set('c', b'3', ['z'])
+        cache.invalidate('y')
+
+        self.assertEqual(cache.stats()['entries'], 1)
+        self.assertEqual(cache.get('c'), b'3')
+        self.assertEqual(cache.tags, {'z': {'c'}})
+
+    def test_writes_of_other_workers_drop_the_entries(self):
+        version = SharedVersionCounter(FakeRedis(), 'data')
+        cache = caching.ResponseCache(version=version)
+        cache.set('a', b'1', ['x'], cache.sync())
+        cache.written(version.bump())
+        self.assertEqual(cache.get('a'), b'1')
+
+        # another worker's write
+        version.bump()
+        cache.sync()
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', b'2', ['x'], cache.sync())
+        self.assertEqual(cache.get('a'), b'2')
+
+    def test_a_write_during_the_view_is_not_cached_over(self):
+        version = models.VersionCounter()
+        cache = caching.ResponseCache(version=version)
+        seen = cache.sync()
+        cache.written(version.bump())
+        cache.set('a', b'1', ['x'], seen)
+
+        self.assertIsNone(cache.get('a'))
+
+    def test_shared_store_keeps_workers_coherent(self):
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        engine = create_engine('sqlite:///' + path)
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(Category.__table__.insert(), [{'type': 'Science'}])
+            connection.execute(Question.__table__.insert(), [
+                {'question': 'Q1', 'answer': 'A', 'category': '1', 'category_id': 1, 'difficulty': 1}])
+        engine.dispose()
+        store = FakeRedis()
+        workers = [create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'CACHE_STORE': store})
+                   for _ in range(2)]
+        # the session of this test's app
+        db.session.remove()
+        try:
+            reader = workers[1].test_client()
+            self.assertEqual(json.loads(reader.get('/questions').data)['total_questions'], 1)
+            workers[0].test_client().post('/questions', json={
+                'question': 'Q2', 'answer': 'A', 'category': '1', 'difficulty': 1})
+
+            res = reader.get('/questions')
+            self.assertEqual(json.loads(res.data)['total_questions'], 2)
+            self.assertEqual(reader.get('/questions').data, res.data)
+            self.assertEqual(reader.get('/questions', headers={'If-None-Match': res.headers['ETag']}).status_code, 304)
+        finally:
+            for worker in workers:
+                stop_background_writes(worker)
+                with worker.app_context():
+                    db.session.remove()
+                    db.get_engine(worker).dispose()
+            os.remove(path)
+
+class QueryCountTestCase(SQLiteTestCase):
+    """Regression tests on the number of SQL statements run per endpoint"""
+
+    config = {'RESPONSE_CACHE_MAX_ENTRIES': 0}
+
+    def assertStatements(self, expected, method, url, body=None):
+        with self.count_queries() as statements:
+            res = getattr(self.client(), method)(url, json=body)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(statements), expected, statements)
+
+    def setUp(self):
+        super().setUp()
+        # warm the category cache and the search index
+        self.client().get('/categories')
+        self.client().post('/questions/search', json={'searchTerm': 'warm'})
+
+    def test_read_endpoints(self):
+        self.assertStatements(0, 'get', '/categories')
+        self.assertStatements(1, 'get', '/questions')
+        self.assertStatements(1, 'get', '/questions?page=3')
+        self.assertStatements(2, 'get', '/questions?after_id=3')
+        self.assertStatements(1, 'get', '/categories/1/questions')
+        self.assertStatements(1, 'post', '/questions/search', {'searchTerm': 'question'})
+        self.assertStatements(2, 'post', '/quizzes', {
+            'quiz_category': {'type': 'click', 'id': 0}, 'previous_questions': [1]})
+
+    def test_mutation_endpoints(self):
+        self.assertStatements(3, 'delete', '/questions/5')
+        self.assertStatements(2, 'post', '/questions', {
+            'question': 'Q', 'answer': 'A', 'category': 1, 'difficulty': 1})
+        self.assertStatements(2, 'post', '/categories', {'type': 'Music'})
+
+    def test_count_past_the_last_page(self):
+        data = json.loads(self.client().get('/categories/1/questions?page=3').data)
+
+        self.assertEqual(data['questions'], [])
+        self.assertEqual(data['total_questions'], self.questions_per_category)
+
+class MigrationTestCase(unittest.TestCase):
+    """Tests for the migrations, run on a SQLite file"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.uri = 'sqlite:///' + self.path
+
+    def tearDown(self):
+        db.session.remove()
+        os.remove(self.path)
+
+    def test_upgrade_backfills_a_trivia_dump(self):
+        engine = create_engine(self.uri)
+        with engine.begin() as connection:
+            # the tables as created by trivia.psql
+            connection.exec_driver_sql('CREATE TABLE categories (id integer NOT NULL PRIMARY KEY, type text)')
+            connection.exec_driver_sql(
+                'CREATE TABLE questions (id integer NOT NULL PRIMARY KEY, question text, '
+                'answer text, difficulty integer, category text)')
+            connection.exec_driver_sql("INSERT INTO categories VALUES (1, 'Science'), (2, 'Art')")
+            connection.exec_driver_sql(
+                "INSERT INTO questions VALUES (1, 'q', 'a', 1, '1'), (2, 'q', 'a', 1, '2'), "
+                "(3, 'q', 'a', 1, '9'), (4, 'q', 'a', 1, 'art'), (5, 'q', 'a', 1, NULL)")
+        engine.dispose()
+
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.uri})
+        with app.app_context():
+            flask_migrate.stamp(revision='0001_initial')
+            flask_migrate.upgrade()
+
+            rows = db.session.execute('SELECT id, category_id FROM questions ORDER BY id').fetchall()
+            self.assertEqual([tuple(row) for row in rows], [(1, 1), (2, 2), (3, None), (4, None), (5, None)])
+            indexes = inspect(db.engine).get_indexes('questions')
+            self.assertIn(['category_id', 'id'], [index['column_names'] for index in indexes])
+
+            flask_migrate.downgrade(revision='0001_initial')
+            columns = [column['name'] for column in inspect(db.engine).get_columns('questions')]
+            self.assertNotIn('category_id', columns)
+
+    def test_migrations_match_the_models(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.uri})
+        with app.app_context():
+            db.drop_all()
+            flask_migrate.upgrade()
+            with db.engine.connect() as connection:
+                context = MigrationContext.configure(connection)
+                self.assertEqual(compare_metadata(context, db.metadata), [])
+
+class BulkTestCase(SQLiteTestCase):
+    """Tests for the bulk import and export of questions"""
+
+    config = {'IMPORT_BATCH_SIZE': 2}
+
+    def test_import_ndjson(self):
+        body = '\n'.join([
+            json.dumps({'question': 'Q1', 'answer': 'A1', 'category': 1, 'difficulty': 2}),
+            '',
+            json.dumps({'question': 'Q2', 'answer': 'A2', 'category': '2', 'difficulty': '3'}),
+            'not json',
+            json.dumps({'question': 'Q3', 'answer': 'A3', 'category': 3}),
+            json.dumps({'question': '', 'answer': 'A4'}),
+        ])
+        res = self.client().post('/questions/import', data=body, content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 3)
+        self.assertEqual(data['batches'], 2)
+        self.assertEqual([error['line'] for error in data['errors']], [4, 6])
+        question = Question.query.filter(Question.question == 'Q2').one()
+        self.assertEqual((question.category, question.category_id, question.difficulty), ('2', 2, 3))
+
+    def test_import_csv(self):
+        body = 'question,answer,category,difficulty\n"Q, one",A1,4,1\nQ2,A2,5,x\n'
+        res = self.client().post('/questions/import', data=body, content_type='text/csv')
+        data = json.loads(res.data)
+
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['errors'], [{'line': 3, 'message': 'difficulty must be an integer'}])
+        self.assertEqual(Question.query.filter(Question.category_id == 4).count(), self.questions_per_category + 1)
+
+    def test_import_unknown_category(self):
+        body = '\n'.join(json.dumps({'question': 'Q', 'answer': 'A', 'category': category})
+                         for category in (1, 99, 'Science', None))
+        data = json.loads(self.client().post('/questions/import', data=body).data)
+
+        self.assertEqual(data['imported'], 3)
+        self.assertEqual(data['errors'], [{'line': 2, 'message': 'unknown category'}])
+
+    def test_import_values_of_the_wrong_type(self):
+        body = '\n'.join(json.dumps(record) for record in (
+            {'question': 'Q1', 'answer': 'A1', 'category': 1},
+            {'question': 123, 'answer': 'A2'},
+            {'question': 'Q3', 'answer': ['x']},
+            {'question': 'Q4', 'answer': 'A4', 'category': {'id': 1}},
+            ['not', 'an', 'object'],
+            {'question': 'Q6', 'answer': 'A6', 'category': 2},
+        ))
+        res = self.client().post('/questions/import', data=body)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(data['errors'], [
+            {'line': 2, 'message': 'question and answer must be strings'},
+            {'line': 3, 'message': 'question and answer must be strings'},
+            {'line': 4, 'message': 'category must be a string or an integer'},
+            {'line': 5, 'message': 'not a JSON object'},
+        ])
+
+    def test_import_resets_the_caches_once(self):
+        actions = []
+        models.listen(self.app, lambda action, instance: actions.append(action))
+        body = '\n'.join(json.dumps({'question': 'Q{}'.format(n), 'answer': 'A', 'category': 1})
+                         for n in range(5))
+        data = json.loads(self.client().post('/questions/import', data=body).data)
+
+        self.assertEqual(data['batches'], 3)
+        self.assertEqual(actions, ['reset'])
+
+    def test_refused_batch_is_reported(self):
+        inserts = []
+        def refuse_first_insert(conn, cursor, statement, *args):
+            if statement.startswith('INSERT INTO questions'):
+                inserts.append(statement)
+                if len(inserts) == 1:
+                    raise IntegrityError(statement, {}, Exception('FOREIGN KEY constraint failed'))
+        event.listen(db.engine, 'before_cursor_execute', refuse_first_insert)
+        try:
+            body = '\n'.join(json.dumps({'question': 'Q{}'.format(n), 'answer': 'A', 'category': 1})
+                             for n in range(3))
+            res = self.client().post('/questions/import', data=body)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', refuse_first_insert)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((data['imported'], data['batches'], data['error_count']), (1, 1, 2))
+        self.assertEqual([error['line'] for error in data['errors']], [1, 2])
+        self.assertEqual([question.question for question in Question.query.filter(Question.id > 30)], ['Q2'])
+
+    def test_imported_questions_are_searchable(self):
+        self.client().post('/questions/search', json={'searchTerm': 'warm'})
+        self.client().post('/questions/import', data=json.dumps(
+            {'question': 'Who wrote Hamlet?', 'answer': 'Shakespeare', 'category': 4}))
+
+        data = json.loads(self.client().post('/questions/search', json={'searchTerm': 'hamlet'}).data)
+        self.assertEqual(data['total_questions'], 1)
+
+    def test_export_streams_every_question(self):
+        res = self.client().get('/questions/export')
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), 30)
+        self.assertEqual(json.loads(lines[0]), Question.query.get(1).format())
+
+    def test_cli_round_trip(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'questions.ndjson')
+        runner = self.app.test_cli_runner()
+
+        result = runner.invoke(args=['questions', 'export', path])
+        self.assertEqual(result.exit_code, 0)
+        result = runner.invoke(args=['questions', 'import', path, '--batch-size', '7'])
+
+        self.assertIn('imported 30 questions in 5 batches, 0 errors', result.output)
+        self.assertEqual(Question.query.count(), 60)
+        os.remove(path)
+        os.rmdir(directory)
+
+class BatchTestCase(SQLiteTestCase):
+    """Tests for the batch create and delete endpoints"""
+
+    def test_batch_delete(self):
+        with self.count_queries() as statements:
+            res = self.client().delete('/questions', json={'ids': [3, 5, 3, 99]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], [3, 5])
+        self.assertEqual(data['not_found'], [99])
+        self.assertEqual(data['total_questions'], 28)
+        self.assertEqual(len([sql for sql in statements if sql.startswith('DELETE')]), 1)
+        self.assertEqual(len(statements), 3)
+
+    def test_batch_delete_updates_the_index(self):
+        self.client().post('/questions/search', json={'searchTerm': 'warm'})
+        self.client().delete('/questions', json={'ids': list(range(1, 6))})
+
+        data = json.loads(self.client().post(
+            '/questions/search', json={'searchTerm': 'question', 'category': 1}).data)
+        self.assertEqual(data['total_questions'], 0)
+
+    def test_batch_delete_errors(self):
+        self.assertEqual(self.client().delete('/questions', json={'ids': []}).status_code, 400)
+        self.assertEqual(self.client().delete('/questions', json={'ids': ['x']}).status_code, 400)
+        self.assertEqual(self.client().delete('/questions', json={}).status_code, 400)
+
+    def test_batch_create(self):
+        res = self.client().post('/questions/batch', json={'questions': [
+            {'question': 'Q1', 'answer': 'A1', 'category': 1, 'difficulty': 1},
+            {'question': 'Q2'},
+            'nope',
+            {'question': 'Q3', 'answer': 'A3', 'category': '2', 'difficulty': 5},
+        ]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], [31, 32])
+        self.assertEqual([result.get('created') for result in data['results']], [31, None, None, 32])
+        self.assertEqual(data['results'][1]['error'], 'question and answer are required')
+        self.assertEqual(data['total_questions'], 32)
+        self.assertEqual(Question.query.get(32).category_id, 2)
+
+    def test_batch_create_values_of_the_wrong_type(self):
+        res = self.client().post('/questions/batch', json={'questions': [
+            {'question': 123, 'answer': 'A1'},
+            {'question': 'Q2', 'answer': ['x']},
+            {'question': 'Q3', 'answer': 'A3', 'category': 1},
+        ]})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['results'], [
+            {'index': 0, 'error': 'question and answer must be strings'},
+            {'index': 1, 'error': 'question and answer must be strings'},
+            {'index': 2, 'created': 31},
+        ])
+
+    def test_batch_create_is_one_transaction(self):
+        commits = []
+        event.listen(db.engine, 'commit', lambda connection: commits.append(1))
+        self.client().post('/questions/batch', json={'questions': [
+            {'question': 'Q', 'answer': 'A', 'category': 1, 'difficulty': 1}] * 20})
+
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(Question.query.count(), 50)
+
+    def test_batch_create_checks_the_categories(self):
+        res = self.client().post('/questions/batch', json={'questions': [
+            {'question': 'Q1', 'answer': 'A1', 'category': 99},
+            {'question': 'Q2', 'answer': 'A2', 'category': 1},
+        ]})
+        data = json.loads(res.data)
+
+        self.assertEqual(data['results'], [{'index': 0, 'error': 'unknown category'}, {'index': 1, 'created': 31}])
+
+    def test_batch_create_refused_by_the_database(self):
+        def refuse(conn, cursor, statement, *args):
+            if statement.startswith('INSERT INTO questions'):
+                raise IntegrityError(statement, {}, Exception('FOREIGN KEY constraint failed'))
+        event.listen(db.engine, 'before_cursor_execute', refuse)
+        try:
+            res = self.client().post('/questions/batch', json={'questions': [
+                {'question': 'Q', 'answer': 'A', 'category': 1}] * 3})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', refuse)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(Question.query.count(), 30)
+
+    def test_batch_create_notifies_once(self):
+        changes = []
+        models.listen(self.app, lambda action, instance: changes.append((action, instance)))
+        self.client().post('/questions/batch', json={'questions': [
+            {'question': 'Q', 'answer': 'A', 'category': 1}] * 5})
+
+        self.assertEqual([action for action, _ in changes], ['insert_many'])
+        self.assertEqual([question.id for question in changes[0][1]], [31, 32, 33, 34, 35])
+
+    def test_returned_rows_are_matched_to_the_inserted_ones(self):
+        rows = [{'question': 'Q{}'.format(n % 3), 'answer': 'A'} for n in range(6)]
+        returned = [dict(row, id=id) for id, row in enumerate(rows, 1)]
+        random.Random(4).shuffle(returned)
+
+        matched = models.match_returned_rows(rows, returned)
+        self.assertEqual([row['question'] for row in matched], [row['question'] for row in rows])
+        self.assertEqual(sorted(row['id'] for row in matched), list(range(1, 7)))
+
+    def test_batch_create_errors(self):
+        self.assertEqual(self.client().post('/questions/batch', json={'questions': {}}).status_code, 400)
+        self.assertEqual(self.client().post('/questions/batch', json={'questions': []}).status_code, 400)
+
+class DatabaseSetupTestCase(unittest.TestCase):
+    """Tests for the engine and pool settings of setup_db"""
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_tables_are_only_created_on_request(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        with app.app_context():
+            self.assertEqual(inspect(db.engine).get_table_names(), [])
+
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'DB_CREATE_ALL': True})
+        with app.app_context():
+            self.assertIn('questions', inspect(db.engine).get_table_names())
+
+    def test_pool_settings(self):
+        os.environ['DB_POOL_SIZE'] = '3'
+        try:
+            app = create_app({
+                'SQLALCHEMY_DATABASE_URI': 'postgresql://postgres@localhost/trivia_test',
+                'DB_MAX_OVERFLOW': 2,
+                'DB_POOL_RECYCLE': '1800',
+                'DB_STATEMENT_TIMEOUT': 5000,
+            })
+        finally:
+            del os.environ['DB_POOL_SIZE']
+        options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['max_overflow'], 2)
+        self.assertEqual(options['pool_recycle'], 1800)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=5000'})
+        with app.app_context():
+            self.assertEqual(models.pool_stats()['size'], 3)
+
+    def test_pool_stats(self):
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        engine = create_engine('sqlite:///' + path, poolclass=models.TimedQueuePool, pool_size=1, max_overflow=0)
+        connection = engine.connect()
+
+        stats = models.pool_stats(engine)
+        self.assertEqual((stats['checked_out'], stats['overflow'], stats['checkouts']), (1, 0, 1))
+        self.assertGreaterEqual(stats['wait_seconds_total'], 0)
+
+        connection.close()
+        self.assertEqual(models.pool_stats(engine)['checked_in'], 1)
+        engine.dispose()
+        os.remove(path)
+
+    def test_pool_stats_endpoint(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        data = json.loads(app.test_client().get('/stats/pool').data)
+
+        self.assertEqual(data['pool']['class'], 'StaticPool')
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """Tests for the routing of read-only requests to a replica"""
+
+    def setUp(self):
+        self.paths = []
+        primary = self.database('Primary question')
+        replica = self.database('Replica question')
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': primary,
+            'SQLALCHEMY_REPLICA_URIS': [replica],
+            'RESPONSE_CACHE_MAX_ENTRIES': 0,
+        })
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        stop_background_writes(self.app)
+        with self.app.app_context():
+            db.session.remove()
+            for bind in (None, 'replica_0'):
+                db.get_engine(self.app, bind).dispose()
+        for path in self.paths:
+            os.remove(path)
+
+    # a SQLite file holding one question
+    def database(self, text):
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.paths.append(path)
+        engine = create_engine('sqlite:///' + path)
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(Category.__table__.insert(), [{'type': 'Science'}])
+            connection.execute(Question.__table__.insert(), [
+                {'question': text, 'answer': 'Answer', 'category': '1', 'category_id': 1, 'difficulty': 1}])
+        engine.dispose()
+        return 'sqlite:///' + path
+
+    def questions(self, client_id):
+        res = self.client().get('/questions', headers={'X-Client-Id': client_id})
+        return [question['question'] for question in json.loads(res.data)['questions']]
+
+    def test_reads_use_the_replica(self):
+        self.assertEqual(self.questions('a'), ['Replica question'])
+
+        res = self.client().post('/quizzes', json={'previous_questions': [], 'quiz_category': {'type': 'click', 'id': 0}})
+        self.assertEqual(json.loads(res.data)['question']['question'], 'Replica question')
+
+    def test_writes_use_the_primary_and_stick_to_it(self):
+        res = self.client().post('/questions', headers={'X-Client-Id': 'a'}, json={
+            'question': 'New question', 'answer': 'New answer', 'category': '1', 'difficulty': 1})
+        self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(self.questions('a'), ['Primary question', 'New question'])
+        self.assertEqual(self.questions('b'), ['Replica question'])
+
+    def test_read_only_posts_do_not_stick(self):
+        for _ in range(3):
+            res = self.client().post('/quizzes', headers={'X-Client-Id': 'a'}, json={
+                'previous_questions': [], 'quiz_category': {'type': 'click', 'id': 0}})
+            self.assertEqual(json.loads(res.data)['question']['question'], 'Replica question')
+
+        self.client().post('/questions/search', headers={'X-Client-Id': 'a'}, json={'searchTerm': 'question'})
+        self.assertEqual(self.questions('a'), ['Replica question'])
+
+    def test_version_keyed_caches_load_from_the_primary(self):
+        res = self.client().post('/categories', headers={'X-Client-Id': 'a'}, json={'type': 'Music'})
+        self.assertEqual(res.status_code, 200)
+
+        # a client still reading from the (lagging) replica reloads the cache
+        res = self.client().get('/categories', headers={'X-Client-Id': 'b'})
+        self.assertEqual(json.loads(res.data)['categories']['2'], 'Music')
+        res = self.client().get('/categories/2/questions', headers={'X-Client-Id': 'b'})
+        self.assertEqual(res.status_code, 200)
+
+    def test_snapshot_and_buckets_load_from_the_primary(self):
+        engine = create_engine('sqlite:///' + self.paths[0])
+        with engine.begin() as connection:
+            connection.execute(Question.__table__.insert(), [
+                {'question': 'Second question', 'answer': 'Answer', 'category': '1', 'category_id': 1, 'difficulty': 1}])
+        engine.dispose()
+
+        with self.app.test_request_context('/questions'):
+            flask.g.use_replica = True
+            self.assertEqual(Question.query.one().question, 'Replica question')
+
+            self.assertEqual(SnapshotStore().get().questions, ['Primary question', 'Second question'])
+            self.assertEqual(adaptive.DifficultyBuckets().counts()[1], 2)
+            self.assertEqual(Question.query.one().question, 'Replica question')
+
+    def test_failed_writes_do_not_stick(self):
+        self.client().delete('/questions/1000', headers={'X-Client-Id': 'a'})
+
+        self.assertEqual(self.questions('a'), ['Replica question'])
+
+    def test_shared_stickiness(self):
+        store = replicas.SharedStickyWrites(FakeRedis())
+        workers = [create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.paths[0],
+            'SQLALCHEMY_REPLICA_URIS': ['sqlite:///' + self.paths[1]],
+            'RESPONSE_CACHE_MAX_ENTRIES': 0,
+            'REPLICA_STICKY_STORE': store,
+        }) for _ in range(2)]
+        try:
+            res = workers[0].test_client().post('/questions', headers={'X-Client-Id': 'a'}, json={
+                'question': 'New question', 'answer': 'New answer', 'category': '1', 'difficulty': 1})
+            self.assertEqual(res.status_code, 200)
+
+            # the other worker sends the client to the primary too
+            for client_id, expected in (('a', 'Primary question'), ('b', 'Replica question')):
+                res = workers[1].test_client().get('/questions', headers={'X-Client-Id': client_id})
+                self.assertEqual(json.loads(res.data)['questions'][0]['question'], expected)
+        finally:
+            for worker in workers:
+                stop_background_writes(worker)
+                with worker.app_context():
+                    db.session.remove()
+                    for bind in (None, 'replica_0'):
+                        db.get_engine(worker, bind).dispose()
+
+    def test_async_reads_use_the_replica(self):
+        asgi = AsyncTriviaApp(self.app)
+        try:
+            transport = partial(asgi_request, asgi)
+            headers = {'X-Client-Id': 'a'}
+            status, _, body = transport('GET', '/questions', headers=headers)
+            self.assertEqual(json.loads(body)['questions'][0]['question'], 'Replica question')
+
+            # the write goes to the Flask app, the next reads to the primary
+            status, _, body = transport('DELETE', '/questions/1', headers=headers)
+            self.assertEqual(status, 200)
+            status, _, body = transport('POST', '/quizzes', {
+                'previous_questions': [], 'quiz_category': {'type': 'click', 'id': 0}}, headers=headers)
+            self.assertIsNone(json.loads(body)['question'])
+            status, _, body = transport('POST', '/quizzes', {
+                'previous_questions': [], 'quiz_category': {'type': 'click', 'id': 0}})
+            self.assertEqual(json.loads(body)['question']['question'], 'Replica question')
+        finally:
+            asyncio.run(asgi.dispose())
+
+    def test_stickiness_expires(self):
+        now = [0.0]
+        sticky = replicas.StickyWrites(window=5, clock=lambda: now[0])
+        sticky.record('a')
+
+        self.assertTrue(sticky.is_recent('a'))
+        self.assertFalse(sticky.is_recent('b'))
+        now[0] = 5.0
+        self.assertFalse(sticky.is_recent('a'))
+
+
+class AsyncAppTestCase(SQLiteTestCase):
+    """Tests for the ASGI app serving the read endpoints with an async engine"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.config = {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.path,
+            'SEARCH_BACKEND': 'like',
+        }
+        super().setUp()
+        self.asgi = AsyncTriviaApp(self.app)
+
+    def tearDown(self):
+        asyncio.run(self.asgi.dispose())
+        super().tearDown()
+        db.get_engine(self.app).dispose()
+        os.remove(self.path)
+
+    def asgi_request(self, method, path, json_body=None, headers=None):
+        return asgi_request(self.asgi, method, path, json_body, headers)
+
+    def assertSameResponse(self, method, path, json_body=None):
+        status, headers, body = self.asgi_request(method, path, json_body)
+        res = self.client().open(path, method=method, json=json_body)
+
+        self.assertEqual((status, body), (res.status_code, res.data))
+        self.assertEqual(headers.get('cache-control'), res.headers.get('Cache-Control'))
+        self.assertEqual(headers.get('etag'), res.headers.get('ETag'))
+
+    def test_read_endpoints_match_the_flask_responses(self):
+        self.assertSameResponse('GET', '/categories')
+        self.assertSameResponse('GET', '/questions')
+        self.assertSameResponse('GET', '/questions?page=3')
+        self.assertSameResponse('GET', '/questions?after_id=25')
+        self.assertSameResponse('GET', '/questions?page=0')
+        self.assertSameResponse('GET', '/categories/2/questions')
+        self.assertSameResponse('POST', '/questions/search', {'searchTerm': 'category 3'})
+        self.assertSameResponse('POST', '/questions/search?page=2', {'searchTerm': 'question'})
+        self.assertSameResponse('POST', '/questions/search', {'searchTerm': 'answer', 'category': 4})
+        self.assertSameResponse('POST', '/quizzes', {
+            'previous_questions': [1, 2, 3, 4], 'quiz_category': {'type': 'Science', 'id': 1}})
+        self.assertSameResponse('POST', '/quizzes', {
+            'previous_questions': [1, 2, 3, 4, 5], 'quiz_category': {'type': 'Science', 'id': 1}})
+
+    def test_read_endpoints_do_not_use_the_flask_app(self):
+        async def wsgi(scope, receive, send):
+            raise AssertionError('{} went to the Flask app'.format(scope['path']))
+        self.asgi.wsgi = wsgi
+
+        for method, path, body in (
+                ('GET', '/categories', None),
+                ('GET', '/questions?page=2', None),
+                ('GET', '/categories/3/questions', None),
+                ('POST', '/questions/search', {'searchTerm': 'question'}),
+                ('POST', '/quizzes', {'previous_questions': [], 'quiz_category': {'type': 'click', 'id': 0}})):
+            self.assertEqual(self.asgi_request(method, path, body)[0], 200)
+
+    def test_errors_come_from_the_flask_app(self):
+        self.assertSameResponse('GET', '/questions?page=100')
+        self.assertSameResponse('GET', '/categories/100/questions')
+        self.assertSameResponse('POST', '/quizzes', {'previous_questions': []})
+
+    def test_other_endpoints_go_to_the_flask_app(self):
+        status, headers, body = self.asgi_request('DELETE', '/questions/1')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['deleted'], 1)
+        status, headers, body = self.asgi_request('GET', '/questions?after_id=0')
+        self.assertEqual(json.loads(body)['total_questions'], 29)
+
+    def test_flask_requests_run_on_a_pool_of_threads(self):
+        threads = []
+        def slow():
+            threads.append(threading.get_ident())
+            time.sleep(0.2)
+            return {'success': True}
+        self.app.add_url_rule('/slow', 'slow', slow)
+
+        started = time.perf_counter()
+        requests = [threading.Thread(target=self.asgi_request, args=('GET', '/slow')) for _ in range(4)]
+        for request in requests:
+            request.start()
+        for request in requests:
+            request.join()
+
+        self.assertEqual(len(set(threads)), 4)
+        self.assertLess(time.perf_counter() - started, 0.6)
+
+    def test_async_engine_uses_the_pool_settings(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.path, 'DB_POOL_RECYCLE': 30})
+        asgi = AsyncTriviaApp(app)
+        try:
+            self.assertEqual(asgi.engine.pool._recycle, 30)
+            self.assertTrue(asgi.engine.pool._pre_ping)
+        finally:
+            asyncio.run(asgi.dispose())
+            stop_background_writes(app)
+
+    def test_limited_endpoints_go_to_the_flask_app(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.path, 'SEARCH_BACKEND': 'like',
+                          'RATE_LIMIT_PER_SECOND': 0.001, 'RATE_LIMIT_BURST': 1})
+        self.asgi = AsyncTriviaApp(app, self.asgi.engine)
+        quiz = {'previous_questions': [], 'quiz_category': {'type': 'click', 'id': 0}}
+
+        self.assertEqual(self.asgi_request('POST', '/quizzes', quiz)[0], 200)
+        status, headers, body = self.asgi_request('POST', '/quizzes', quiz)
+        self.assertEqual(status, 429)
+        self.assertIn('retry-after', headers)
+        self.assertEqual(self.asgi_request('POST', '/questions/search', {'searchTerm': 'question'})[0], 429)
+        # the other reads are still served by the async views
+        self.assertEqual(self.asgi_request('GET', '/questions')[0], 200)
+        stop_background_writes(app)
+        with app.app_context():
+            db.get_engine(app).dispose()
+
+    def test_shares_the_flask_caches(self):
+        cache = self.app.extensions['trivia_response_cache']
+        self.assertEqual(self.asgi_request('GET', '/questions?page=2')[0], 200)
+        self.assertEqual(self.client().get('/questions?page=2').status_code, 200)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.asgi_request('GET', '/questions?page=2')
+        self.assertEqual(cache.stats()['hits'], 2)
+
+        # the categories were cached by the first request, for both apps
+        metrics = self.app.extensions['trivia_metrics']
+        self.client().get('/categories')
+        self.asgi_request('GET', '/categories')
+        self.assertEqual(metrics.statements.get('get_categories')[1:], (0, 2))
+
+    def test_metrics_and_served_questions(self):
+        metrics = self.app.extensions['trivia_metrics']
+        status, headers, body = self.asgi_request('POST', '/quizzes', {
+            'previous_questions': [1, 2, 3, 4], 'quiz_category': {'type': 'Science', 'id': 1}})
+
+        self.assertEqual(metrics.latency.get('play_quizz', 'POST', '200')[2], 1)
+        self.assertEqual(metrics.statements.get('play_quizz')[1], 2)
+        self.assertEqual(metrics.response_size.get('play_quizz')[1], len(body))
+        self.assertEqual(self.app.extensions['trivia_question_stats'].pending(), {5: (1, 0, 0)})
+
+    def test_snapshot_mode_goes_to_the_flask_app(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.path, 'QUESTION_SNAPSHOT': True})
+        self.asgi = AsyncTriviaApp(app, self.asgi.engine)
+        served = []
+        wsgi = self.asgi.wsgi
+        async def to_flask(scope, receive, send):
+            served.append(scope['path'])
+            await wsgi(scope, receive, send)
+        self.asgi.wsgi = to_flask
+
+        self.assertEqual(self.asgi_request('GET', '/questions')[0], 200)
+        self.assertEqual(served, ['/questions'])
+        with app.app_context():
+            db.get_engine(app).dispose()
+
+    def test_random_quiz_question(self):
+        status, headers, body = self.asgi_request('POST', '/quizzes', {
+            'previous_questions': [1], 'quiz_category': {'type': 'click', 'id': 0}})
+
+        question = json.loads(body)['question']
+        self.assertEqual(status, 200)
+        self.assertNotEqual(question['id'], 1)
+        self.assertEqual(set(question), {'id', 'question', 'category', 'difficulty'})
+
+        # refused by the Flask view
+        status, _, _ = self.asgi_request('POST', '/quizzes', {
+            'previous_questions': [[1]], 'quiz_category': {'type': 'click', 'id': 0}})
+        self.assertEqual(status, 400)
+
+    def test_not_modified(self):
+        status, headers, body = self.asgi_request('GET', '/categories')
+        status, headers, body = self.asgi_request(
+            'GET', '/categories', headers={'If-None-Match': headers['etag']})
+
+        self.assertEqual((status, body), (304, b''))
+
+
+class SnapshotTestCase(SQLiteTestCase):
+    """Tests for serving the questions from the in-memory snapshot"""
+
+    config = {'QUESTION_SNAPSHOT': True, 'RESPONSE_CACHE_MAX_ENTRIES': 0}
+
+    def get(self, path):
+        return json.loads(self.client().get(path).data)
+
+    def test_rows_format_like_questions(self):
+        snapshot = QuestionSnapshot(load_snapshot_rows())
+
+        self.assertEqual(len(snapshot), 30)
+        for question in Question.query:
+            self.assertEqual(snapshot.get(question.id).format(), question.format())
+        self.assertIsNone(snapshot.get(1000))
+
+    def test_question_pages(self):
+        data = self.get('/questions?page=2')
+        self.assertEqual([question['id'] for question in data['questions']], list(range(11, 21)))
+        self.assertEqual(data['total_questions'], 30)
+        self.assertEqual(data['questions'][0], Question.query.get(11).format())
+
+        data = self.get('/questions?after_id=25')
+        self.assertEqual([question['id'] for question in data['questions']], list(range(26, 31)))
+
+        data = self.get('/categories/3/questions?page=1')
+        self.assertEqual([question['id'] for question in data['questions']], list(range(11, 16)))
+        self.assertEqual(data['total_questions'], 5)
+
+        data = self.get('/categories/3/questions?after_id=13')
+        self.assertEqual([question['id'] for question in data['questions']], [14, 15])
+
+        self.assertEqual(self.client().get('/questions?page=4').status_code, 404)
+
+    def test_quiz_draws_skip_previous_questions(self):
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [1, 2, 3, 4], 'quiz_category': {'type': 'Science', 'id': 1}})
+        self.assertEqual(json.loads(res.data)['question']['id'], 5)
+
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [1, 2, 3, 4, 5], 'quiz_category': {'type': 'Science', 'id': 1}})
+        self.assertIsNone(json.loads(res.data)['question'])
+
+        res = self.client().post('/quizzes', json={'previous_questions': []})
+        self.assertEqual(res.status_code, 400)
+        for previous in ([[1]], [{'id': 1}], ['1'], 5, {'1': 1}):
+            res = self.client().post('/quizzes', json={
+                'previous_questions': previous, 'quiz_category': {'type': 'Science', 'id': 1}})
+            self.assertEqual(res.status_code, 400, previous)
+
+    def test_pick_random_covers_the_remaining_questions(self):
+        snapshot = QuestionSnapshot(load_snapshot_rows())
+        rng = random.Random(1)
+
+        drawn = {snapshot.pick_random(2, [6, 8, 1000], rng).id for _ in range(200)}
+        self.assertEqual(drawn, {7, 9, 10})
+        drawn = {snapshot.pick_random(None, range(2, 30), rng).id for _ in range(100)}
+        self.assertEqual(drawn, {1, 30})
+
+    def test_quiz_sessions(self):
+        token = json.loads(self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'Art', 'id': 2}}).data)['token']
+
+        drawn = [json.loads(self.client().post('/quizzes/sessions/{}/next'.format(token)).data)['question']['id']
+                 for _ in range(5)]
+        self.assertEqual(sorted(drawn), [6, 7, 8, 9, 10])
+
+    def test_writes_refresh_the_snapshot(self):
+        self.assertEqual(self.get('/questions')['total_questions'], 30)
+
+        self.client().post('/questions', json={
+            'question': 'New', 'answer': 'Answer', 'category': '1', 'difficulty': 1})
+        self.client().delete('/questions/2')
+
+        data = self.get('/categories/1/questions')
+        self.assertEqual([question['id'] for question in data['questions']], [1, 3, 4, 5, 31])
+
+    def test_snapshot_max_age(self):
+        now = [0]
+        loads = []
+        def loader():
+            loads.append(now[0])
+            return load_snapshot_rows()
+        store = SnapshotStore(loader, max_age=60, clock=lambda: now[0])
+
+        store.get()
+        now[0] = 30
+        store.get()
+        now[0] = 61
+        store.get()
+        self.assertEqual(loads, [0, 61])
+
+    def test_writes_of_other_workers_reload_it(self):
+        version = SharedVersionCounter(FakeRedis(), 'data')
+        loads = []
+        def loader():
+            loads.append(version.get())
+            return [(1, 'Q', 'A', '1', 1, 1)]
+        store = SnapshotStore(loader, version=version)
+
+        store.get()
+        store.get()
+        version.bump()
+        store.get()
+        self.assertEqual(loads, [0, 1])
+
+    def test_snapshots_age_by_default(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'QUESTION_SNAPSHOT': True})
+        self.assertEqual(app.extensions['trivia_snapshots'].max_age, snapshot.SNAPSHOT_MAX_AGE)
+
+    def test_one_load_at_a_time(self):
+        loading, release = threading.Event(), threading.Event()
+        loads = []
+        def loader():
+            loads.append(None)
+            loading.set()
+            release.wait(5)
+            return [(1, 'Q', 'A', '1', 1, 1)]
+        store = SnapshotStore(loader)
+
+        readers = [threading.Thread(target=store.get) for _ in range(3)]
+        readers[0].start()
+        self.assertTrue(loading.wait(5))
+        for reader in readers[1:]:
+            reader.start()
+        release.set()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(len(loads), 1)
+
+    def test_write_during_a_load(self):
+        def loader():
+            # committed once the rows were read
+            store.invalidate()
+            return [(1, 'Q', 'A', '1', 1, 1)]
+        store = SnapshotStore(loader)
+
+        self.assertEqual(len(store.get()), 1)
+        # not kept, the next reader loads the write
+        self.assertIsNone(store.snapshot)
+        store.loader = lambda: []
+        self.assertEqual(len(store.get()), 0)
+
+
+@unittest.skipIf(serialization.orjson is None, 'orjson is not installed')
+class JSONProviderTestCase(SQLiteTestCase):
+    """Tests for the orjson JSON provider"""
+
+    config = {'RESPONSE_CACHE_MAX_ENTRIES': 0}
+
+    def assertSameJSON(self, data):
+        fast = serialization.OrjsonProvider(self.app)
+        stdlib = DefaultJSONProvider(self.app)
+
+        self.assertEqual(fast.response(data).get_data(), stdlib.response(data).get_data())
+        self.assertEqual(fast.dumps(data), stdlib.dumps(data))
+
+    def test_provider(self):
+        self.assertIsInstance(self.app.json, serialization.OrjsonProvider)
+        stdlib_app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'JSON_BACKEND': 'stdlib'})
+        self.assertIs(type(stdlib_app.json), DefaultJSONProvider)
+
+    def test_same_output_as_the_stdlib(self):
+        self.assertSameJSON({'success': True, 'questions': [q.format() for q in Question.query]})
+        self.assertSameJSON({'z': 1, 'a': {'y': [None, False, 'x'], 'b': -2}, 'm': []})
+        self.assertSameJSON({'categories': {n: str(n) for n in range(1, 13)}})
+        self.assertSameJSON({'categories': {n: str(n) for n in range(9, 0, -1)}, 'nested': [{2: 'b', 1: 'a'}]})
+        self.assertSameJSON({'categories': {n: str(n) for n in range(9, 0, -1)}, 'total': 9})
+        self.assertSameJSON({'text': 'Qu\'est-ce que c\'est ? Æ ☃ \U0001f600 "quoted" \\ \n\t\x01'})
+        self.assertSameJSON({'text': 'delete \x7f', 'control': '\x00\x1f'})
+        self.assertSameJSON({'floats': [0.0, -0.0, 1.5, 0.1 + 0.2, 1e-7, 6.5e-05, 0.0001, 1e16, 1e20, 123456.789]})
+        self.assertSameJSON({'ints': [0, -1, 2 ** 63 - 1, 2 ** 64, -2 ** 70]})
+        self.assertSameJSON({'when': date(2020, 1, 2), 'at': datetime(2020, 1, 2, 3, 4, 5), 'price': Decimal('1.50')})
+        self.assertSameJSON([1, 'two', {'three': 3}])
+
+    def test_same_responses_as_the_stdlib(self):
+        self.client().post('/questions', json={
+            'question': 'Où est la tour Eiffel ?', 'answer': 'Paris', 'category': '3', 'difficulty': 1})
+        paths = ['/categories', '/questions', '/questions?page=4', '/categories/3/questions',
+                 '/questions?page=100', '/questions/autocomplete?q=ques']
+        fast = [self.client().get(path).data for path in paths]
+        self.app.json = DefaultJSONProvider(self.app)
+
+        self.assertEqual(fast, [self.client().get(path).data for path in paths])
+
+    def test_responses_are_written_by_orjson(self):
+        stdlib_dumps = DefaultJSONProvider.dumps
+        DefaultJSONProvider.dumps = None
+        try:
+            self.assertEqual(self.client().get('/questions').status_code, 200)
+            self.assertEqual(self.client().get('/categories').status_code, 200)
+        finally:
+            DefaultJSONProvider.dumps = stdlib_dumps
+
+    def test_pretty_output_uses_the_stdlib(self):
+        data = {'b': [1, 2], 'a': 'é'}
+        self.assertEqual(serialization.OrjsonProvider(self.app).dumps(data, indent=2),
+                         DefaultJSONProvider(self.app).dumps(data, indent=2))
+
+
+class ReadQuestionsTestCase(SQLiteTestCase):
+    """Tests for the column-projected read-only question queries"""
+
+    def test_page(self):
+        rows, total = models.read_questions(offset=10, limit=10)
+
+        self.assertEqual([row.id for row in rows], list(range(11, 21)))
+        self.assertEqual(total, 30)
+        self.assertEqual(models.format_row(rows[0]), Question.query.get(11).format())
+
+    def test_category_and_keyset(self):
+        rows, total = models.read_questions(3, offset=0, limit=10)
+        self.assertEqual(([row.id for row in rows], total), ([11, 12, 13, 14, 15], 5))
+
+        rows, total = models.read_questions(3, after_id=13, limit=10)
+        self.assertEqual(([row.id for row in rows], total), ([14, 15], 5))
+
+        rows, total = models.read_questions(3, offset=10, limit=10)
+        self.assertEqual((rows, total), ([], 5))
+
+    def test_no_entities_are_loaded(self):
+        db.session.expunge_all()
+        models.read_questions(offset=0, limit=10)
+
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_count_only(self):
+        with self.count_queries() as statements:
+            self.assertEqual(models.read_questions(count_only=True), 30)
+            self.assertEqual(models.read_questions(2, count_only=True), 5)
+
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(all('count(*)' in statement and 'anon' not in statement
+                            for statement in statements))
+
+    def test_page_with_total_shapes(self):
+        selection = Question.query.filter(Question.category_id == 2).order_by(Question.id)
+
+        questions, total = models.page_with_total(selection, 1, 2, entities=True)
+        self.assertEqual(([question.id for question in questions], total), ([7, 8], 5))
+
+        rows, total = models.page_with_total(selection.with_entities(Question.id), 1, 2)
+        self.assertEqual((rows, total), ([(7,), (8,)], 5))
+
+        rows, total = models.page_with_total(selection.with_entities(Question.id), 10, 2)
+        self.assertEqual((rows, total), ([], 5))
+
+
+class MetricsTestCase(SQLiteTestCase):
+    """Tests for the request metrics and the log events"""
+
+    config = {'RESPONSE_CACHE_MAX_ENTRIES': 0}
+
+    def setUp(self):
+        super().setUp()
+        self.metrics = self.app.extensions['trivia_metrics']
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram('h', 'help', ('route',), (1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value, 'a')
+
+        self.assertEqual(histogram.get('a'), ([2, 1, 1], 14.5, 4))
+        self.assertEqual(histogram.render()[2:], [
+            'h_bucket{route="a",le="1"} 2',
+            'h_bucket{route="a",le="5"} 3',
+            'h_bucket{route="a",le="+Inf"} 4',
+            'h_sum{route="a"} 14.5',
+            'h_count{route="a"} 4'])
+
+    def test_requests_are_recorded(self):
+        res = self.client().get('/questions?page=2')
+        self.client().get('/questions?page=50')
+
+        self.assertEqual(self.metrics.latency.get('get_questions', 'GET', '200')[2], 1)
+        self.assertEqual(self.metrics.latency.get('get_questions', 'GET', '404')[2], 1)
+        counts, size, count = self.metrics.response_size.get('get_questions')
+        self.assertEqual(count, 2)
+        self.assertGreaterEqual(size, len(res.data))
+
+    def test_sql_statements_per_request(self):
+        with self.count_queries() as statements:
+            self.client().get('/questions')
+        self.client().get('/categories')
+
+        self.assertEqual(self.metrics.statements.get('get_questions')[1], len(statements))
+        self.assertGreater(self.metrics.sql_time.get('get_questions')[1], 0)
+        # served from the category cache
+        self.assertEqual(self.metrics.statements.get('get_categories')[1], 0)
+
+    def test_statements_outside_requests_are_not_counted(self):
+        self.client().get('/questions')
+        Question.query.count()
+
+        self.assertEqual(self.metrics.statements.get('get_questions')[2], 1)
+        self.assertFalse(metrics.tracker.active)
+
+    def test_metrics_endpoint(self):
+        self.client().get('/categories')
+        res = self.client().get('/metrics')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/plain')
+        text = res.data.decode()
+        self.assertIn('# TYPE trivia_request_duration_seconds histogram', text)
+        self.assertIn('trivia_request_duration_seconds_count{endpoint="get_categories",method="GET",status="200"} 1', text)
+        # the first request loads the category cache
+        self.assertIn('trivia_request_sql_statements_sum{endpoint="get_categories"} 1', text)
+
+    def test_metrics_can_be_disabled(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'METRICS_ENABLED': False})
+
+        self.assertIsNone(app.extensions['trivia_metrics'])
+        self.assertEqual(app.test_client().get('/metrics').status_code, 404)
+
+    def test_views_log_events(self):
+        self.app.logger.setLevel('DEBUG')
+        try:
+            with self.assertLogs(self.app.logger, 'DEBUG') as logs:
+                self.client().post('/quizzes', json={
+                    'previous_questions': [1], 'quiz_category': {'type': 'Science', 'id': 1}})
+                self.client().post('/questions/search', json={'searchTerm': 'two words'})
+        finally:
+            self.app.logger.setLevel('NOTSET')
+
+        self.assertIn('quiz.draw category=Science previous=[1]', logs.output[0])
+        self.assertIn('question.search term="two words" category=None', logs.output[-1])
+        self.assertEqual(logs.records[-1].fields['term'], 'two words')
+
+    def test_sampling_filter(self):
+        draws = iter([0.05, 0.5])
+        sampled = metrics.SamplingFilter(0.1, rng=lambda: next(draws))
+        record = lambda level: logging.LogRecord('flaskr', level, __file__, 1, 'msg', (), None)
+
+        self.assertTrue(sampled.filter(record(logging.DEBUG)))
+        self.assertFalse(sampled.filter(record(logging.INFO)))
+        self.assertTrue(sampled.filter(record(logging.ERROR)))
+
+    def test_sampling_filter_is_not_stacked(self):
+        for _ in range(3):
+            create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'LOG_SAMPLE_RATE': 0.5})
+        filters = [f for f in self.app.logger.filters if isinstance(f, metrics.SamplingFilter)]
+        create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+
+        self.assertEqual(len(filters), 1)
+        self.assertFalse([f for f in self.app.logger.filters if isinstance(f, metrics.SamplingFilter)])
+
+
+class RateLimitTestCase(SQLiteTestCase):
+    """Tests for the rate limits and the load shedding of the search and quiz endpoints"""
+
+    config = {'RATE_LIMIT_PER_SECOND': 0.5, 'RATE_LIMIT_BURST': 2, 'MAX_CONCURRENT_REQUESTS': 2,
+              'MAX_QUEUED_REQUESTS': 0, 'RESPONSE_CACHE_MAX_ENTRIES': 0}
+
+    def search(self, address='10.0.0.1', headers=None):
+        return self.client().post('/questions/search', json={'searchTerm': 'question'},
+                                  headers=headers, environ_base={'REMOTE_ADDR': address})
+
+    def test_clients_are_limited_past_their_burst(self):
+        self.assertEqual(self.search().status_code, 200)
+        self.assertEqual(self.search().status_code, 200)
+        res = self.search()
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(json.loads(res.data), {
+            'success': False, 'error': 429, 'message': 'Too Many Requests'})
+        self.assertEqual(res.headers['Retry-After'], '2')
+        # the bucket is per client and per limited endpoint group
+        self.assertEqual(self.search('10.0.0.2').status_code, 200)
+        address = {'REMOTE_ADDR': '10.0.0.1'}
+        self.assertEqual(self.client().get('/questions', environ_base=address).status_code, 200)
+        self.assertEqual(self.client().post('/quizzes', environ_base=address, json={
+            'quiz_category': {'type': 'click', 'id': 0}}).status_code, 429)
+        self.assertEqual(self.client().post('/quizzes/sessions', environ_base=address, json={
+            'quiz_category': {'type': 'click', 'id': 0}}).status_code, 429)
+
+    def test_client_ids_do_not_get_new_buckets(self):
+        statuses = [self.search(headers={'X-Client-Id': str(n)}).status_code for n in range(4)]
+
+        self.assertEqual(statuses, [200, 200, 429, 429])
+
+    def test_trusted_proxies(self):
+        app = create_app(dict(self.config, SQLALCHEMY_DATABASE_URI='sqlite://', TRUSTED_PROXIES=1))
+        try:
+            def search(forwarded_for):
+                return app.test_client().post('/questions/search', json={'searchTerm': 'question'},
+                                              headers={'X-Forwarded-For': forwarded_for})
+            self.assertEqual([search('10.0.0.1').status_code == 429 for _ in range(3)], [False, False, True])
+            self.assertNotEqual(search('10.0.0.2').status_code, 429)
+        finally:
+            stop_background_writes(app)
+
+    def test_requests_are_shed_when_saturated(self):
+        limiter = self.app.extensions['trivia_concurrency_limiter']
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+
+        res = self.search()
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(json.loads(res.data)['message'], 'Service Unavailable')
+
+        limiter.release()
+        self.assertEqual(self.search().status_code, 200)
+        # the slot was given back after the request
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.shed, 1)
+
+    def test_limits_are_off_by_default(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+
+        self.assertIsNone(app.extensions['trivia_concurrency_limiter'])
+        for _ in range(20):
+            res = app.test_client().post('/quizzes', json={'quiz_category': {'type': 'click', 'id': 0}})
+            self.assertNotIn(res.status_code, (429, 503))
+
+    def test_memory_buckets_refill(self):
+        now = [0.0]
+        buckets = ratelimit.MemoryTokenBuckets(clock=lambda: now[0])
+
+        self.assertEqual([buckets.take('a', 2, 3) for _ in range(4)], [0, 0, 0, 0.5])
+        now[0] = 0.25
+        self.assertEqual(buckets.take('a', 2, 3), 0.25)
+        now[0] = 0.5
+        self.assertEqual(buckets.take('a', 2, 3), 0)
+        now[0] = 100
+        self.assertEqual([buckets.take('a', 2, 3) for _ in range(4)], [0, 0, 0, 0.5])
+
+    def test_memory_buckets_sweep_full_buckets(self):
+        now = [0.0]
+        buckets = ratelimit.MemoryTokenBuckets(clock=lambda: now[0])
+        buckets.sweep_size = 2
+        buckets.take('a', 1, 5)
+        now[0] = 10
+        buckets.take('b', 1, 5)
+        buckets.take('c', 1, 5)
+
+        self.assertEqual(set(buckets.buckets), {'b', 'c'})
+
+    def test_shared_buckets(self):
+        now = [1000.0]
+        client = FakeRedis()
+        workers = [ratelimit.SharedTokenBuckets(client, clock=lambda: now[0]) for _ in range(2)]
+
+        self.assertEqual([workers[n % 2].take('a', 2, 3) for n in range(4)], [0, 0, 0, 0.5])
+        self.assertEqual(workers[0].take('b', 2, 3), 0)
+        now[0] += 0.5
+        self.assertEqual(workers[1].take('a', 2, 3), 0)
+        self.assertEqual(workers[1].take('a', 2, 3), 0.5)
+        now[0] += 100
+        self.assertEqual([workers[n % 2].take('a', 2, 3) for n in range(4)], [0, 0, 0, 0.5])
+
+    def test_concurrency_limiter_queue(self):
+        limiter = ratelimit.ConcurrencyLimiter(1, max_queued=1, timeout=5)
+        self.assertTrue(limiter.acquire())
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(limiter.acquire()))
+        waiter.start()
+        while not limiter.queued:
+            time.sleep(0.001)
+
+        # the queue is full
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        waiter.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(limiter.shed, 1)
+
+    def test_configured_store_is_used(self):
+        buckets = self.app.extensions['trivia_token_buckets']
+        self.search()
+
+        self.assertIs(buckets, self.config.get('RATE_LIMIT_STORE', buckets))
+        if hasattr(self, 'redis'):
+            self.assertIn('trivia:ratelimit:10.0.0.1', self.redis.data)
+
+    def test_concurrency_limiter_timeout(self):
+        limiter = ratelimit.ConcurrencyLimiter(1, max_queued=1, timeout=0.01)
+        limiter.acquire()
+
+        self.assertFalse(limiter.acquire())
+        self.assertEqual((limiter.queued, limiter.shed), (0, 1))
+
+
+SharedRateLimitTestCase = shared_store_case(
+    RateLimitTestCase, 'RATE_LIMIT_STORE', ratelimit.SharedTokenBuckets)
+
+class AdaptiveQuizTestCase(SQLiteTestCase):
+    """Tests for the adaptive difficulty quizzes"""
+
+    # two questions per category and difficulty
+    questions_per_category = 10
+
+    def post(self, path, body=None):
+        res = self.client().post(path, json=body)
+        return res.status_code, json.loads(res.data)
+
+    def start(self, category={'type': 'Science', 'id': 1}, **kwargs):
+        status, data = self.post('/quizzes/adaptive', dict(kwargs, quiz_category=category))
+        self.assertEqual(status, 200)
+        return data['token']
+
+    def next(self, token, correct=None):
+        status, data = self.post('/quizzes/adaptive/{}/next'.format(token),
+                                 None if correct is None else {'correct': correct})
+        self.assertEqual(status, 200)
+        return data
+
+    def test_id_bucket(self):
+        bucket = adaptive.IdBucket()
+        for id in (1, 2, 3, 2):
+            bucket.add(id)
+        bucket.remove(1)
+        bucket.remove(7)
+
+        self.assertEqual(len(bucket), 2)
+        self.assertEqual(sorted(bucket.ids), [2, 3])
+        self.assertEqual({id: bucket.ids[position] for id, position in bucket.positions.items()},
+                         {2: 2, 3: 3})
+        self.assertEqual(bucket.pick(excluded={3}), 2)
+        self.assertIsNone(bucket.pick(excluded={2, 3}))
+
+    def test_counts_by_difficulty(self):
+        data = json.loads(self.client().get('/quizzes/difficulties').data)
+        self.assertEqual(data['difficulties'], {str(level): 12 for level in range(1, 6)})
+
+        with self.count_queries() as statements:
+            data = json.loads(self.client().get('/quizzes/difficulties?category=2').data)
+        self.assertEqual(data['difficulties'], {str(level): 2 for level in range(1, 6)})
+        self.assertEqual(statements, [])
+
+    def test_difficulty_follows_the_answers(self):
+        token = self.start()
+        question = self.next(token)['question']
+        self.assertEqual((question['category'], question['difficulty']), ('1', 3))
+
+        # a wrong answer lowers the difficulty
+        self.assertEqual(self.next(token, correct=False)['question']['difficulty'], 2)
+        self.assertEqual(self.next(token, correct=True)['question']['difficulty'], 2)
+        # two right answers in a row raise it
+        data = self.next(token, correct=True)
+        self.assertEqual((data['difficulty'], data['question']['difficulty']), (3, 3))
+        self.assertEqual(data['remaining'], {'1': 2, '2': 0, '3': 0, '4': 2, '5': 2})
+
+    def test_closest_difficulty_once_a_bucket_is_played(self):
+        token = self.start(difficulty=5)
+        levels = [self.next(token)['question']['difficulty'] for _ in range(5)]
+
+        self.assertEqual(levels, [5, 5, 4, 4, 3])
+
+    def test_quiz_ends_when_every_question_was_played(self):
+        token = self.start()
+        ids = {self.next(token, correct=True)['question']['id'] for _ in range(10)}
+        data = self.next(token)
+
+        self.assertEqual(ids, set(range(1, 11)))
+        self.assertIsNone(data['question'])
+        self.assertEqual(data['remaining'], {str(level): 0 for level in range(1, 6)})
+
+    def test_all_categories(self):
+        token = self.start({'type': 'click', 'id': 0}, difficulty=1)
+        data = self.next(token)
+
+        self.assertEqual(data['question']['difficulty'], 1)
+        self.assertEqual(data['remaining']['1'], 11)
+
+    def test_buckets_follow_writes(self):
+        self.client().get('/quizzes/difficulties')
+        self.client().post('/questions', json={
+            'question': 'Q', 'answer': 'A', 'category': 1, 'difficulty': 5})
+        self.client().delete('/questions/2')
+
+        with self.count_queries() as statements:
+            data = json.loads(self.client().get('/quizzes/difficulties?category=1').data)
+        self.assertEqual(data['difficulties'], {'1': 2, '2': 1, '3': 2, '4': 2, '5': 3})
+        self.assertEqual(statements, [])
+
+    def test_buckets_reload_after_a_write_elsewhere(self):
+        self.client().get('/quizzes/difficulties')
+        db.session.execute(Question.__table__.delete().where(Question.category_id == 1))
+        db.session.commit()
+        self.app.extensions['trivia_data_version'].bump()
+
+        data = json.loads(self.client().get('/quizzes/difficulties?category=1').data)
+        self.assertEqual(data['difficulties'], {str(level): 0 for level in range(1, 6)})
+
+    def test_one_load_swapped_in_whole(self):
+        loading, release = threading.Event(), threading.Event()
+        loads = []
+        def loader():
+            loads.append(None)
+            loading.set()
+            release.wait(5)
+            return [(1, 1, 1), (2, 1, 2)]
+
+        buckets = adaptive.DifficultyBuckets(loader)
+        first = threading.Thread(target=buckets.counts)
+        first.start()
+        self.assertTrue(loading.wait(5))
+        # nothing half loaded is published meanwhile
+        self.assertIsNone(buckets.buckets)
+        second = threading.Thread(target=buckets.counts)
+        second.start()
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(buckets.counts(1), {1: 1, 2: 1, 3: 0, 4: 0, 5: 0})
+
+    def test_change_during_a_load(self):
+        rows = [[(1, 1, 1)]]
+        def loader():
+            # committed once the rows were read
+            buckets.on_change('delete', Question.query.get(1))
+            return rows.pop()
+
+        buckets = adaptive.DifficultyBuckets(loader)
+        self.assertEqual(buckets.counts(1)[1], 1)
+        buckets.loader = lambda: [(2, 1, 2)]
+        # loaded again on next use
+        self.assertEqual(buckets.counts(1), {1: 0, 2: 1, 3: 0, 4: 0, 5: 0})
+
+    def test_deleted_questions_are_skipped(self):
+        token = self.start(difficulty=1)
+        self.client().get('/quizzes/difficulties')
+        # deleted without the commit hooks, the buckets still hold them
+        db.session.execute(Question.__table__.delete().where(Question.id.in_([1, 6])))
+        db.session.commit()
+
+        self.assertEqual(self.next(token)['question']['difficulty'], 2)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post('/quizzes/adaptive', {
+            'quiz_category': {'type': 'Science', 'id': 1}, 'difficulty': 9})[0], 400)
+        self.assertEqual(self.post('/quizzes/adaptive', {})[0], 400)
+        token = self.start()
+        self.assertEqual(self.post('/quizzes/adaptive/{}/next'.format(token), {'correct': 'yes'})[0], 400)
+        self.assertEqual(self.post('/quizzes/adaptive/unknown/next')[0], 404)
+        # adaptive and deck sessions share the store, not their endpoints
+        self.assertEqual(self.post('/quizzes/sessions/{}/next'.format(token))[0], 404)
+        _, data = self.post('/quizzes/sessions', {'quiz_category': {'type': 'Science', 'id': 1}})
+        self.assertEqual(self.post('/quizzes/adaptive/{}/next'.format(data['token']))[0], 404)
+
+
+class AnswerCheckTestCase(SQLiteTestCase):
+    """Tests for checking the guesses on the server"""
+
+    def check(self, question_id, guess):
+        res = self.client().post('/questions/{}/answer'.format(question_id), json={'answer': guess})
+        return res.status_code, json.loads(res.data)
+
+    def add_question(self, answer):
+        question = Question(question='Q', answer=answer, category='1', difficulty=1)
+        question.insert()
+        return question.id
+
+    def test_normalize(self):
+        self.assertEqual(answers.normalize('  The Beatles!'), 'beatles')
+        self.assertEqual(answers.normalize('Café Müller'), 'cafe muller')
+        self.assertEqual(answers.normalize("Rock'n'roll, an era"), 'rock n roll era')
+        self.assertEqual(answers.normalize('A'), 'a')
+
+    def test_edit_distance(self):
+        self.assertEqual(answers.edit_distance('kitten', 'sitting', 5), 3)
+        self.assertEqual(answers.edit_distance('kitten', 'sitting', 2), 3)
+        self.assertEqual(answers.edit_distance('beatles', 'beatels', 2), 1)
+        self.assertEqual(answers.edit_distance('', 'abc', 3), 3)
+        self.assertEqual(answers.edit_distance('abc', 'abcdefg', 2), 3)
+
+    def test_matches(self):
+        beatles = answers.normalize('The Beatles')
+        for guess in ('the beatles', 'BEATLES.', 'Beatels', 'it was the Beatles'):
+            self.assertTrue(answers.matches(answers.normalize(guess), beatles), guess)
+        for guess in ('Beetels', 'Rolling Stones', 'beatle mania', ''):
+            self.assertFalse(answers.matches(answers.normalize(guess), beatles), guess)
+        # no typos on short answers, nor in numbers
+        self.assertFalse(answers.matches('tim', 'tom'))
+        self.assertFalse(answers.matches('1991', '1990'))
+        self.assertFalse(answers.matches('answer 12', 'answer 13'))
+
+    def test_guesses_listing_many_answers_are_wrong(self):
+        victoria = answers.normalize('Lake Victoria')
+        for guess in ('it is Lake Victoria', 'lake victoria in east africa'):
+            self.assertTrue(answers.matches(answers.normalize(guess), victoria), guess)
+        for guess in ('Lake Tanganyika Lake Malawi Lake Victoria Lake Chad',
+                      'paris london lake victoria rome madrid'):
+            self.assertFalse(answers.matches(answers.normalize(guess), victoria), guess)
+
+    def test_check_answer(self):
+        id = self.add_question('Lake Victoria')
+
+        self.assertEqual(self.check(id, 'lake victoria'), (200, {
+            'success': True, 'correct': True, 'answer': 'Lake Victoria'}))
+        self.assertTrue(self.check(id, 'Lake Victora')[1]['correct'])
+        self.assertFalse(self.check(id, 'Lake Tanganyika')[1]['correct'])
+        self.assertFalse(self.check(1, 'Answer 1')[1]['correct'])
+        self.assertTrue(self.check(1, 'answer 0')[1]['correct'])
+
+    def test_check_answer_errors(self):
+        self.assertEqual(self.check(1000, 'guess')[0], 404)
+        self.assertEqual(self.check(1, None)[0], 400)
+        res = self.client().post('/questions/1/answer', data='not json')
+        self.assertEqual(res.status_code, 400)
+
+    def test_answers_are_cached(self):
+        self.check(3, 'guess')
+        with self.count_queries() as statements:
+            self.check(3, 'other guess')
+        self.assertEqual(statements, [])
+
+    def test_cache_follows_writes(self):
+        id = self.add_question('Paris')
+        self.assertTrue(self.check(id, 'paris')[1]['correct'])
+
+        question = Question.query.get(id)
+        question.answer = 'Rome'
+        question.update()
+        self.assertEqual(self.check(id, 'paris')[1], {'success': True, 'correct': False, 'answer': None})
+        self.assertEqual(self.check(id, 'rome')[1]['answer'], 'Rome')
+
+        self.client().delete('/questions/{}'.format(id))
+        self.assertEqual(self.check(id, 'rome')[0], 404)
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = answers.AnswerCache(loader=lambda id: 'answer {}'.format(id), max_entries=2)
+        for id in (1, 2, 1, 3):
+            cache.get(id)
+
+        self.assertEqual(list(cache.entries), [1, 3])
+        self.assertEqual(cache.check(3, 'Answer 3!'), (True, 'answer 3'))
+
+    def test_quiz_answers_are_hidden(self):
+        question = json.loads(self.client().post('/quizzes', json={
+            'quiz_category': {'type': 'click', 'id': 0}}).data)['question']
+        self.assertNotIn('answer', question)
+        token = json.loads(self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'click', 'id': 0}}).data)['token']
+        question = json.loads(self.client().post('/quizzes/sessions/{}/next'.format(token)).data)['question']
+        self.assertNotIn('answer', question)
+
+        # a wrong guess does not reveal it, the session does, once
+        self.assertEqual(self.check(question['id'], 'nope')[1], {'success': True, 'correct': False, 'answer': None})
+        url = '/quizzes/sessions/{}/answer'.format(token)
+        res = self.client().post(url, json={'answer': 'nope'})
+        self.assertEqual(json.loads(res.data)['answer'], Question.query.get(question['id']).answer)
+        self.assertEqual(self.client().post(url, json={'answer': 'nope'}).status_code, 422)
+
+    def test_quiz_answers_can_be_shown(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'QUIZ_HIDE_ANSWERS': False})
+        db.session.remove()
+        with app.app_context():
+            db.create_all()
+            self.seed()
+            question = json.loads(app.test_client().post('/quizzes', json={
+                'quiz_category': {'type': 'click', 'id': 0}}).data)['question']
+            self.assertIn('answer', question)
+            db.session.remove()
+
+
+class QuizResultsTestCase(SQLiteTestCase):
+    """Tests for the batched quiz results and the leaderboards"""
+
+    def setUp(self):
+        # a file so the flushing thread sees the same database
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.config = {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.path,
+            'QUIZ_RESULTS_FLUSH_INTERVAL': 0,
+            'QUIZ_RESULTS_BATCH_SIZE': 3,
+        }
+        super().setUp()
+        self.results = self.app.extensions['trivia_quiz_results']
+
+    def tearDown(self):
+        super().tearDown()
+        db.get_engine(self.app).dispose()
+        os.remove(self.path)
+
+    # plays a quiz session of `total` questions, `score` of them answered right
+    def play(self, score, total=5, category=None, client=None):
+        client = client or self.client()
+        token = json.loads(client.post('/quizzes/sessions', json={
+            'quiz_category': category or {'type': 'click', 'id': 0}}).data)['token']
+        for n in range(total):
+            id = json.loads(client.post('/quizzes/sessions/{}/next'.format(token)).data)['question']['id']
+            guess = Question.query.get(id).answer if n < score else 'nope'
+            res = client.post('/quizzes/sessions/{}/answer'.format(token), json={'answer': guess})
+            self.assertEqual(res.status_code, 200)
+        return token
+
+    def post_result(self, player, score, total=5, category=None):
+        res = self.client().post('/quizzes/results', json={
+            'player': player,
+            'token': self.play(score, total, category)})
+        return res.status_code, json.loads(res.data)
+
+    def leaderboard(self, query=''):
+        res = self.client().get('/leaderboard' + query)
+        self.assertEqual(res.status_code, 200)
+        return [(entry['player'], entry['score']) for entry in json.loads(res.data)['leaderboard']]
+
+    def test_board(self):
+        board = results.Board(capacity=3)
+        for player, score in (('a', 2), ('b', 5), ('c', 2), ('a', 1), ('d', 4), ('a', 6)):
+            board.record(player, score)
+        self.assertEqual(board.top(10), [('a', 6), ('b', 5), ('d', 4)])
+        self.assertEqual(board.rank('d'), 3)
+        # 'c' fell off the board, a tie with the last player does not get on it
+        self.assertIsNone(board.rank('c'))
+        board.record('e', 4)
+        self.assertEqual(board.top(10), [('a', 6), ('b', 5), ('d', 4)])
+        board.record('e', 7)
+        self.assertEqual(board.top(2), [('e', 7), ('a', 6)])
+        self.assertEqual(len(board), 3)
+
+    def test_record_result(self):
+        self.assertEqual(self.post_result('ann', 3), (200, {'success': True, 'score': 3, 'total': 5, 'rank': 1}))
+        self.assertEqual(self.post_result('bob', 4)[1]['rank'], 1)
+        self.assertEqual(self.post_result('ann', 2)[1]['rank'], 2)
+        self.assertEqual(self.post_result('cat', 1, category={'type': 'Art', 'id': 2})[1]['rank'], 1)
+
+        # served before the results are written
+        self.assertEqual(QuizResult.query.count(), 0)
+        self.assertEqual(self.leaderboard(), [('bob', 4), ('ann', 3), ('cat', 1)])
+        self.assertEqual(self.leaderboard('?category=2'), [('cat', 1)])
+        self.assertEqual(self.leaderboard('?category=3'), [])
+        self.assertEqual(self.leaderboard('?limit=1'), [('bob', 4)])
+
+        self.assertEqual(self.results.flush(), 4)
+        self.assertEqual(
+            [(result.player, result.category_id, result.score) for result in QuizResult.query.order_by(QuizResult.id)],
+            [('ann', None, 3), ('bob', None, 4), ('ann', None, 2), ('cat', 2, 1)])
+        stats = json.loads(self.client().get('/stats/results').data)['results']
+        self.assertEqual(stats, {'recorded': 4, 'written': 4, 'batches': 2, 'failures': 0, 'rejected': 0,
+                                 'pending': 0})
+
+    def test_leaderboard_loads_the_written_results(self):
+        db.session.add_all([
+            QuizResult(player='ann', category_id=1, score=2, total=5, created_at=datetime.utcnow()),
+            QuizResult(player='ann', category_id=1, score=4, total=5, created_at=datetime.utcnow()),
+            QuizResult(player='bob', category_id=2, score=3, total=5, created_at=datetime.utcnow()),
+        ])
+        db.session.commit()
+        self.post_result('cat', 5, category={'type': 'Science', 'id': 1})
+
+        self.assertEqual(self.leaderboard(), [('cat', 5), ('ann', 4), ('bob', 3)])
+        self.assertEqual(self.leaderboard('?category=1'), [('cat', 5), ('ann', 4)])
+        # read from memory afterwards
+        with self.count_queries() as statements:
+            self.leaderboard('?category=2')
+        self.assertEqual(statements, [])
+
+    def test_invalid_result(self):
+        token = self.play(1, 2)
+        for body in ({'token': token}, {'player': 'ann'}, {'player': ' ', 'token': token},
+                     {'player': 'ann', 'token': 1}, {'player': 'x' * 81, 'token': token},
+                     {'player': 'a\x00b', 'token': token}, {'player': 'a\ud800', 'token': token}):
+            res = self.client().post('/quizzes/results', json=body)
+            self.assertEqual(res.status_code, 400, body)
+        res = self.client().post('/quizzes/results', json={'player': 'ann', 'token': 'nope'})
+        self.assertEqual(res.status_code, 404)
+        # nothing answered
+        self.assertEqual(self.post_result('ann', 0, total=0)[0], 422)
+        self.assertEqual(self.post_result('ann', 0, total=0, category={'type': 'Nope', 'id': 99})[0], 422)
+        self.assertEqual(self.results.stats()['recorded'], 0)
+
+        # recorded once
+        res = self.client().post('/quizzes/results', json={'player': 'ann', 'token': token})
+        self.assertEqual(json.loads(res.data)['score'], 1)
+        res = self.client().post('/quizzes/results', json={'player': 'bob', 'token': token})
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(self.results.stats()['recorded'], 1)
+
+    def test_the_session_keeps_the_score(self):
+        start = self.client().post('/quizzes/sessions', json={'quiz_category': {'type': 'Art', 'id': 2}})
+        token = json.loads(start.data)['token']
+        url = '/quizzes/sessions/{}/answer'.format(token)
+        # nothing drawn yet
+        self.assertEqual(self.client().post(url, json={'answer': 'x'}).status_code, 422)
+
+        id = json.loads(self.client().post('/quizzes/sessions/{}/next'.format(token)).data)['question']['id']
+        answer = Question.query.get(id).answer
+        res = self.client().post(url, json={'answer': answer.lower()})
+        self.assertEqual(json.loads(res.data), {
+            'success': True, 'question': id, 'correct': True, 'answer': answer, 'answered': 1, 'score': 1})
+        # each question is answered once
+        self.assertEqual(self.client().post(url, json={'answer': answer}).status_code, 422)
+        self.assertEqual(self.client().post(url, json={}).status_code, 400)
+        self.assertEqual(self.client().post('/quizzes/sessions/nope/answer', json={'answer': 'x'}).status_code, 404)
+
+        self.client().post('/quizzes/sessions/{}/next'.format(token))
+        res = self.client().post(url, json={'answer': 'nope'})
+        self.assertEqual(json.loads(res.data)['score'], 1)
+        res = self.client().post('/quizzes/results', json={'player': 'ann', 'token': token})
+        self.assertEqual(json.loads(res.data), {'success': True, 'score': 1, 'total': 2, 'rank': 1})
+        self.assertEqual(self.leaderboard('?category=2'), [('ann', 1)])
+
+    def test_adaptive_quiz_result(self):
+        start = self.client().post('/quizzes/adaptive', json={'quiz_category': {'type': 'click', 'id': 0}})
+        token = json.loads(start.data)['token']
+        for _ in range(2):
+            id = json.loads(self.client().post('/quizzes/adaptive/{}/next'.format(token)).data)['question']['id']
+            self.client().post('/quizzes/sessions/{}/answer'.format(token),
+                               json={'answer': Question.query.get(id).answer})
+        # two right answers moved the target up, a `correct` sent with the
+        # next draw does not count again
+        res = self.client().post('/quizzes/adaptive/{}/next'.format(token), json={'correct': False})
+        self.assertEqual(json.loads(res.data)['difficulty'], 4)
+
+        res = self.client().post('/quizzes/results', json={'player': 'ann', 'token': token})
+        self.assertEqual(json.loads(res.data)['score'], 2)
+
+    def test_flush_failure_keeps_the_results(self):
+        written = []
+        def write(rows):
+            if len(written) < 1:
+                written.append(None)
+                raise OperationalError('INSERT', {}, Exception('database is down'))
+            results.insert_results(rows)
+            written.append(rows)
+
+        self.results.write = write
+        for n in range(4):
+            self.post_result('player {}'.format(n), n)
+
+        self.assertEqual(self.results.flush(), 0)
+        self.assertEqual(self.results.stats()['pending'], 4)
+        self.assertEqual(self.results.stats()['failures'], 1)
+        self.post_result('late', 1)
+
+        self.assertEqual(self.results.flush(), 5)
+        self.assertEqual([result.player for result in QuizResult.query.order_by(QuizResult.id)],
+                         ['player 0', 'player 1', 'player 2', 'player 3', 'late'])
+        self.assertEqual(self.results.stats()['pending'], 0)
+
+    def test_partial_flush_failure(self):
+        batches = []
+        def write(rows):
+            if batches:
+                raise OperationalError('INSERT', {}, Exception('database is down'))
+            results.insert_results(rows)
+            batches.append(rows)
+
+        self.results.write = write
+        for n in range(5):
+            self.post_result('player {}'.format(n), n)
+
+        # the first batch of 3 is written, the last 2 wait for the next flush
+        self.assertEqual(self.results.flush(), 3)
+        self.assertEqual([row['player'] for row in self.results.pending], ['player 3', 'player 4'])
+
+        self.results.write = results.insert_results
+        self.assertEqual(self.results.flush(), 2)
+        self.assertEqual(QuizResult.query.count(), 5)
+
+    def test_rows_at_fault_are_set_aside(self):
+        calls = []
+        def write(rows):
+            calls.append(len(rows))
+            if any(row['player'] == 'poison' for row in rows):
+                raise ValueError('cannot be written')
+            results.insert_results(rows)
+
+        self.results.write = write
+        self.results.add('poison', None, 1, 1)
+        for attempt in range(results.MAX_ATTEMPTS):
+            self.results.add('ann {}'.format(attempt), None, 1, 1)
+            self.results.add('bob {}'.format(attempt), None, 1, 1)
+            # the batch is split, the rows next to the poison one are written
+            self.assertEqual(self.results.flush(), 2)
+            self.assertEqual(calls, [3, 1, 2])
+            del calls[:]
+
+        stats = self.results.stats()
+        self.assertEqual((stats['rejected'], stats['pending']), (1, 0))
+        self.assertEqual(self.results.rejected[0]['player'], 'poison')
+        self.assertEqual(QuizResult.query.count(), 2 * results.MAX_ATTEMPTS)
+        self.assertEqual(self.results.flush(), 0)
+        self.assertEqual(calls, [])
+
+    def test_failing_writes_without_progress_are_kept(self):
+        def write(rows):
+            raise ValueError('cannot be written')
+
+        self.results.write = write
+        for n in range(3):
+            self.results.add('player {}'.format(n), None, n, 3)
+        for attempt in range(results.MAX_ATTEMPTS + 1):
+            self.assertEqual(self.results.flush(), 0)
+        self.assertEqual(self.results.stats()['rejected'], 0)
+        self.assertEqual([row['player'] for row in self.results.pending], ['player 0', 'player 1', 'player 2'])
+
+    def test_background_flush(self):
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.path,
+            'QUIZ_RESULTS_FLUSH_INTERVAL': 0.05,
+        })
+        store = app.extensions['trivia_quiz_results']
+        client = app.test_client()
+        try:
+            res = client.post('/quizzes/results', json={'player': 'ann', 'token': self.play(1, 1, client=client)})
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(store.worker.is_alive())
+
+            deadline = time.monotonic() + 5
+            while store.stats()['written'] < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(store.stats()['written'], 1)
+        finally:
+            stop_background_writes(app)
+            with app.app_context():
+                db.get_engine(app).dispose()
+        db.session.remove()
+        self.assertEqual(QuizResult.query.one().player, 'ann')
+        self.assertFalse(store.worker.is_alive())
+
+    def test_leaderboard_max_age(self):
+        now = [0.0]
+        store = results.QuizResults(self.app, interval=None, max_age=10, clock=lambda: now[0])
+        store.add('ann', None, 1, 1)
+        self.assertEqual(store.board().top(), [('ann', 1)])
+
+        # written by another worker
+        db.session.add(QuizResult(player='bob', score=2, total=2, created_at=datetime.utcnow()))
+        db.session.commit()
+        self.assertEqual(store.board().top(), [('ann', 1)])
+        now[0] = 10.0
+        self.assertEqual(store.board().top(), [('bob', 2), ('ann', 1)])
+        store.stop()
+
+    def test_no_flush_during_a_load(self):
+        store = results.QuizResults(self.app, interval=None)
+        store.add('ann', None, 3, 3)
+        flushes = []
+        def loader():
+            # a flush now would take 'ann' out of the buffer before it is read
+            flushing = threading.Thread(target=lambda: flushes.append(store.flush()))
+            flushing.start()
+            flushing.join(0.1)
+            self.assertTrue(flushing.is_alive())
+            flushes.append(flushing)
+            return results.load_leaderboard_rows()
+
+        store.loader = loader
+        self.assertEqual(store.board().top(), [('ann', 3)])
+        flushes[0].join()
+        self.assertEqual(flushes[1:], [1])
+
+    def test_one_reload_at_a_time(self):
+        now = [0.0]
+        store = results.QuizResults(self.app, interval=None, max_age=10, clock=lambda: now[0])
+        store.add('ann', None, 1, 1)
+        first = store.board()
+        now[0] = 10.0
+
+        loading, release = threading.Event(), threading.Event()
+        loads = []
+        def loader():
+            loads.append(None)
+            loading.set()
+            release.wait(5)
+            return results.load_leaderboard_rows()
+
+        store.loader = loader
+        reloading = threading.Thread(target=store.board)
+        reloading.start()
+        self.assertTrue(loading.wait(5))
+        # the stale leaderboard is served meanwhile, without another load
+        self.assertIs(store.board(), first)
+        release.set()
+        reloading.join()
+        self.assertIsNot(store.board(), first)
+        self.assertEqual(len(loads), 1)
+        store.stop()
+
+
+class QuestionStatsTestCase(SQLiteTestCase):
+    """Tests for the per question statistics"""
+
+    def setUp(self):
+        super().setUp()
+        self.stats = self.app.extensions['trivia_question_stats']
+
+    def check(self, question_id, guess):
+        res = self.client().post('/questions/{}/answer'.format(question_id), json={'answer': guess})
+        self.assertEqual(res.status_code, 200)
+
+    # draws question `id` in a quiz session and answers it, returns the token
+    def answer(self, id, guess):
+        token = self.app.extensions['trivia_quiz_sessions'].create(quiz.new_session_state([id]))
+        self.client().post('/quizzes/sessions/{}/next'.format(token))
+        res = self.client().post('/quizzes/sessions/{}/answer'.format(token), json={'answer': guess})
+        self.assertEqual(res.status_code, 200)
+        return token
+
+    def written(self):
+        db.session.expire_all()
+        return {stat.question_id: (stat.served, stat.answered, stat.correct)
+                for stat in QuestionStat.query}
+
+    def get_stats(self, category_id, query=''):
+        res = self.client().get('/categories/{}/questions/stats{}'.format(category_id, query))
+        return res.status_code, json.loads(res.data)
+
+    def test_counts(self):
+        res = self.client().post('/quizzes', json={
+            'quiz_category': {'type': 'Science', 'id': 1}, 'previous_questions': [1, 2, 3, 4]})
+        self.assertEqual(json.loads(res.data)['question']['id'], 5)
+        token = self.answer(5, 'Answer 4')
+        self.answer(5, 'wrong')
+        self.answer(1, 'Answer 0')
+        # a question drawn is answered once, the answer checks do not count
+        res = self.client().post('/quizzes/sessions/{}/answer'.format(token), json={'answer': 'Answer 4'})
+        self.assertEqual(res.status_code, 422)
+        self.check(1, 'Answer 0')
+        self.check(1, 'nope')
+        self.assertEqual(self.stats.pending(), {5: (3, 2, 1), 1: (1, 1, 1)})
+
+        self.assertEqual(self.stats.flush(), 2)
+        self.assertEqual(self.written(), {5: (3, 2, 1), 1: (1, 1, 1)})
+        self.assertEqual(self.stats.pending(), {})
+
+        # added to the written counts
+        self.answer(5, 'Answer 4')
+        self.stats.served(2)
+        self.stats.flush()
+        self.assertEqual(self.written(), {5: (4, 3, 2), 1: (1, 1, 1), 2: (1, 0, 0)})
+
+    def test_served_by_the_sessions(self):
+        token = json.loads(self.client().post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'Art', 'id': 2}}).data)['token']
+        for _ in range(2):
+            self.client().post('/quizzes/sessions/{}/next'.format(token))
+        token = json.loads(self.client().post('/quizzes/adaptive', json={
+            'quiz_category': {'type': 'Art', 'id': 2}}).data)['token']
+        self.client().post('/quizzes/adaptive/{}/next'.format(token))
+
+        pending = self.stats.pending()
+        self.assertEqual(sum(served for served, _, _ in pending.values()), 3)
+        self.assertTrue(all(6 <= id <= 10 for id in pending))
+
+    def test_flush_failure_keeps_the_counts(self):
+        def write(rows):
+            raise RuntimeError('database is down')
+
+        self.stats.write = write
+        self.answer(3, 'Answer 2')
+        self.assertEqual(self.stats.flush(), 0)
+        self.answer(3, 'nope')
+        self.assertEqual(self.stats.pending(), {3: (2, 2, 1)})
+        self.assertEqual(self.stats.stats()['failures'], 1)
+
+        self.stats.write = stats.upsert_stats
+        self.assertEqual(self.stats.flush(), 1)
+        self.assertEqual(self.written(), {3: (2, 2, 1)})
+
+    def test_deleted_questions(self):
+        self.stats.served(1)
+        self.stats.served(2)
+        self.stats.served(3)
+        Question.query.get(1).delete()
+        # deleted by another worker, without the commit hooks
+        db.session.execute(Question.__table__.delete().where(Question.id == 2))
+        db.session.commit()
+
+        self.assertNotIn(1, self.stats.pending())
+        self.stats.flush()
+        self.assertEqual(self.written(), {3: (1, 0, 0)})
+
+    def test_category_stats_are_sorted_by_the_database(self):
+        for id in range(1, 6):
+            self.stats.count(id, served=1, answered=id, correct=id // 2)
+        self.stats.flush()
+        # 2 right answers out of 7 for question 5
+        self.stats.answered(5, False)
+        self.stats.answered(5, False)
+
+        with self.count_queries() as statements:
+            result = stats.category_stats(1, self.stats.pending(), 'hardest', limit=2)
+        self.assertEqual([stat['id'] for stat in result], [1, 5])
+        # the pending question, then the sorted page of the others
+        self.assertEqual(len(statements), 2)
+        self.assertIn('LIMIT', statements[1])
+        self.assertIn('ORDER BY', statements[1])
+
+    def test_suggested_difficulty(self):
+        self.assertIsNone(stats.suggested_difficulty(19, 19))
+        self.assertEqual(stats.suggested_difficulty(20, 20), 1)
+        self.assertEqual(stats.suggested_difficulty(20, 16), 1)
+        self.assertEqual(stats.suggested_difficulty(20, 15), 2)
+        self.assertEqual(stats.suggested_difficulty(20, 10), 3)
+        self.assertEqual(stats.suggested_difficulty(20, 0), 5)
+
+    def test_category_stats(self):
+        # questions 1 to 5 are the Science ones
+        for id, right, wrong in ((1, 3, 1), (2, 0, 2), (3, 20, 0), (4, 1, 1)):
+            for _ in range(right):
+                self.stats.answered(id, True)
+            for _ in range(wrong):
+                self.stats.answered(id, False)
+            self.stats.served(id)
+        self.stats.served(5)
+        self.stats.served(5)
+        self.stats.flush()
+        # merged with the counts not written yet
+        self.stats.answered(4, True)
+
+        status, data = self.get_stats(1)
+        self.assertEqual(status, 200)
+        self.assertEqual([(stat['id'], stat['success_rate']) for stat in data['questions']],
+                         [(2, 0.0), (4, 0.6667), (1, 0.75), (3, 1.0)])
+        self.assertEqual(data['questions'][-1], {
+            'id': 3, 'question': 'Question 2 in category 1', 'difficulty': 3, 'served': 1,
+            'answered': 20, 'correct': 20, 'success_rate': 1.0, 'suggested_difficulty': 1})
+
+        _, data = self.get_stats(1, '?sort=easiest&limit=2')
+        self.assertEqual([stat['id'] for stat in data['questions']], [3, 1])
+        _, data = self.get_stats(1, '?sort=served&min_answered=0')
+        self.assertEqual([stat['id'] for stat in data['questions']], [5, 1, 2, 3, 4])
+        _, data = self.get_stats(1, '?min_answered=4')
+        self.assertEqual([stat['id'] for stat in data['questions']], [1, 3])
+        _, data = self.get_stats(2)
+        self.assertEqual(data['questions'], [])
+
+        # the pending counts move a question up, past the database's limit
+        for _ in range(10):
+            self.stats.answered(3, False)
+        _, data = self.get_stats(1, '?limit=1')
+        self.assertEqual([(stat['id'], stat['answered']) for stat in data['questions']], [(2, 2)])
+        _, data = self.get_stats(1, '?sort=easiest&limit=1')
+        self.assertEqual([stat['id'] for stat in data['questions']], [1])
+
+        self.assertEqual(self.get_stats(1, '?sort=random')[0], 400)
+        self.assertEqual(self.get_stats(1, '?limit=0')[0], 400)
+        self.assertEqual(self.get_stats(99)[0], 404)
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
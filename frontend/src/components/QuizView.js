@@ -9,12 +9,15 @@ class QuizView extends Component {
     super();
     this.state = {
       quizCategory: null,
+      token: null,
       previousQuestions: [],
       showAnswer: false,
       categories: {},
       numCorrect: 0,
       currentQuestion: {},
       guess: '',
+      correct: false,
+      answer: '',
       forceEnd: false,
     };
   }
@@ -35,7 +38,30 @@ class QuizView extends Component {
   }
 
   selectCategory = ({ type, id = 0 }) => {
-    this.setState({ quizCategory: { type, id } }, this.getNextQuestion);
+    this.setState({ quizCategory: { type, id } }, this.startSession);
+  };
+
+  // the server keeps the questions left and the score of the session
+  startSession = () => {
+    $.ajax({
+      url: '/quizzes/sessions',
+      type: 'POST',
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({ quiz_category: this.state.quizCategory }),
+      xhrFields: {
+        withCredentials: true,
+      },
+      crossDomain: true,
+      success: (result) => {
+        this.setState({ token: result.token }, this.getNextQuestion);
+        return;
+      },
+      error: (error) => {
+        alert('Unable to start the quiz. Please try your request again');
+        return;
+      },
+    });
   };
 
   handleChange = (event) => {
@@ -49,14 +75,10 @@ class QuizView extends Component {
     }
 
     $.ajax({
-      url: '/quizzes',
+      url: `/quizzes/sessions/${this.state.token}/next`,
       type: 'POST',
       dataType: 'json',
       contentType: 'application/json',
-      data: JSON.stringify({
-        previous_questions: previousQuestions,
-        quiz_category: this.state.quizCategory,
-      }),
       xhrFields: {
         withCredentials: true,
       },
@@ -80,21 +102,53 @@ class QuizView extends Component {
 
   submitGuess = (event) => {
     event.preventDefault();
-    let evaluate = this.evaluateAnswer();
-    this.setState({
-      numCorrect: !evaluate ? this.state.numCorrect : this.state.numCorrect + 1,
-      showAnswer: true,
+    $.ajax({
+      url: `/quizzes/sessions/${this.state.token}/answer`,
+      type: 'POST',
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({ answer: this.state.guess }),
+      xhrFields: {
+        withCredentials: true,
+      },
+      crossDomain: true,
+      success: (result) => {
+        this.setState({
+          numCorrect: result.score,
+          correct: result.correct,
+          answer: result.answer,
+          showAnswer: true,
+        });
+        return;
+      },
+      error: (error) => {
+        alert('Unable to check the answer. Please try your request again');
+        return;
+      },
     });
   };
 
   restartGame = () => {
+    if (this.state.token) {
+      $.ajax({
+        url: `/quizzes/sessions/${this.state.token}`,
+        type: 'DELETE',
+        xhrFields: {
+          withCredentials: true,
+        },
+        crossDomain: true,
+      });
+    }
     this.setState({
       quizCategory: null,
+      token: null,
       previousQuestions: [],
       showAnswer: false,
       numCorrect: 0,
       currentQuestion: {},
       guess: '',
+      correct: false,
+      answer: '',
       forceEnd: false,
     });
   };
@@ -139,19 +193,8 @@ class QuizView extends Component {
     );
   }
 
-  evaluateAnswer = () => {
-    const formatGuess = this.state.guess
-      // eslint-disable-next-line
-      .replace(/[.,\/#!$%\^&\*;:{}=\-_`~()]/g, '')
-      .toLowerCase();
-    const answerArray = this.state.currentQuestion.answer
-      .toLowerCase()
-      .split(' ');
-    return answerArray.every((el) => formatGuess.includes(el));
-  };
-
   renderCorrectAnswer() {
-    let evaluate = this.evaluateAnswer();
+    const evaluate = this.state.correct;
     return (
       <div className='quiz-play-holder'>
         <div className='quiz-question'>
@@ -160,7 +203,7 @@ class QuizView extends Component {
         <div className={`${evaluate ? 'correct' : 'wrong'}`}>
           {evaluate ? 'You were correct!' : 'You were incorrect'}
         </div>
-        <div className='quiz-answer'>{this.state.currentQuestion.answer}</div>
+        <div className='quiz-answer'>{this.state.answer}</div>
         <div className='next-question button' onClick={this.getNextQuestion}>
           {' '}
           Next Question{' '}